@@ -1,12 +1,14 @@
 from django.contrib import admin
-from apps.history.models import History
+from apps.history.models import History, Conversation, UsageDaily
+from apps.history import conversations, recent
+from chatbox import context
 from django.contrib.auth.models import User
 
 @admin.register(History)
 class HistoryAdmin(admin.ModelAdmin):
     # Use the method names (strings) in list_display
-    list_display = ('username', 'id', 'short_user_msg', 'short_ai_msg', 'created_at')
-    list_filter = ('user', 'created_at')
+    list_display = ('username', 'id', 'short_user_msg', 'short_ai_msg', 'model', 'tokens', 'created_at')
+    list_filter = ('user', 'model', 'created_at')
     search_fields = ('user__username', 'user_message', 'ai_message')
 
     # Django >= 3.2 / 4.x / 5.x: use @admin.display for nicer metadata
@@ -25,5 +27,44 @@ class HistoryAdmin(admin.ModelAdmin):
     @admin.display(description='AI message')
     def short_ai_msg(self, obj):
         return (obj.ai_message[:50] + '...') if len(obj.ai_message) > 50 else obj.ai_message  
+
+    @admin.display(description='Tokens')
+    def tokens(self, obj):
+        if obj.prompt_tokens is None and obj.completion_tokens is None:
+            return '-'
+        return (obj.prompt_tokens or 0) + (obj.completion_tokens or 0)
+
+    # Keep Conversation summaries in step with admin deletes
+    def delete_model(self, request, obj):
+        super().delete_model(request, obj)
+        conversations.refresh(obj.user, [obj.chat_id])
+        recent.invalidate(obj.user_id, [obj.chat_id])
+        context.forget_summaries(obj.user_id, [obj.chat_id])
+
+    def delete_queryset(self, request, queryset):
+        affected = set(queryset.values_list("user_id", "chat_id"))
+        super().delete_queryset(request, queryset)
+        for user_id, chat_id in affected:
+            conversations.refresh(user_id, [chat_id])
+            recent.invalidate(user_id, [chat_id])
+            context.forget_summaries(user_id, [chat_id])
+
+
+@admin.register(Conversation)
+class ConversationAdmin(admin.ModelAdmin):
+    list_display = ('user', 'chat_id', 'preview', 'message_count', 'last_activity', 'is_archived')
+    list_filter = ('is_archived',)
+    search_fields = ('user__username', 'preview')
+    
     
-    
\ No newline at end of file
+
+@admin.register(UsageDaily)
+class UsageDailyAdmin(admin.ModelAdmin):
+    list_display = ('user', 'day', 'model', 'messages', 'prompt_tokens', 'completion_tokens', 'avg_ttft')
+    list_filter = ('day', 'model')
+    date_hierarchy = 'day'
+    search_fields = ('user__username',)
+
+    @admin.display(description='Avg TTFT (ms)')
+    def avg_ttft(self, obj):
+        return obj.avg_ttft_ms
@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class HistoryConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'apps.history'
+
+    def ready(self):
+        import apps.history.signal
+        from apps.history import checks  # noqa: F401
@@ -0,0 +1,52 @@
+from django.core.checks import Tags, Warning, register
+from django.db import connections
+from django.db.migrations.recorder import MigrationRecorder
+
+# Created by migration 0008_history_search, outside the History model
+SEARCH_MIGRATION = ("history", "0008_history_search")
+SQLITE_OBJECTS = {
+    ("table", "history_fts"),
+    ("trigger", "history_fts_insert"),
+    ("trigger", "history_fts_delete"),
+    ("trigger", "history_fts_update"),
+}
+
+
+def _missing(connection):
+    with connection.cursor() as cursor:
+        if connection.vendor == "sqlite":
+            cursor.execute("SELECT type, name FROM sqlite_master WHERE name LIKE %s", ["history_fts%"])
+            return sorted(name for kind, name in SQLITE_OBJECTS - set(cursor.fetchall()))
+        if connection.vendor == "postgresql":
+            cursor.execute(
+                "SELECT 1 FROM information_schema.columns "
+                "WHERE table_name = 'history_history' AND column_name = 'search_vector'"
+            )
+            return [] if cursor.fetchone() else ["history_history.search_vector"]
+    return []
+
+
+@register(Tags.database)
+def search_index_check(app_configs, databases=None, **kwargs):
+    """
+    History search (apps/history/search.py) needs what 0008 created; SQLite
+    table rebuilds in later migrations silently drop the FTS triggers
+    """
+    errors = []
+    for alias in databases or []:
+        connection = connections[alias]
+        if SEARCH_MIGRATION not in MigrationRecorder(connection).applied_migrations():
+            continue
+        missing = _missing(connection)
+        if missing:
+            errors.append(
+                Warning(
+                    f"History search objects are missing on database '{alias}': "
+                    f"{', '.join(missing)}. Search results will be stale or fail.",
+                    hint="A History migration that rebuilds the table on SQLite must "
+                    "restore them, as 0009_usage.restore_sqlite_search does.",
+                    obj="history.History",
+                    id="history.W001",
+                )
+            )
+    return errors
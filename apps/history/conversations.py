@@ -0,0 +1,138 @@
+from django.db.models import Count, F, Max, Min, OuterRef, Q, Subquery
+
+from apps.history.models import Conversation, History
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp")
+IMAGE_REGEX = r"\.(jpe?g|png|webp)$"
+PREVIEW_LENGTH = 60
+
+
+def is_image(uploaded_file):
+    return bool(uploaded_file) and uploaded_file.name.lower().endswith(IMAGE_EXTENSIONS)
+
+
+# =====================
+# INCREMENTAL (ON WRITE)
+# =====================
+def record_message(history):
+    """
+    Fold one newly created History row into its Conversation
+    """
+    image = history.uploaded_file.name if is_image(history.uploaded_file) else ""
+
+    conversation, created = Conversation.objects.get_or_create(
+        user_id=history.user_id,
+        chat_id=history.chat_id,
+        defaults={
+            "preview": (history.user_message or "")[:PREVIEW_LENGTH],
+            "image": image,
+            "message_count": 1,
+            "started_at": history.created_at,
+            "last_activity": history.created_at,
+            "is_archived": history.is_archived,
+        },
+    )
+    if created:
+        return
+
+    updates = {
+        "message_count": F("message_count") + 1,
+        "last_activity": history.created_at,
+    }
+    if image and not conversation.image:
+        updates["image"] = image
+    if history.user_message and not conversation.preview:
+        updates["preview"] = history.user_message[:PREVIEW_LENGTH]
+
+    Conversation.objects.filter(pk=conversation.pk).update(**updates)
+
+
+def set_archived(user, chat_id, archived):
+    Conversation.objects.filter(user=user, chat_id=chat_id).update(is_archived=archived)
+
+
+# =====================
+# REBUILD (DELETES / BACKFILL)
+# =====================
+def summarize(history_qs):
+    """
+    One aggregate row per (user, chat_id) in history_qs
+    """
+    chat_rows = History.objects.filter(
+        user_id=OuterRef("user_id"),
+        chat_id=OuterRef("chat_id"),
+    ).order_by("created_at")
+
+    return (
+        history_qs.order_by()
+        .values("user_id", "chat_id")
+        .annotate(
+            message_count=Count("id"),
+            archived_count=Count("id", filter=Q(is_archived=True)),
+            started_at=Min("created_at"),
+            last_activity=Max("created_at"),
+            preview=Subquery(chat_rows.exclude(user_message="").values("user_message")[:1]),
+            image=Subquery(
+                chat_rows.filter(uploaded_file__iregex=IMAGE_REGEX).values("uploaded_file")[:1]
+            ),
+        )
+    )
+
+
+def _to_conversation(row):
+    return Conversation(
+        user_id=row["user_id"],
+        chat_id=row["chat_id"],
+        preview=(row["preview"] or "")[:PREVIEW_LENGTH],
+        image=row["image"] or "",
+        message_count=row["message_count"],
+        started_at=row["started_at"],
+        last_activity=row["last_activity"],
+        is_archived=row["archived_count"] == row["message_count"],
+    )
+
+
+def rebuild(history_qs, batch_size=1000):
+    """
+    Upsert Conversation rows for every chat in history_qs; returns the count
+    """
+    total = 0
+    batch = []
+
+    for row in summarize(history_qs).iterator(chunk_size=batch_size):
+        batch.append(_to_conversation(row))
+        if len(batch) >= batch_size:
+            total += _upsert(batch)
+            batch = []
+
+    if batch:
+        total += _upsert(batch)
+    return total
+
+
+def _upsert(batch):
+    Conversation.objects.bulk_create(
+        batch,
+        update_conflicts=True,
+        unique_fields=["user", "chat_id"],
+        update_fields=[
+            "preview", "image", "message_count",
+            "started_at", "last_activity", "is_archived",
+        ],
+    )
+    return len(batch)
+
+
+def refresh(user, chat_ids):
+    """
+    Recompute the given chats after History rows were deleted
+    """
+    chat_ids = list(chat_ids)
+    if not chat_ids:
+        return
+
+    rebuild(History.objects.filter(user=user, chat_id__in=chat_ids))
+
+    remaining = History.objects.filter(user=user, chat_id__in=chat_ids).values("chat_id")
+    Conversation.objects.filter(user=user, chat_id__in=chat_ids) \
+        .exclude(chat_id__in=remaining).delete()
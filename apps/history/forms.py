@@ -1,5 +1,7 @@
 from django import forms
-from apps.history.models import History
+from apps.history.models import History, Conversation
+from apps.history import conversations, recent
+from chatbox import context, retrieval
 from django.utils.timezone import localdate
 from datetime import timedelta
 from django.utils import timezone
@@ -36,10 +38,24 @@ class CleanHistoryForm(forms.Form):
                 created_at__month=today.month
             )
 
-        elif range_type == "all":
-            pass
-
+        chat_ids = set(qs.values_list("chat_id", flat=True).distinct())
         qs.delete()
+        recent.invalidate(self.user.pk, chat_ids)
+        context.forget_summaries(self.user.pk, chat_ids)
+
+        # Chats left without rows lose their document index too
+        remaining = set(
+            History.objects.filter(user=self.user, chat_id__in=chat_ids)
+            .values_list("chat_id", flat=True).distinct()
+        )
+        retrieval.drop(self.user.pk, chat_ids - remaining)
+
+        if range_type == "all":
+            Conversation.objects.filter(user=self.user).delete()
+            return
+
+        # Partly cleaned chats keep a (recomputed) summary row
+        conversations.refresh(self.user, chat_ids)
 
 class DeleteHistoryForm(forms.Form):
     chat_id = forms.CharField()
@@ -57,4 +73,8 @@ class DeleteHistoryForm(forms.Form):
     def delete_history(self):
         chat_id = self.cleaned_data.get("chat_id")
         History.objects.filter(user=self.user, chat_id=chat_id).delete()
+        Conversation.objects.filter(user=self.user, chat_id=chat_id).delete()
+        recent.invalidate(self.user.pk, [chat_id])
+        context.forget_summaries(self.user.pk, [chat_id])
+        retrieval.drop(self.user.pk, [chat_id])
         return True
@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand
+
+from apps.history import conversations
+from apps.history.models import Conversation, History
+
+
+class Command(BaseCommand):
+    help = "Rebuild Conversation summary rows from History (safe to re-run)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--user", type=int, help="Only rebuild this user id")
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        history = History.objects.all()
+        summaries = Conversation.objects.all()
+
+        if options["user"]:
+            history = history.filter(user_id=options["user"])
+            summaries = summaries.filter(user_id=options["user"])
+
+        total = conversations.rebuild(history, batch_size=options["batch_size"])
+
+        # Drop summaries whose chat no longer has any messages
+        orphaned, _ = summaries.exclude(
+            chat_id__in=history.values("chat_id")
+        ).delete()
+
+        self.stdout.write(self.style.SUCCESS(
+            f"{total} conversations rebuilt, {orphaned} orphaned summaries removed"
+        ))
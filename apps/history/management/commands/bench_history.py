@@ -0,0 +1,138 @@
+from contextlib import contextmanager
+from datetime import timedelta
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.utils import timezone
+import random
+import statistics
+import time
+import uuid
+
+from apps.history.models import History
+
+BENCH_USER_PREFIX = "bench-history-"
+
+
+@contextmanager
+def explicit_created_at():
+    # auto_now_add would stamp every seeded row with the same time
+    field = History._meta.get_field("created_at")
+    field.auto_now_add = False
+    try:
+        yield
+    finally:
+        field.auto_now_add = True
+
+
+class Command(BaseCommand):
+    help = "Seed History with synthetic rows and report query plans/timings for each history query shape"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rows", type=int, default=1_000_000)
+        parser.add_argument("--users", type=int, default=200)
+        parser.add_argument("--chats-per-user", type=int, default=100)
+        parser.add_argument("--repeat", type=int, default=20)
+        parser.add_argument("--no-seed", action="store_true", help="Reuse rows from a previous run")
+        parser.add_argument("--cleanup", action="store_true", help="Delete the benchmark users and rows")
+
+    # =====================
+    # SEED
+    # =====================
+    def seed(self, rows, users, chats_per_user):
+        rng = random.Random(42)
+        now = timezone.now()
+
+        bench_users = [
+            User.objects.get_or_create(username=f"{BENCH_USER_PREFIX}{i}")[0]
+            for i in range(users)
+        ]
+        chats = {user.pk: [uuid.uuid4() for _ in range(chats_per_user)] for user in bench_users}
+
+        batch = []
+        with explicit_created_at():
+            for n in range(rows):
+                user = rng.choice(bench_users)
+                batch.append(History(
+                    user=user,
+                    chat_id=rng.choice(chats[user.pk]),
+                    user_message=f"synthetic question {n}",
+                    ai_message=f"synthetic answer {n}",
+                    created_at=now - timedelta(seconds=rng.randint(0, 365 * 24 * 3600)),
+                    is_archived=rng.random() < 0.1,
+                ))
+
+                if len(batch) >= 10_000:
+                    with transaction.atomic():
+                        History.objects.bulk_create(batch)
+                    batch.clear()
+                    self.stdout.write(f"\rseeded {n + 1}/{rows}", ending="")
+
+            if batch:
+                History.objects.bulk_create(batch)
+
+        # Fresh planner statistics, otherwise the plans below are guesses
+        with connection.cursor() as cursor:
+            cursor.execute(f"ANALYZE {History._meta.db_table}")
+
+        self.stdout.write(f"\rseeded {rows} rows for {users} users")
+
+    # =====================
+    # QUERY SHAPES (as issued by the views)
+    # =====================
+    def query_shapes(self, user, chat_id):
+        window_start = timezone.now() - timedelta(hours=24)
+
+        return {
+            "chat history (new_chatbot/stream_chatbot)": (
+                History.objects.filter(user=user, chat_id=chat_id)
+                .only("user_message", "ai_message", "uploaded_file", "created_at")
+                .order_by("-created_at")[:20],
+                list,
+            ),
+            "24h limit count (new_chatbot)": (
+                History.objects.filter(user=user, chat_id=chat_id, created_at__gte=window_start)
+                .exclude(user_message=""),
+                lambda qs: qs.count(),
+            ),
+            "view_history": (
+                History.objects.filter(user=user, is_archived=False).order_by("-created_at"),
+                list,
+            ),
+            "archived_history": (
+                History.objects.filter(user=user, is_archived=True).order_by("-created_at"),
+                list,
+            ),
+        }
+
+    def handle(self, *args, **options):
+        if options["cleanup"]:
+            deleted, _ = User.objects.filter(username__startswith=BENCH_USER_PREFIX).delete()
+            self.stdout.write(f"deleted {deleted} objects")
+            return
+
+        if not options["no_seed"]:
+            self.seed(options["rows"], options["users"], options["chats_per_user"])
+
+        sample = (
+            History.objects.filter(user__username__startswith=BENCH_USER_PREFIX)
+            .select_related("user").first()
+        )
+        if sample is None:
+            self.stderr.write("No benchmark rows; run without --no-seed first")
+            return
+
+        user, chat_id = sample.user, sample.chat_id
+
+        for label, (queryset, evaluate) in self.query_shapes(user, chat_id).items():
+            timings = []
+            for _ in range(options["repeat"]):
+                start = time.perf_counter()
+                evaluate(queryset.all())
+                timings.append((time.perf_counter() - start) * 1000)
+
+            self.stdout.write(self.style.MIGRATE_HEADING(label))
+            self.stdout.write(queryset.explain())
+            self.stdout.write(
+                f"median={statistics.median(timings):.2f} ms  max={max(timings):.2f} ms\n"
+            )
@@ -0,0 +1,27 @@
+# Generated by Django 5.2.18 on 2026-10-18 19:23
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('history', '0005_history_is_archived'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='history',
+            index=models.Index(fields=['user', 'chat_id', 'created_at'], name='history_user_chat_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='history',
+            index=models.Index(fields=['user', 'is_archived', 'created_at'], name='history_user_arch_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='history',
+            index=models.Index(condition=models.Q(('is_archived', False)), fields=['user', '-created_at'], name='history_active_created_idx'),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 5.2.18 on 2026-10-18 19:24
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('history', '0006_history_indexes'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Conversation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('chat_id', models.UUIDField(editable=False)),
+                ('preview', models.CharField(blank=True, max_length=60)),
+                ('image', models.FileField(blank=True, null=True, upload_to='chat_uploads/')),
+                ('message_count', models.PositiveIntegerField(default=0)),
+                ('started_at', models.DateTimeField()),
+                ('last_activity', models.DateTimeField()),
+                ('is_archived', models.BooleanField(default=False)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['user', 'is_archived', 'last_activity'], name='conv_user_arch_activity_idx'), models.Index(fields=['user', 'is_archived', 'started_at'], name='conv_user_arch_started_idx')],
+                'constraints': [models.UniqueConstraint(fields=('user', 'chat_id'), name='conversation_user_chat_uniq')],
+            },
+        ),
+    ]
@@ -0,0 +1,84 @@
+# Full-text search over History.user_message / ai_message (apps/history/search.py).
+# PostgreSQL: stored tsvector column + GIN index. SQLite: FTS5 external-content
+# table kept in step by triggers. The column/table live outside the Django
+# model and are only read through raw SQL. A later migration that makes SQLite
+# rebuild history_history drops the triggers and must restore them (see 0009
+# and the history.W001 check).
+
+from django.db import migrations
+
+POSTGRES_FORWARD = [
+    """
+    ALTER TABLE history_history ADD COLUMN search_vector tsvector
+    GENERATED ALWAYS AS (
+        setweight(to_tsvector('english'::regconfig, coalesce(user_message, '')), 'A')
+        || setweight(to_tsvector('english'::regconfig, coalesce(ai_message, '')), 'B')
+    ) STORED
+    """,
+    "CREATE INDEX history_search_vector_idx ON history_history USING GIN (search_vector)",
+]
+
+POSTGRES_REVERSE = [
+    "DROP INDEX IF EXISTS history_search_vector_idx",
+    "ALTER TABLE history_history DROP COLUMN IF EXISTS search_vector",
+]
+
+SQLITE_FORWARD = [
+    """
+    CREATE VIRTUAL TABLE history_fts USING fts5(
+        user_message, ai_message,
+        content='history_history', content_rowid='id',
+        tokenize='porter unicode61'
+    )
+    """,
+    """
+    CREATE TRIGGER history_fts_insert AFTER INSERT ON history_history BEGIN
+        INSERT INTO history_fts(rowid, user_message, ai_message)
+        VALUES (new.id, new.user_message, new.ai_message);
+    END
+    """,
+    """
+    CREATE TRIGGER history_fts_delete AFTER DELETE ON history_history BEGIN
+        INSERT INTO history_fts(history_fts, rowid, user_message, ai_message)
+        VALUES ('delete', old.id, old.user_message, old.ai_message);
+    END
+    """,
+    """
+    CREATE TRIGGER history_fts_update AFTER UPDATE OF user_message, ai_message ON history_history BEGIN
+        INSERT INTO history_fts(history_fts, rowid, user_message, ai_message)
+        VALUES ('delete', old.id, old.user_message, old.ai_message);
+        INSERT INTO history_fts(rowid, user_message, ai_message)
+        VALUES (new.id, new.user_message, new.ai_message);
+    END
+    """,
+    "INSERT INTO history_fts(history_fts) VALUES ('rebuild')",
+]
+
+SQLITE_REVERSE = [
+    "DROP TRIGGER IF EXISTS history_fts_update",
+    "DROP TRIGGER IF EXISTS history_fts_delete",
+    "DROP TRIGGER IF EXISTS history_fts_insert",
+    "DROP TABLE IF EXISTS history_fts",
+]
+
+
+def _run(statements):
+    def run(apps, schema_editor):
+        vendor = schema_editor.connection.vendor
+        for sql in statements.get(vendor, []):
+            schema_editor.execute(sql)
+    return run
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('history', '0007_conversation'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            _run({"postgresql": POSTGRES_FORWARD, "sqlite": SQLITE_FORWARD}),
+            _run({"postgresql": POSTGRES_REVERSE, "sqlite": SQLITE_REVERSE}),
+        ),
+    ]
@@ -0,0 +1,75 @@
+# Generated by Django 5.2.18 on 2026-10-18 19:54
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from importlib import import_module
+
+search = import_module("apps.history.migrations.0008_history_search")
+
+
+def restore_sqlite_search(apps, schema_editor):
+    # SQLite adds these columns by rebuilding history_history, which drops
+    # the FTS triggers from 0008; put them back and resync the index
+    if schema_editor.connection.vendor != "sqlite":
+        return
+    for sql in search.SQLITE_REVERSE[:3] + search.SQLITE_FORWARD[1:]:
+        schema_editor.execute(sql)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('history', '0008_history_search'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        # Runs last when unapplying (the fields' removal rebuilds the table too)
+        migrations.RunPython(migrations.RunPython.noop, restore_sqlite_search),
+        migrations.AddField(
+            model_name='history',
+            name='completion_tokens',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='history',
+            name='duration_ms',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='history',
+            name='model',
+            field=models.CharField(blank=True, default='', max_length=100),
+        ),
+        migrations.AddField(
+            model_name='history',
+            name='prompt_tokens',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='history',
+            name='ttft_ms',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.CreateModel(
+            name='UsageDaily',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('model', models.CharField(blank=True, default='', max_length=100)),
+                ('messages', models.PositiveIntegerField(default=0)),
+                ('prompt_tokens', models.PositiveBigIntegerField(default=0)),
+                ('completion_tokens', models.PositiveBigIntegerField(default=0)),
+                ('ttft_ms_total', models.PositiveBigIntegerField(default=0)),
+                ('ttft_samples', models.PositiveIntegerField(default=0)),
+                ('duration_ms_total', models.PositiveBigIntegerField(default=0)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['day', 'model'], name='usage_day_model_idx')],
+                'constraints': [models.UniqueConstraint(fields=('user', 'day', 'model'), name='usage_user_day_model_uniq')],
+            },
+        ),
+        migrations.RunPython(restore_sqlite_search, migrations.RunPython.noop),
+    ]
@@ -16,4 +16,102 @@ class History(models.Model):
         blank=True
     )
 
+    # Upstream usage for this reply (see chatbox/openrouter_api.py); empty
+    # for rows written before it was recorded
+    model = models.CharField(max_length=100, blank=True, default="")
+    prompt_tokens = models.PositiveIntegerField(null=True, blank=True)
+    completion_tokens = models.PositiveIntegerField(null=True, blank=True)
+    ttft_ms = models.PositiveIntegerField(null=True, blank=True)
+    duration_ms = models.PositiveIntegerField(null=True, blank=True)
 
+    class Meta:
+        indexes = [
+            # chat views + 24h limit: filter(user, chat_id) order by created_at
+            models.Index(
+                fields=["user", "chat_id", "created_at"],
+                name="history_user_chat_created_idx",
+            ),
+            # history / archive pages: filter(user, is_archived) order by created_at
+            models.Index(
+                fields=["user", "is_archived", "created_at"],
+                name="history_user_arch_created_idx",
+            ),
+            # hot path: the (much larger) non-archived set only
+            models.Index(
+                fields=["user", "-created_at"],
+                condition=models.Q(is_archived=False),
+                name="history_active_created_idx",
+            ),
+        ]
+
+
+
+
+class Conversation(models.Model):
+    """
+    One row per chat, kept in step with History (see conversations.py) so
+    the history/archive pages read O(chats) rows instead of every message.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    chat_id = models.UUIDField(editable=False)
+    preview = models.CharField(max_length=60, blank=True)
+    image = models.FileField(upload_to="chat_uploads/", null=True, blank=True)
+    message_count = models.PositiveIntegerField(default=0)
+    started_at = models.DateTimeField()
+    last_activity = models.DateTimeField()
+    is_archived = models.BooleanField(default=False)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["user", "chat_id"], name="conversation_user_chat_uniq"),
+        ]
+        indexes = [
+            models.Index(
+                fields=["user", "is_archived", "last_activity"],
+                name="conv_user_arch_activity_idx",
+            ),
+            models.Index(
+                fields=["user", "is_archived", "started_at"],
+                name="conv_user_arch_started_idx",
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.user.username} - {self.chat_id}"
+
+
+class UsageDaily(models.Model):
+    """
+    Token usage per user, day and model, kept in step with History as rows
+    are written (see usage.py). A ledger: deleting chats does not refund it.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    day = models.DateField()
+    model = models.CharField(max_length=100, blank=True, default="")
+    messages = models.PositiveIntegerField(default=0)
+    prompt_tokens = models.PositiveBigIntegerField(default=0)
+    completion_tokens = models.PositiveBigIntegerField(default=0)
+    # Sums, for averages over the day
+    ttft_ms_total = models.PositiveBigIntegerField(default=0)
+    ttft_samples = models.PositiveIntegerField(default=0)
+    duration_ms_total = models.PositiveBigIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["user", "day", "model"], name="usage_user_day_model_uniq"),
+        ]
+        indexes = [
+            # admin reporting: all users for a day range
+            models.Index(fields=["day", "model"], name="usage_day_model_idx"),
+        ]
+
+    @property
+    def total_tokens(self):
+        return self.prompt_tokens + self.completion_tokens
+
+    @property
+    def avg_ttft_ms(self):
+        return round(self.ttft_ms_total / self.ttft_samples) if self.ttft_samples else None
+
+    def __str__(self):
+        return f"{self.user.username} - {self.day} - {self.model}"
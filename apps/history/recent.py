@@ -0,0 +1,152 @@
+"""
+Per-(user, chat_id) cache of the most recent History turns
+
+The chat views read the last CONTEXT_HISTORY_ROWS turns on every message.
+This keeps that list in the cache, appends to it once a History row is
+written (signal.py, writer.py) and drops it on delete/clean/archive, so a
+steady-state turn does no history query at all.
+
+The cache has no atomic list append, so appends and cold loads hold a
+short per-chat lock (cache.add); turns are kept unique and in id order.
+An append that cannot get the lock drops the list instead.
+"""
+
+from django.conf import settings
+from django.core.cache import cache
+import asyncio
+import time
+import uuid
+
+from apps.history.models import History
+
+RECENT_TTL = 3600
+LOCK_SECONDS = 5
+LOCK_WAIT_SECONDS = 0.2
+LOCK_POLL_SECONDS = 0.005
+
+
+def _key(user_id, chat_id):
+    try:
+        chat_id = uuid.UUID(str(chat_id))
+    except ValueError:
+        pass
+    return f"history:recent:v3:{user_id}:{chat_id}"
+
+
+def _to_turn(item):
+    return {
+        # Position for the context summary (chatbox/context.py)
+        "id": item.pk,
+        "user_message": item.user_message,
+        "ai_message": item.ai_message,
+        "uploaded_file": item.uploaded_file.name if item.uploaded_file else "",
+    }
+
+
+def file_url(name):
+    if not name:
+        return None
+    return History._meta.get_field("uploaded_file").storage.url(name)
+
+
+def _query(user_id, chat_id):
+    return History.objects.filter(
+        user_id=user_id,
+        chat_id=chat_id
+    ).only("user_message", "ai_message", "uploaded_file", "created_at") \
+    .order_by("-created_at")[:settings.CONTEXT_HISTORY_ROWS]
+
+
+# =====================
+# PER-CHAT LOCK
+# =====================
+def _lock_key(key):
+    return f"{key}:lock"
+
+
+def _acquire(key):
+    deadline = time.monotonic() + LOCK_WAIT_SECONDS
+    while not cache.add(_lock_key(key), 1, LOCK_SECONDS):
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(LOCK_POLL_SECONDS)
+    return True
+
+
+async def _aacquire(key):
+    deadline = time.monotonic() + LOCK_WAIT_SECONDS
+    while not await cache.aadd(_lock_key(key), 1, LOCK_SECONDS):
+        if time.monotonic() >= deadline:
+            return False
+        await asyncio.sleep(LOCK_POLL_SECONDS)
+    return True
+
+
+# =====================
+# READ
+# =====================
+def get_recent(user_id, chat_id):
+    """
+    Recent turns, oldest first
+    """
+    key = _key(user_id, chat_id)
+    turns = cache.get(key)
+
+    if turns is None:
+        # Under the lock, so no row is written between the query and the fill
+        locked = _acquire(key)
+        try:
+            turns = [_to_turn(item) for item in reversed(list(_query(user_id, chat_id)))]
+            if locked:
+                cache.add(key, turns, RECENT_TTL)
+        finally:
+            if locked:
+                cache.delete(_lock_key(key))
+    return turns
+
+
+async def aget_recent(user_id, chat_id):
+    key = _key(user_id, chat_id)
+    turns = await cache.aget(key)
+
+    if turns is None:
+        locked = await _aacquire(key)
+        try:
+            rows = [item async for item in _query(user_id, chat_id)]
+            turns = [_to_turn(item) for item in reversed(rows)]
+            if locked:
+                await cache.aadd(key, turns, RECENT_TTL)
+        finally:
+            if locked:
+                await cache.adelete(_lock_key(key))
+    return turns
+
+
+# =====================
+# WRITE
+# =====================
+def append(history):
+    """
+    Add a written (committed) row to an already cached list; a miss stays a
+    miss and is filled from the DB on the next read
+    """
+    key = _key(history.user_id, history.chat_id)
+
+    if not _acquire(key):
+        # Cannot append safely: make the next read go to the DB
+        cache.delete(key)
+        return
+
+    try:
+        turns = cache.get(key)
+        if turns is None or any(turn["id"] == history.pk for turn in turns):
+            return
+
+        turns = sorted(turns + [_to_turn(history)], key=lambda turn: turn["id"])
+        cache.set(key, turns[-settings.CONTEXT_HISTORY_ROWS:], RECENT_TTL)
+    finally:
+        cache.delete(_lock_key(key))
+
+
+def invalidate(user_id, chat_ids):
+    cache.delete_many([_key(user_id, chat_id) for chat_id in chat_ids])
@@ -0,0 +1,268 @@
+"""
+Full-text search over a user's History (see migration 0008_history_search)
+
+Matches are ranked in the database (ts_rank_cd on PostgreSQL, bm25 on
+SQLite FTS5), grouped by chat_id and paginated by chat. Snippets are only
+built for the rows on the requested page. Other backends fall back to an
+unindexed icontains match ranked by hit count.
+"""
+
+from django.db import connection
+from django.db.models import Count, Max, Q
+from django.utils.dateparse import parse_datetime
+from django.utils.html import escape
+from django.utils import timezone
+from apps.history.models import History
+from datetime import timezone as dt_timezone
+import re
+import uuid
+
+PAGE_SIZE = 10
+SNIPPETS_PER_CHAT = 3
+
+# Highlight markers that cannot occur in user text; escaped then turned into <mark>
+START_MARK = "\x02"
+STOP_MARK = "\x03"
+
+_WORD = re.compile(r"\w+", re.UNICODE)
+
+
+POSTGRES_SQL = f"""
+WITH q AS (
+    SELECT websearch_to_tsquery('english', %(query)s) AS query
+), matches AS MATERIALIZED (
+    SELECT h.id, h.chat_id, h.created_at, ts_rank_cd(h.search_vector, q.query) AS rank
+    FROM history_history h, q
+    WHERE h.user_id = %(user_id)s AND h.search_vector @@ q.query
+), chats AS (
+    SELECT chat_id, max(rank) AS best, count(*) AS hits, max(created_at) AS last_match
+    FROM matches
+    GROUP BY chat_id
+    ORDER BY best DESC, last_match DESC, chat_id
+    LIMIT %(limit)s OFFSET %(offset)s
+), ranked AS (
+    SELECT m.*, row_number() OVER (
+        PARTITION BY m.chat_id ORDER BY m.rank DESC, m.created_at DESC
+    ) AS n
+    FROM matches m JOIN chats c ON c.chat_id = m.chat_id
+)
+SELECT r.chat_id, c.best, c.hits, r.id, r.created_at, r.rank,
+    ts_headline('english', h.user_message, q.query,
+        'StartSel={START_MARK}, StopSel={STOP_MARK}, MaxWords=25, MinWords=8, MaxFragments=2'),
+    ts_headline('english', h.ai_message, q.query,
+        'StartSel={START_MARK}, StopSel={STOP_MARK}, MaxWords=25, MinWords=8, MaxFragments=2'),
+    h.is_archived
+FROM ranked r
+JOIN chats c ON c.chat_id = r.chat_id
+JOIN history_history h ON h.id = r.id
+CROSS JOIN q
+WHERE r.n <= %(per_chat)s
+ORDER BY c.best DESC, c.last_match DESC, r.chat_id, r.rank DESC
+"""
+
+# bm25() is "lower is better"; negated so both backends rank descending
+SQLITE_SQL = f"""
+WITH fts AS MATERIALIZED (
+    -- drive from the FTS index, then look rows up by primary key
+    SELECT rowid AS id, -bm25(history_fts, 2.0, 1.0) AS rank
+    FROM history_fts
+    WHERE history_fts MATCH %(query)s
+), matches AS MATERIALIZED (
+    SELECT h.id, h.chat_id, h.created_at, fts.rank, h.is_archived
+    FROM fts
+    JOIN history_history h ON h.id = fts.id
+    WHERE h.user_id = %(user_id)s
+), chats AS (
+    SELECT chat_id, max(rank) AS best, count(*) AS hits, max(created_at) AS last_match
+    FROM matches
+    GROUP BY chat_id
+    ORDER BY best DESC, last_match DESC, chat_id
+    LIMIT %(limit)s OFFSET %(offset)s
+), ranked AS (
+    SELECT m.*, row_number() OVER (
+        PARTITION BY m.chat_id ORDER BY m.rank DESC, m.created_at DESC
+    ) AS n
+    FROM matches m JOIN chats c ON c.chat_id = m.chat_id
+)
+SELECT r.chat_id, c.best, c.hits, r.id, r.created_at, r.rank,
+    NULL, NULL, r.is_archived
+FROM ranked r JOIN chats c ON c.chat_id = r.chat_id
+WHERE r.n <= %(per_chat)s
+ORDER BY c.best DESC, c.last_match DESC, r.chat_id, r.rank DESC
+"""
+
+# snippet() needs the MATCH context, so it runs as a second query over the
+# page's rows only
+SQLITE_SNIPPETS_SQL = f"""
+SELECT rowid,
+    snippet(history_fts, 0, '{START_MARK}', '{STOP_MARK}', '…', 16),
+    snippet(history_fts, 1, '{START_MARK}', '{STOP_MARK}', '…', 16)
+FROM history_fts
+WHERE history_fts MATCH %s AND rowid IN ({{ids}})
+"""
+
+
+def fts5_query(text):
+    """
+    Plain words -> FTS5 query (all terms, last one as a prefix); no operators
+    """
+    words = _WORD.findall(text)
+    if not words:
+        return None
+    terms = [f'"{word}"' for word in words]
+    terms[-1] += "*"
+    return " ".join(terms)
+
+
+def highlight(snippet):
+    if not snippet:
+        return ""
+    return escape(snippet).replace(START_MARK, "<mark>").replace(STOP_MARK, "</mark>")
+
+
+def excerpt(message, words, width=80):
+    """
+    Window of message around the first matched word, with the words marked
+    """
+    lowered = message.lower()
+    found = [i for i in (lowered.find(word.lower()) for word in words) if i >= 0]
+    if not found:
+        return ""
+    start = max(min(found) - width // 2, 0)
+    text = message[start:start + width]
+    pattern = re.compile("|".join(re.escape(word) for word in words), re.IGNORECASE)
+    text = pattern.sub(lambda m: f"{START_MARK}{m.group(0)}{STOP_MARK}", text)
+    prefix = "…" if start else ""
+    suffix = "…" if start + width < len(message) else ""
+    return f"{prefix}{text}{suffix}"
+
+
+def _score(value):
+    # Significant digits, not decimals: bm25 on a small corpus is ~1e-6
+    return float(f"{float(value):.4g}")
+
+
+def _aware(value):
+    # SQLite hands back naive UTC strings
+    if isinstance(value, str):
+        value = parse_datetime(value)
+    if timezone.is_naive(value):
+        value = timezone.make_aware(value, dt_timezone.utc)
+    return value
+
+
+def search(user, text, page=1, page_size=PAGE_SIZE):
+    """
+    One page of chats matching text: (results, has_next)
+    """
+    text = (text or "").strip()
+    vendor = connection.vendor
+
+    if vendor == "postgresql":
+        sql, query = POSTGRES_SQL, text
+    elif vendor == "sqlite":
+        sql, query = SQLITE_SQL, fts5_query(text)
+    else:
+        return search_icontains(user, text, page, page_size)
+
+    if not query:
+        return [], False
+
+    params = {
+        "query": query,
+        "user_id": user.pk,
+        # one extra chat tells us whether there is a next page
+        "limit": page_size + 1,
+        "offset": (page - 1) * page_size,
+        "per_chat": SNIPPETS_PER_CHAT,
+    }
+
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        rows = cursor.fetchall()
+
+        if vendor == "sqlite" and rows:
+            ids = [row[3] for row in rows]
+            cursor.execute(
+                SQLITE_SNIPPETS_SQL.format(ids=", ".join(["%s"] * len(ids))),
+                [query, *ids],
+            )
+            snippets = {rowid: (user_snippet, ai_snippet) for rowid, user_snippet, ai_snippet in cursor.fetchall()}
+            rows = [row[:6] + snippets.get(row[3], ("", "")) + row[8:] for row in rows]
+
+    groups = {}
+    for chat_id, best, hits, history_id, created_at, rank, user_snippet, ai_snippet, archived in rows:
+        group = groups.get(chat_id)
+        if group is None:
+            group = groups[chat_id] = {
+                # SQLite stores UUIDs as bare hex
+                "chat_id": str(uuid.UUID(str(chat_id))),
+                "score": _score(best),
+                "hits": hits,
+                "snippets": [],
+            }
+        group["snippets"].append({
+            "id": history_id,
+            "created_at": _aware(created_at).isoformat(),
+            "score": _score(rank),
+            "is_archived": bool(archived),
+            "user_message": highlight(user_snippet),
+            "ai_message": highlight(ai_snippet),
+        })
+
+    results = list(groups.values())
+    return results[:page_size], len(results) > page_size
+
+
+def search_icontains(user, text, page=1, page_size=PAGE_SIZE):
+    """
+    search() without a full-text index: rows containing every word, chats
+    ranked by hits
+    """
+    words = _WORD.findall(text or "")
+    if not words:
+        return [], False
+
+    matches = History.objects.filter(user=user)
+    for word in words:
+        matches = matches.filter(Q(user_message__icontains=word) | Q(ai_message__icontains=word))
+
+    offset = (page - 1) * page_size
+    chats = list(
+        matches.values("chat_id")
+        .annotate(hits=Count("id"), last_match=Max("created_at"))
+        .order_by("-hits", "-last_match", "chat_id")[offset:offset + page_size + 1]
+    )
+    has_next = len(chats) > page_size
+    chats = chats[:page_size]
+
+    rows = {}
+    page_rows = (
+        matches.filter(chat_id__in=[chat["chat_id"] for chat in chats])
+        .only("id", "chat_id", "created_at", "is_archived", "user_message", "ai_message")
+        .order_by("-created_at")
+    )
+    for row in page_rows:
+        snippets = rows.setdefault(row.chat_id, [])
+        if len(snippets) < SNIPPETS_PER_CHAT:
+            snippets.append(row)
+
+    results = []
+    for chat in chats:
+        results.append({
+            "chat_id": str(chat["chat_id"]),
+            "score": float(chat["hits"]),
+            "hits": chat["hits"],
+            "snippets": [
+                {
+                    "id": row.id,
+                    "created_at": _aware(row.created_at).isoformat(),
+                    "score": 1.0,
+                    "is_archived": row.is_archived,
+                    "user_message": highlight(excerpt(row.user_message or "", words)),
+                    "ai_message": highlight(excerpt(row.ai_message or "", words)),
+                }
+                for row in rows.get(chat["chat_id"], [])
+            ],
+        })
+    return results, has_next
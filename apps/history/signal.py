@@ -0,0 +1,14 @@
+from django.db import transaction
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+from apps.history.models import History
+from apps.history.conversations import record_message
+from apps.history import recent, usage
+
+@receiver(post_save, sender=History)
+def update_conversation(sender, instance, created, **kwargs):
+    if created:
+        record_message(instance)
+        usage.record([instance])
+        # Only once the row is committed (see recent.append)
+        transaction.on_commit(lambda: recent.append(instance))
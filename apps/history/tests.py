@@ -1,3 +1,428 @@
-from django.test import TestCase
+from django.contrib.auth.models import User
+from django.core import checks
+from django.core.cache import cache
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from datetime import timedelta
+from unittest import mock
+import os
+import signal
+import tempfile
+import uuid
 
-# Create your tests here.
+from apps.history import conversations, recent, search, usage, views, writer
+from apps.history.forms import CleanHistoryForm
+from apps.history.models import Conversation, History, UsageDaily
+from chatbox import context, openrouter_api, retrieval
+from apps.history.writer import HistoryWriter
+
+
+class SearchTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user("searcher", password="pw")
+        self.chat = uuid.uuid4()
+        for i in range(3):
+            History.objects.create(
+                user=self.user, chat_id=self.chat,
+                user_message=f"hello world {i}", ai_message="a <b>reply</b>",
+            )
+        History.objects.create(user=self.user, chat_id=uuid.uuid4(), user_message="bye", ai_message="world")
+
+    def test_icontains_fallback(self):
+        results, has_next = search.search_icontains(self.user, "WORLD", page_size=1)
+
+        self.assertTrue(has_next)
+        self.assertEqual(results[0]["chat_id"], str(self.chat))
+        self.assertEqual(results[0]["hits"], 3)
+        self.assertEqual(len(results[0]["snippets"]), search.SNIPPETS_PER_CHAT)
+        self.assertIn("<mark>world</mark>", results[0]["snippets"][0]["user_message"])
+
+    def test_icontains_escapes_and_needs_every_word(self):
+        results, _ = search.search_icontains(self.user, "hello reply")
+
+        self.assertEqual([result["chat_id"] for result in results], [str(self.chat)])
+        self.assertEqual(results[0]["snippets"][0]["ai_message"], "a &lt;b&gt;<mark>reply</mark>&lt;/b&gt;")
+
+    def test_other_users_rows_are_not_searched(self):
+        other = User.objects.create_user("other", password="pw")
+
+        self.assertEqual(search.search_icontains(other, "world"), ([], False))
+
+
+class FullTextSearchTests(TestCase):
+    def setUp(self):
+        if connection.vendor not in ("sqlite", "postgresql"):
+            self.skipTest("No full-text index on this backend")
+        self.user = User.objects.create_user("fts", password="pw")
+        self.chats = [uuid.uuid4() for _ in range(3)]
+        self.add(self.chats[0], "python decorators explained", "they wrap a function")
+        self.add(self.chats[0], "python generators", "they yield values lazily")
+        self.add(self.chats[1], "how do I cook rice", "rinse it, then python is not needed")
+        self.add(self.chats[2], "<script>python</script> in a page", "escape it first")
+        other = User.objects.create_user("fts-other", password="pw")
+        History.objects.create(user=other, chat_id=uuid.uuid4(), user_message="python", ai_message="python")
+
+    def add(self, chat_id, user_message, ai_message):
+        return History.objects.create(
+            user=self.user, chat_id=chat_id, user_message=user_message, ai_message=ai_message,
+        )
+
+    def chat_ids(self, results):
+        return [result["chat_id"] for result in results]
+
+    def test_ranks_chats_and_keeps_small_scores(self):
+        results, has_next = search.search(self.user, "python")
+
+        self.assertFalse(has_next)
+        self.assertCountEqual(self.chat_ids(results), [str(chat) for chat in self.chats])
+        # A hit in the user message outranks one in the reply
+        self.assertLess(self.chat_ids(results).index(str(self.chats[0])), self.chat_ids(results).index(str(self.chats[1])))
+        scores = [result["score"] for result in results]
+        self.assertEqual(scores, sorted(scores, reverse=True))
+        self.assertTrue(all(score > 0 for score in scores))
+        self.assertEqual(results[self.chat_ids(results).index(str(self.chats[0]))]["hits"], 2)
+
+    def test_snippets_are_marked_and_escaped(self):
+        results, _ = search.search(self.user, "script page")
+        snippet = results[0]["snippets"][0]["user_message"]
+
+        self.assertIn("<mark>", snippet)
+        self.assertNotIn("<script>", snippet)
+
+    def test_pages_by_chat(self):
+        first, has_next = search.search(self.user, "python", page=1, page_size=2)
+        second, has_more = search.search(self.user, "python", page=2, page_size=2)
+
+        self.assertTrue(has_next)
+        self.assertFalse(has_more)
+        self.assertEqual(len(first), 2)
+        self.assertEqual(len(second), 1)
+        self.assertFalse(set(self.chat_ids(first)) & set(self.chat_ids(second)))
+
+    def test_query_syntax_is_not_passed_through(self):
+        self.assertEqual(search.fts5_query('a" OR b NEAR(c'), '"a" "OR" "b" "NEAR" "c"*')
+
+        for text in ['python" OR "rice', "NEAR(python rice)", "python*^", "'; --", ""]:
+            results, _ = search.search(self.user, text)
+            self.assertIsInstance(results, list)
+
+    def test_index_follows_updates_and_deletes(self):
+        row = History.objects.get(user_message="how do I cook rice")
+        row.user_message = "how do I cook quinoa"
+        row.save()
+
+        self.assertEqual(self.chat_ids(search.search(self.user, "quinoa")[0]), [str(self.chats[1])])
+        self.assertEqual(search.search(self.user, "rice")[0], [])
+
+        row.delete()
+        self.assertEqual(search.search(self.user, "quinoa")[0], [])
+
+
+class SearchIndexCheckTests(TestCase):
+    def messages(self):
+        return [m for m in checks.run_checks(databases=["default"]) if m.id == "history.W001"]
+
+    def test_migrated_database_has_search_objects(self):
+        self.assertEqual(self.messages(), [])
+
+    def test_missing_trigger_is_reported(self):
+        if connection.vendor != "sqlite":
+            self.skipTest("SQLite FTS triggers")
+        with connection.cursor() as cursor:
+            cursor.execute("DROP TRIGGER history_fts_update")
+
+        messages = self.messages()
+
+        self.assertEqual(len(messages), 1)
+        self.assertIn("history_fts_update", messages[0].msg)
+
+
+@override_settings(HISTORY_WRITER_ENABLED=False)
+class WriterRecentTests(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user("writer", password="pw")
+        self.chat = uuid.uuid4()
+        self.writer = HistoryWriter()
+
+    def row(self, message="hi"):
+        return History(user=self.user, chat_id=self.chat, user_message=message, ai_message="hello")
+
+    def cached(self):
+        return cache.get(recent._key(self.user.pk, self.chat))
+
+    def test_written_row_is_appended_once(self):
+        self.assertEqual(recent.get_recent(self.user.pk, self.chat), [])
+
+        history = self.row()
+        self.writer.submit(history)
+        recent.append(history)
+
+        self.assertEqual([turn["id"] for turn in self.cached()], [history.pk])
+
+    def test_dropped_row_invalidates_the_cached_turns(self):
+        recent.get_recent(self.user.pk, self.chat)
+        good, bad = self.row("kept"), self.row(None)
+
+        with self.assertLogs("apps.history.writer", "ERROR"):
+            self.writer._flush([(good, None), (bad, None)])
+
+        self.assertIsNone(self.cached())
+        self.assertEqual(self.writer.stats()["failed"], 1)
+        self.assertEqual(
+            [turn["user_message"] for turn in recent.get_recent(self.user.pk, self.chat)],
+            ["kept"],
+        )
+
+
+class UsageTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user("usage", password="pw")
+        self.chat = uuid.uuid4()
+
+    def row(self, model="model-a", prompt=10, completion=5, ttft=None):
+        # Unsaved, as the writer's bulk insert (no post_save) hands them over
+        return History(
+            user=self.user, chat_id=self.chat, user_message="hi", ai_message="hello",
+            model=model, prompt_tokens=prompt, completion_tokens=completion,
+            ttft_ms=ttft, duration_ms=100, created_at=timezone.now(),
+        )
+
+    def test_rows_fold_into_one_rollup_per_model(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            usage.record([self.row(ttft=200), self.row(ttft=400), self.row(model="model-b", completion=None)])
+
+        daily = UsageDaily.objects.get(user=self.user, model="model-a")
+        self.assertEqual((daily.messages, daily.prompt_tokens, daily.completion_tokens), (2, 20, 10))
+        self.assertEqual((daily.ttft_ms_total, daily.ttft_samples, daily.duration_ms_total), (600, 2, 200))
+        other = UsageDaily.objects.get(user=self.user, model="model-b")
+        self.assertEqual((other.messages, other.prompt_tokens, other.completion_tokens), (1, 10, 0))
+        self.assertEqual(other.ttft_samples, 0)
+
+    def test_later_batches_add_to_the_existing_rollup(self):
+        usage.record([self.row()])
+        usage.record([self.row(prompt=1, completion=2)])
+
+        daily = UsageDaily.objects.get(user=self.user, model="model-a")
+        self.assertEqual((daily.messages, daily.prompt_tokens, daily.completion_tokens), (2, 11, 7))
+
+    def test_tokens_used_is_refreshed_after_a_write(self):
+        self.assertEqual(usage.tokens_used(self.user.pk), 0)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            usage.record([self.row()])
+
+        self.assertEqual(usage.tokens_used(self.user.pk), 15)
+        self.assertEqual(usage.tokens_used(self.user.pk, timezone.localdate() - timedelta(days=1)), 0)
+
+    def test_saved_row_is_recorded_once(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            history = self.row()
+            history.save()
+            history.ai_message = "edited"
+            history.save()
+
+        self.assertEqual(usage.tokens_used(self.user.pk), 15)
+
+    def test_deleting_chats_does_not_refund_usage(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.row().save()
+        History.objects.filter(user=self.user).delete()
+
+        self.assertEqual(usage.tokens_used(self.user.pk), 15)
+
+    def test_reply_usage_reads_upstream_counts(self):
+        timer = mock.Mock(ttft_ms=120, duration_ms=900)
+        upstream = mock.Mock(prompt_tokens=7, completion_tokens=3)
+
+        self.assertEqual(openrouter_api.reply_usage("model-a", upstream, timer), {
+            "model": "model-a", "prompt_tokens": 7, "completion_tokens": 3,
+            "ttft_ms": 120, "duration_ms": 900,
+        })
+        self.assertEqual(openrouter_api.reply_usage(None, None, None), {
+            "model": "", "prompt_tokens": None, "completion_tokens": None,
+            "ttft_ms": None, "duration_ms": None,
+        })
+
+
+class SigtermTests(SimpleTestCase):
+    def install(self, previous):
+        self.addCleanup(signal.signal, signal.SIGTERM, signal.getsignal(signal.SIGTERM))
+        signal.signal(signal.SIGTERM, previous)
+        writer.install_sigterm_handler()
+        return signal.getsignal(signal.SIGTERM)
+
+    def test_exits_without_draining_in_the_handler(self):
+        handle = self.install(signal.SIG_DFL)
+
+        # The main thread may hold the writer's lock when the signal lands
+        with writer.writer._lock, mock.patch.object(writer.writer, "drain") as drain:
+            with self.assertRaises(SystemExit):
+                handle(signal.SIGTERM, None)
+        drain.assert_not_called()
+
+    def test_chains_to_the_previous_handler(self):
+        previous = mock.Mock()
+        handle = self.install(previous)
+
+        handle(signal.SIGTERM, None)
+
+        previous.assert_called_once_with(signal.SIGTERM, None)
+
+
+class CleanHistoryTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        index_dir = override_settings(RETRIEVAL_INDEX_DIR=directory.name)
+        index_dir.enable()
+        self.addCleanup(index_dir.disable)
+
+        self.user = User.objects.create_user("cleaner", password="pw")
+        self.emptied, self.kept = uuid.uuid4(), uuid.uuid4()
+        for chat_id in (self.emptied, self.kept):
+            History.objects.create(user=self.user, chat_id=chat_id, user_message="today", ai_message="ok")
+            retrieval.add_document(f"{self.user.pk}:{chat_id}", "notes.txt", "some notes about the chat")
+        old = History.objects.create(user=self.user, chat_id=self.kept, user_message="old", ai_message="ok")
+        History.objects.filter(pk=old.pk).update(created_at=timezone.now() - timedelta(days=40))
+
+    def clean(self, range_type):
+        form = CleanHistoryForm(self.user, data={"range_type": range_type})
+        self.assertTrue(form.is_valid())
+        form.clean_history()
+
+    def indexed(self, chat_id):
+        return os.path.exists(retrieval.index_path(f"{self.user.pk}:{chat_id}"))
+
+    def test_range_delete_drops_the_index_of_emptied_chats(self):
+        self.clean("day")
+
+        self.assertFalse(self.indexed(self.emptied))
+        self.assertTrue(self.indexed(self.kept))
+
+    def test_deleted_turns_leave_no_cached_summary(self):
+        untouched = uuid.uuid4()
+        for chat_id in (self.emptied, self.kept, untouched):
+            cache.set(context._summary_key(f"{self.user.pk}:{chat_id}"), {"text": "summary", "turn": 1})
+
+        self.clean("day")
+
+        self.assertIsNone(cache.get(context._summary_key(f"{self.user.pk}:{self.emptied}")))
+        self.assertIsNone(cache.get(context._summary_key(f"{self.user.pk}:{self.kept}")))
+        self.assertIsNotNone(cache.get(context._summary_key(f"{self.user.pk}:{untouched}")))
+
+    def test_clear_all_drops_every_index(self):
+        self.clean("all")
+
+        self.assertFalse(self.indexed(self.emptied))
+        self.assertFalse(self.indexed(self.kept))
+
+
+class ConversationTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user("talker", password="pw")
+        self.chat = uuid.uuid4()
+
+    def add(self, user_message, uploaded_file=None):
+        return History.objects.create(
+            user=self.user, chat_id=self.chat, user_message=user_message, ai_message="ok",
+            uploaded_file=uploaded_file,
+        )
+
+    def conversation(self):
+        return Conversation.objects.get(user=self.user, chat_id=self.chat)
+
+    def test_written_rows_are_folded_in(self):
+        self.add("", uploaded_file="chat_uploads/scan.PNG")
+        self.add("first question " * 10)
+        last = self.add("second question")
+
+        conversation = self.conversation()
+        self.assertEqual(conversation.message_count, 3)
+        self.assertEqual(conversation.preview, ("first question " * 10)[:conversations.PREVIEW_LENGTH])
+        self.assertEqual(conversation.image.name, "chat_uploads/scan.PNG")
+        self.assertEqual(conversation.last_activity, last.created_at)
+
+    def test_refresh_after_deletes(self):
+        first = self.add("first")
+        self.add("second")
+
+        first.delete()
+        conversations.refresh(self.user, [self.chat])
+        self.assertEqual(self.conversation().message_count, 1)
+        self.assertEqual(self.conversation().preview, "second")
+
+        History.objects.filter(chat_id=self.chat).delete()
+        conversations.refresh(self.user, [self.chat])
+        self.assertFalse(Conversation.objects.filter(chat_id=self.chat).exists())
+
+    def test_rebuild_matches_the_incremental_rows(self):
+        self.add("first")
+        self.add("second")
+        History.objects.filter(chat_id=self.chat).update(is_archived=True)
+        conversations.set_archived(self.user, self.chat, True)
+        incremental = Conversation.objects.filter(chat_id=self.chat).values().get()
+
+        Conversation.objects.all().delete()
+        self.assertEqual(conversations.rebuild(History.objects.all()), 1)
+
+        rebuilt = Conversation.objects.filter(chat_id=self.chat).values().get()
+        incremental.pop("id")
+        rebuilt.pop("id")
+        self.assertEqual(rebuilt, incremental)
+
+
+class ConversationPageTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user("pager", password="pw")
+        base = timezone.now() - timedelta(days=1)
+        self.chats = []
+        for i in range(7):
+            # Pairs share a timestamp, so the chat_id tiebreak is exercised
+            at = base + timedelta(minutes=i // 2)
+            conversation = Conversation.objects.create(
+                user=self.user, chat_id=uuid.uuid4(), preview=f"chat {i}",
+                message_count=1, started_at=at, last_activity=at,
+            )
+            self.chats.append(conversation)
+        Conversation.objects.create(
+            user=self.user, chat_id=uuid.uuid4(), preview="archived", message_count=1,
+            started_at=base, last_activity=base, is_archived=True,
+        )
+
+    def walk(self, sort_option):
+        seen, cursor = [], None
+        while True:
+            groups, cursor = views.conversation_page(self.user, False, sort_option, cursor=cursor, limit=3)
+            seen.extend(group["chat_id"] for group in groups)
+            if cursor is None:
+                return seen
+
+    def expected(self, sort_option):
+        ordering = views.conversation_ordering(sort_option)
+        return list(
+            Conversation.objects.filter(user=self.user, is_archived=False)
+            .order_by(*ordering).values_list("chat_id", flat=True)
+        )
+
+    def test_pages_cover_every_chat_once_in_order(self):
+        for sort_option in ("newest", "oldest"):
+            self.assertEqual(self.walk(sort_option), self.expected(sort_option), sort_option)
+
+    def test_bad_cursor_starts_from_the_top(self):
+        first, _ = views.conversation_page(self.user, False, "newest", limit=3)
+        again, _ = views.conversation_page(self.user, False, "newest", cursor="not-a-cursor", limit=3)
+
+        self.assertEqual(again, first)
+
+    def test_page_api(self):
+        self.client.force_login(self.user)
+
+        page = self.client.get(reverse("history:history_page"), {"archived": "1"}).json()
+
+        self.assertEqual([group["preview"] for group in page["results"]], ["archived"])
+        self.assertIsNone(page["next_cursor"])
+        self.assertIn("archived", page["html"])
@@ -9,6 +9,8 @@ app_name = "history"
 urlpatterns = [
     
     path("history/",views.view_history,name="history"),
+    path("history/page/", views.history_page, name="history_page"),
+    path("history/search/", views.history_search, name="history_search"),
     path("clean-history/", views.clean_history, name="clean-history"),
     path("delete-history/<uuid:chat_id>/", views.delete_history, name="delete_single_history"),
     path("archive/<uuid:chat_id>/", views.archive_chat, name="archive_chat"),
@@ -0,0 +1,76 @@
+"""
+Per-message token usage and the daily per-user rollup (UsageDaily)
+
+The chat clients report each reply's usage (OpenRouterChatbot.usage); it is
+stored on the History row and folded into UsageDaily(user, day, model) as
+the row is written, one upsert per (user, day, model) in the batch. Quota
+and admin reporting read the rollup, never History.
+"""
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F, Sum
+from django.utils import timezone
+
+from apps.history.models import UsageDaily
+
+TOKENS_CACHE_SECONDS = 300
+
+
+def tokens_cache_key(user_id, day):
+    return f"usage:tokens:{user_id}:{day.isoformat()}"
+
+
+def record(histories):
+    """
+    Fold newly written History rows into UsageDaily
+    """
+    totals = {}
+    for history in histories:
+        key = (history.user_id, timezone.localdate(history.created_at), history.model or "")
+        row = totals.setdefault(key, {
+            "messages": 0,
+            "prompt_tokens": 0,
+            "completion_tokens": 0,
+            "ttft_ms_total": 0,
+            "ttft_samples": 0,
+            "duration_ms_total": 0,
+        })
+        row["messages"] += 1
+        row["prompt_tokens"] += history.prompt_tokens or 0
+        row["completion_tokens"] += history.completion_tokens or 0
+        row["duration_ms_total"] += history.duration_ms or 0
+        if history.ttft_ms is not None:
+            row["ttft_ms_total"] += history.ttft_ms
+            row["ttft_samples"] += 1
+
+    for (user_id, day, model), values in totals.items():
+        usage, created = UsageDaily.objects.get_or_create(
+            user_id=user_id, day=day, model=model, defaults=values
+        )
+        if not created:
+            UsageDaily.objects.filter(pk=usage.pk).update(
+                **{field: F(field) + value for field, value in values.items()}
+            )
+
+    # Cached token totals are stale once this commits
+    stale = [tokens_cache_key(user_id, day) for user_id, day, _ in totals]
+    if stale:
+        transaction.on_commit(lambda: cache.delete_many(stale))
+
+
+def tokens_used(user_id, day=None):
+    """
+    Prompt + completion tokens for the user on `day` (cached)
+    """
+    day = day or timezone.localdate()
+    key = tokens_cache_key(user_id, day)
+
+    used = cache.get(key)
+    if used is None:
+        totals = UsageDaily.objects.filter(user_id=user_id, day=day).aggregate(
+            prompt=Sum("prompt_tokens"), completion=Sum("completion_tokens")
+        )
+        used = (totals["prompt"] or 0) + (totals["completion"] or 0)
+        cache.set(key, used, TOKENS_CACHE_SECONDS)
+    return used
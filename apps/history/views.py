@@ -1,56 +1,109 @@
 from django.shortcuts import render
 from django.contrib.auth.decorators import login_required
 from django.http import JsonResponse
-from apps.history.models import History
+from django.db.models import Q
+from django.template.loader import render_to_string
+from django.utils.dateparse import parse_datetime
+from apps.history.models import History, Conversation
+from apps.history import conversations, recent, search
 from apps.profiles.models import Profile
 from .forms import CleanHistoryForm, DeleteHistoryForm
-import json
+import base64, json, uuid
+
+PAGE_SIZE = 30
 
 
 # ================================
-# HISTORY PAGE
+# KEYSET PAGINATION
 # ================================
-@login_required(login_url='login')
-def view_history(request):
+# Pages are cut on (timestamp, chat_id) rather than OFFSET, so page N costs
+# the same index range scan as page 1 however much history a user has.
+def sort_field(sort_option):
+    return "last_activity" if sort_option == "newest" else "started_at"
+
+
+def conversation_ordering(sort_option):
+    if sort_option == "newest":
+        return ("-last_activity", "-chat_id")
+    return ("started_at", "chat_id")
+
+
+def encode_cursor(timestamp, chat_id):
+    raw = f"{timestamp.isoformat()}|{chat_id}".encode()
+    return base64.urlsafe_b64encode(raw).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        timestamp, chat_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        parsed = parse_datetime(timestamp)
+        return (parsed, uuid.UUID(chat_id)) if parsed else None
+    except (ValueError, UnicodeDecodeError):
+        return None
 
-    profile, _ = Profile.objects.get_or_create(user=request.user)
-    sort_option = request.GET.get("sort", "newest")
 
-    # Order directly from DB (IMPORTANT FIX)
-    ordering = "-created_at" if sort_option == "newest" else "created_at"
+def history_group(chat, sort_option):
+    start_time = getattr(chat, sort_field(sort_option))
 
-    messages = History.objects.filter(
-        user=request.user,
-        is_archived=False
-    ).order_by(ordering)
+    return {
+        "chat_id": chat.chat_id,
+        "start_time": start_time,
+        "preview": chat.preview or ("📷 Image" if chat.image else "No message"),
+        "image_url": chat.image.url if chat.image else None,
+        "count": chat.message_count,
+        "from_time": start_time.isoformat(),
+    }
 
-    chat_seen = set()
-    history_groups = []
 
-    # One entry per chat (stable order)
-    for msg in messages:
-        if msg.chat_id not in chat_seen:
+def conversation_page(user, archived, sort_option, cursor=None, limit=PAGE_SIZE):
+    """
+    One page of history groups plus the cursor for the next page (or None)
+    """
+    field = sort_field(sort_option)
 
-            is_image = (
-                msg.uploaded_file and
-                msg.uploaded_file.name.lower().endswith((".jpg", ".jpeg", ".png", ".webp"))
-            )
+    chats = Conversation.objects.filter(user=user, is_archived=archived)
+
+    position = decode_cursor(cursor) if cursor else None
+    if position:
+        timestamp, chat_id = position
+        after = "lt" if sort_option == "newest" else "gt"
+        chats = chats.filter(
+            Q(**{f"{field}__{after}": timestamp})
+            | Q(**{field: timestamp, f"chat_id__{after}": chat_id})
+        )
+
+    rows = list(chats.order_by(*conversation_ordering(sort_option))[:limit + 1])
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(getattr(rows[-1], field), rows[-1].chat_id)
+
+    return [history_group(chat, sort_option) for chat in rows], next_cursor
+
+
+def sort_param(request):
+    sort_option = request.GET.get("sort", "newest")
+    return sort_option if sort_option in ("newest", "oldest") else "newest"
+
+
+# ================================
+# HISTORY PAGE
+# ================================
+@login_required(login_url='login')
+def view_history(request):
 
-            history_groups.append({
-                "chat_id": msg.chat_id,
-                "start_time": msg.created_at,
-                "preview": msg.user_message[:60] if msg.user_message else "📷 Image",
-                "image_url": msg.uploaded_file.url if is_image else None,
-                "count": messages.filter(chat_id=msg.chat_id).count(),
-                "from_time": msg.created_at.isoformat(),
-            })
+    profile, _ = Profile.objects.get_or_create(user=request.user)
+    sort_option = sort_param(request)
 
-            chat_seen.add(msg.chat_id)
+    # First page only; script.js fetches the rest from history_page on scroll
+    history_groups, next_cursor = conversation_page(request.user, False, sort_option)
 
     return render(request, "root/history.html", {
         "history_groups": history_groups,
         "profile": profile,
         "sort_option": sort_option,
+        "next_cursor": next_cursor,
     })
 
 
@@ -64,6 +117,8 @@ def archive_chat(request, chat_id):
             user=request.user,
             chat_id=chat_id
         ).update(is_archived=True)
+        conversations.set_archived(request.user, chat_id, True)
+        recent.invalidate(request.user.pk, [chat_id])
 
         return JsonResponse({"status": "archived"})
 
@@ -80,6 +135,8 @@ def unarchive_chat(request, chat_id):
             user=request.user,
             chat_id=chat_id
         ).update(is_archived=False)
+        conversations.set_archived(request.user, chat_id, False)
+        recent.invalidate(request.user.pk, [chat_id])
 
         return JsonResponse({"status": "unarchived"})
 
@@ -96,33 +153,37 @@ def archived_history(request):
     profile, _ = Profile.objects.get_or_create(user=request.user)
 
     # ✅ Get sort from URL
-    sort_option = request.GET.get("sort", "newest")
-
-    # ✅ Apply ordering
-    ordering = "-created_at" if sort_option == "newest" else "created_at"
+    sort_option = sort_param(request)
 
-    messages = History.objects.filter(
-        user=request.user,
-        is_archived=True
-    ).order_by(ordering)
-
-    chat_seen = set()
-    history_groups = []
-
-    for msg in messages:
-        if msg.chat_id not in chat_seen:
-            history_groups.append({
-                "chat_id": msg.chat_id,
-                "start_time": msg.created_at,
-                "preview": msg.user_message[:60] if msg.user_message else "No message",
-                "from_time": msg.created_at.isoformat(),
-            })
-            chat_seen.add(msg.chat_id)
+    history_groups, next_cursor = conversation_page(request.user, True, sort_option)
 
     return render(request, "root/archive.html", {
         "history_groups": history_groups,
         "profile": profile,
         "sort_option": sort_option,   # ✅ VERY IMPORTANT
+        "next_cursor": next_cursor,
+    })
+
+
+# ================================
+# HISTORY PAGE API (INFINITE SCROLL)
+# ================================
+@login_required(login_url="login")
+def history_page(request):
+    archived = request.GET.get("archived") == "1"
+    sort_option = sort_param(request)
+
+    history_groups, next_cursor = conversation_page(
+        request.user, archived, sort_option, cursor=request.GET.get("cursor")
+    )
+
+    return JsonResponse({
+        "results": history_groups,
+        "html": render_to_string("root/history_rows.html", {
+            "history_groups": history_groups,
+            "archived": archived,
+        }, request=request),
+        "next_cursor": next_cursor,
     })
 
 
@@ -156,3 +217,25 @@ def delete_history(request, chat_id):
         return JsonResponse({"error": form.errors}, status=400)
 
     return JsonResponse({"error": "Invalid request"}, status=400)
+
+
+# ================================
+# SEARCH (JSON)
+# ================================
+@login_required(login_url="login")
+def history_search(request):
+    query = request.GET.get("q", "").strip()
+
+    try:
+        page = max(1, int(request.GET.get("page", 1)))
+    except ValueError:
+        page = 1
+
+    results, has_next = search.search(request.user, query, page=page)
+
+    return JsonResponse({
+        "query": query,
+        "page": page,
+        "results": results,
+        "next_page": page + 1 if has_next else None,
+    })
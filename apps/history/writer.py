@@ -0,0 +1,288 @@
+"""
+Background History writer
+
+The chat views hand finished turns to submit() instead of inserting them on
+the request path. A bounded queue feeds HISTORY_WRITER_WORKERS threads that
+bulk_create rows in micro-batches (up to HISTORY_WRITER_BATCH_SIZE, waiting
+at most HISTORY_WRITER_FLUSH_MS to fill one). The queue is drained at exit,
+including the exit SIGTERM triggers, so a deploy restart does not lose turns.
+
+Rows are only ever inserted with bulk_create, which does not send
+post_save, so the writer does what the History signal receiver would
+(Conversation summary, usage rollup, recent-turns cache) itself.
+"""
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+import atexit
+import logging
+import os
+import queue
+import signal
+import threading
+import time
+
+from apps.history.models import History
+from apps.history.conversations import record_message
+from apps.history import recent, usage
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class HistoryWriter:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._queue = None
+        self._threads = []
+        self._closed = False
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            "submitted": 0,
+            "written": 0,
+            "batches": 0,
+            "failed": 0,
+            "written_inline": 0,
+            "latency_ms_avg": 0.0,
+            "latency_ms_max": 0.0,
+        }
+
+    # =====================
+    # PRODUCER
+    # =====================
+    def submit(self, history):
+        """
+        Queue an unsaved History row (its file, if any, is stored now)
+        """
+        upload = history.uploaded_file
+        if upload and not upload._committed:
+            # The upload's temp file is gone once the request ends
+            upload.save(upload.name, upload.file, save=False)
+
+        self._count(submitted=1)
+
+        queued = False
+        if settings.HISTORY_WRITER_ENABLED:
+            with self._lock:
+                # Checked under the lock so nothing lands behind drain()'s stop marker
+                if not self._closed:
+                    self._start()
+                    try:
+                        self._queue.put_nowait((history, time.monotonic()))
+                        queued = True
+                    except queue.Full:
+                        # Backpressure: the request writes its own row, never drops it
+                        logger.warning("History writer queue full (%d); writing inline", self._queue.maxsize)
+
+        if not queued:
+            self._write_inline(history)
+
+    def _write_inline(self, history):
+        try:
+            History.objects.bulk_create([history])
+        except Exception:
+            self._drop(history)
+            return
+        self._after_write([(history, None)])
+        self._count(written_inline=1)
+
+    def _drop(self, history):
+        logger.exception("Dropping History row for chat %s", history.chat_id)
+        self._count(failed=1)
+        # Whatever is cached for the chat must not outlive the lost row
+        try:
+            recent.invalidate(history.user_id, [history.chat_id])
+        except Exception:
+            logger.exception("Could not invalidate recent turns for chat %s", history.chat_id)
+
+    # =====================
+    # WORKERS
+    # =====================
+    def _start(self):
+        # Called with self._lock held
+        if self._threads:
+            return
+
+        self._queue = queue.Queue(maxsize=settings.HISTORY_WRITER_QUEUE_SIZE)
+        for n in range(settings.HISTORY_WRITER_WORKERS):
+            thread = threading.Thread(target=self._run, name=f"history-writer-{n}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _run(self):
+        batch_size = settings.HISTORY_WRITER_BATCH_SIZE
+        window = settings.HISTORY_WRITER_FLUSH_MS / 1000
+
+        while True:
+            item = self._queue.get()
+            if item is _STOP:
+                self._queue.task_done()
+                return
+
+            batch = [item]
+            deadline = time.monotonic() + window
+            stop = False
+
+            while len(batch) < batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stop = True
+                    break
+                batch.append(item)
+
+            try:
+                self._flush(batch)
+            finally:
+                for _ in range(len(batch) + int(stop)):
+                    self._queue.task_done()
+
+            if stop:
+                return
+
+    def _flush(self, batch):
+        close_old_connections()
+
+        try:
+            with transaction.atomic():
+                History.objects.bulk_create([history for history, _ in batch])
+            written = batch
+        except Exception:
+            # One bad row must not take the batch with it
+            logger.exception("History batch insert failed; retrying rows one by one")
+            written = []
+            for entry in batch:
+                try:
+                    History.objects.bulk_create([entry[0]])
+                    written.append(entry)
+                except Exception:
+                    self._drop(entry[0])
+
+        self._after_write(written)
+        self._count(batches=1)
+
+    def _after_write(self, written):
+        # One commit for the whole batch; a savepoint per row isolates failures
+        with transaction.atomic():
+            for history, _ in written:
+                try:
+                    with transaction.atomic():
+                        record_message(history)
+                except Exception:
+                    logger.exception("Post-write update failed for chat %s", history.chat_id)
+
+            try:
+                with transaction.atomic():
+                    usage.record([history for history, _ in written])
+            except Exception:
+                logger.exception("Usage rollup update failed for %d rows", len(written))
+
+        # The only place a written row enters the recent-turns cache
+        for history, _ in written:
+            try:
+                recent.append(history)
+            except Exception:
+                logger.exception("Recent turns update failed for chat %s", history.chat_id)
+                recent.invalidate(history.user_id, [history.chat_id])
+
+        now = time.monotonic()
+        for _, queued_at in written:
+            if queued_at is not None:
+                self._observe((now - queued_at) * 1000)
+
+    # =====================
+    # SHUTDOWN
+    # =====================
+    def drain(self, timeout=None):
+        """
+        Flush everything queued and stop the workers; later submits write inline
+        """
+        timeout = settings.HISTORY_WRITER_DRAIN_SECONDS if timeout is None else timeout
+
+        with self._lock:
+            self._closed = True
+            threads, self._threads = self._threads, []
+
+        if not threads:
+            return True
+
+        pending = self._queue.qsize()
+        for _ in threads:
+            self._queue.put(_STOP)
+
+        deadline = time.monotonic() + timeout
+        for thread in threads:
+            thread.join(max(0, deadline - time.monotonic()))
+
+        drained = not any(thread.is_alive() for thread in threads)
+        log = logger.info if drained else logger.error
+        log("History writer drained %d queued rows (%s)", pending, "complete" if drained else "timed out")
+        return drained
+
+    def _reset_after_fork(self):
+        # Worker threads do not survive fork(); the child starts its own
+        self._lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._queue = None
+        self._threads = []
+
+    # =====================
+    # METRICS
+    # =====================
+    def _count(self, **values):
+        with self._stats_lock:
+            for key, value in values.items():
+                self._stats[key] += value
+
+    def _observe(self, latency_ms):
+        with self._stats_lock:
+            self._stats["written"] += 1
+            # EWMA of enqueue -> committed
+            self._stats["latency_ms_avg"] += 0.1 * (latency_ms - self._stats["latency_ms_avg"])
+            self._stats["latency_ms_max"] = max(self._stats["latency_ms_max"], latency_ms)
+
+    def stats(self):
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats["queue_depth"] = self._queue.qsize() if self._queue is not None else 0
+        stats["workers"] = len(self._threads)
+        return stats
+
+
+writer = HistoryWriter()
+
+submit = writer.submit
+drain = writer.drain
+stats = writer.stats
+
+atexit.register(drain)
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=writer._reset_after_fork)
+
+
+def install_sigterm_handler():
+    """
+    Make SIGTERM a normal exit, so the atexit drain() runs
+
+    The handler does not drain itself: it runs on the main thread, which may
+    be inside submit() holding the writer's lock. It hands over to the
+    previous handler (e.g. gunicorn's graceful stop) or raises SystemExit.
+    Must be called from the main thread.
+    """
+    previous = signal.getsignal(signal.SIGTERM)
+
+    def handle(signum, frame):
+        if callable(previous):
+            previous(signum, frame)
+        elif previous != signal.SIG_IGN:
+            raise SystemExit(128 + signum)
+
+    signal.signal(signal.SIGTERM, handle)
@@ -1,6 +1,49 @@
 from django.apps import AppConfig
+from django.conf import settings
+import os, sys, threading
+
+SERVER_COMMANDS = ("gunicorn", "uvicorn", "daphne", "hypercorn")
+
+
+def is_server_process():
+    """
+    True for web workers (gunicorn/uvicorn/... or runserver), False for
+    migrate, shell, tests and other short-lived management commands.
+    """
+    program = os.path.basename(sys.argv[0]) if sys.argv else ""
+    if any(name in program for name in SERVER_COMMANDS):
+        return True
+
+    # runserver: only the autoreloaded child actually serves requests
+    return "runserver" in sys.argv and os.environ.get("RUN_MAIN") == "true"
 
 
 class NewchatConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'apps.newchat'
+
+    def ready(self):
+        # ✅ System checks (shared cache for the quota)
+        from apps.newchat import checks  # noqa: F401
+
+        # ✅ Per-view DB query counting for /metrics
+        from chatbox import metrics
+        metrics.install()
+
+        if not is_server_process():
+            return
+
+        # ✅ Open the OpenRouter keep-alive connections (sync + worker loop) before the first message
+        if getattr(settings, "OPENROUTER_PREWARM", True):
+            from chatbox.openrouter_api import prewarm
+            threading.Thread(target=prewarm, daemon=True).start()
+
+        # ✅ Load the Presidio/spaCy engine now rather than on the first message
+        if getattr(settings, "GUARDRAIL_WARMUP", True):
+            from apps.newchat.guardrails import warm_up
+            threading.Thread(target=warm_up, daemon=True).start()
+
+        # ✅ Flush queued History rows when the worker is told to stop
+        if threading.current_thread() is threading.main_thread():
+            from apps.history.writer import install_sigterm_handler
+            install_sigterm_handler()
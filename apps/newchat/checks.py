@@ -0,0 +1,28 @@
+from django.conf import settings
+from django.core.checks import Warning, register
+
+# Backends that keep their data inside one process
+PER_PROCESS_CACHES = (
+    "django.core.cache.backends.locmem.LocMemCache",
+    "django.core.cache.backends.dummy.DummyCache",
+)
+
+
+@register()
+def quota_cache_check(app_configs, **kwargs):
+    """
+    The message quota (apps/newchat/quota.py) is only per user with a shared cache
+    """
+    backend = settings.CACHES.get("default", {}).get("BACKEND", "")
+    if settings.DEBUG or backend not in PER_PROCESS_CACHES:
+        return []
+
+    return [
+        Warning(
+            "The default cache is per process, so every worker counts the chat "
+            "quota (and idempotency keys, stream buffers) on its own.",
+            hint="Set CACHE_URL to a shared backend, e.g. redis://host:6379/0.",
+            obj="CACHES",
+            id="newchat.W001",
+        )
+    ]
@@ -1,5 +1,6 @@
 from django import forms
 from apps.history.models import History
+from apps.history import writer as history_writer
 
 
 class ChatbotMessageForm(forms.Form):
@@ -11,7 +12,7 @@ class ChatbotMessageForm(forms.Form):
         self.conversation = conversation
         super().__init__(*args, **kwargs)
 
-    def save(self, bot_engine, uploaded_file=None, image_base64=None):
+    def save(self, bot_engine, uploaded_file=None, image_base64=None, stream=None, on_token=None):
 
         user_message = self.cleaned_data.get("message", "")
 
@@ -21,18 +22,22 @@ class ChatbotMessageForm(forms.Form):
         ai_message = bot_engine.get_response(
             user_input=user_message,
             conversation_history=self.conversation,
-            image_base64=image_base64
+            image_base64=image_base64,
+            stream=stream,
+            on_token=on_token
         )
 
         # =====================
         # SAVE TO DB (WITH FILE)
         # =====================
-        History.objects.create(
+        # ✅ Batched by the background writer (file is stored right away)
+        history_writer.submit(History(
             user=self.user,
             chat_id=self.chat_id,
             user_message=user_message,
             ai_message=ai_message,
-            uploaded_file=uploaded_file   # ✅ THIS IS THE KEY LINE
-        )
+            uploaded_file=uploaded_file,   # ✅ THIS IS THE KEY LINE
+            **bot_engine.usage
+        ))
 
         return ai_message
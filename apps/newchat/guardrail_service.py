@@ -0,0 +1,201 @@
+"""
+Out-of-process guardrail sidecar
+
+One process (``manage.py guardrail_server``) loads the Presidio/spaCy engine
+once and answers PII checks for every web worker over a Unix socket, so the
+workers themselves never hold the NLP pipeline in memory.
+
+Protocol: newline-delimited JSON, one request and one reply per line.
+
+    {"text": "..."}  ->  {"pii": true}
+    {"ping": true}   ->  {"ok": true}
+
+Concurrent requests are micro-batched (GUARDRAIL_BATCH_SIZE /
+GUARDRAIL_BATCH_WINDOW_MS) and run through spaCy's ``nlp.pipe``.
+"""
+
+from django.conf import settings
+import asyncio
+import json
+import logging
+import os
+import socket
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def socket_path():
+    return getattr(settings, "GUARDRAIL_SOCKET", None)
+
+
+# =====================
+# CLIENT (WEB WORKERS)
+# =====================
+class SidecarUnavailable(Exception):
+    pass
+
+
+_local = threading.local()
+_down_until = 0.0
+
+
+def _connection():
+    conn = getattr(_local, "conn", None)
+
+    if conn is None:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(getattr(settings, "GUARDRAIL_SOCKET_TIMEOUT", 2.0))
+        sock.connect(socket_path())
+        conn = _local.conn = (sock, sock.makefile("rb"))
+    return conn
+
+
+def _drop_connection():
+    conn = getattr(_local, "conn", None)
+    _local.conn = None
+
+    if conn is not None:
+        for part in reversed(conn):
+            try:
+                part.close()
+            except OSError:
+                pass
+
+
+def _call(payload):
+    global _down_until
+
+    if not socket_path() or time.monotonic() < _down_until:
+        raise SidecarUnavailable()
+
+    try:
+        sock, reader = _connection()
+        sock.sendall(json.dumps(payload).encode("utf-8") + b"\n")
+        line = reader.readline()
+        if not line:
+            raise ConnectionError("guardrail sidecar closed the connection")
+
+        reply = json.loads(line)
+        if "error" in reply:
+            raise RuntimeError(reply["error"])
+        return reply
+
+    except Exception as e:
+        _drop_connection()
+        # Don't retry a dead sidecar on every message
+        _down_until = time.monotonic() + getattr(settings, "GUARDRAIL_SIDECAR_RETRY_SECONDS", 10)
+        logger.warning("Guardrail sidecar unavailable, using in-process engine: %s", e)
+        raise SidecarUnavailable() from e
+
+
+def remote_contains_pii(text):
+    """
+    PII verdict from the sidecar; raises SidecarUnavailable for fallback
+    """
+    return bool(_call({"text": text})["pii"])
+
+
+def sidecar_available():
+    try:
+        return bool(_call({"ping": True}).get("ok"))
+    except SidecarUnavailable:
+        return False
+
+
+# =====================
+# SERVER (SIDECAR PROCESS)
+# =====================
+class GuardrailServer:
+
+    def __init__(self, path, batch_size=32, batch_window=0.005):
+        self.path = path
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self.queue = None
+
+    async def handle(self, reader, writer):
+        loop = asyncio.get_running_loop()
+
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+
+                try:
+                    request = json.loads(line)
+                    if request.get("ping"):
+                        reply = {"ok": True}
+                    else:
+                        future = loop.create_future()
+                        await self.queue.put((request["text"], future))
+                        reply = {"pii": await future}
+                except Exception as e:
+                    logger.exception("Guardrail sidecar request failed")
+                    reply = {"error": str(e)}
+
+                writer.write(json.dumps(reply).encode("utf-8") + b"\n")
+                await writer.drain()
+        finally:
+            writer.close()
+
+    async def next_batch(self):
+        loop = asyncio.get_running_loop()
+        batch = [await self.queue.get()]
+        deadline = loop.time() + self.batch_window
+
+        while len(batch) < self.batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def batcher(self):
+        from apps.newchat import guardrails
+
+        loop = asyncio.get_running_loop()
+
+        while True:
+            batch = await self.next_batch()
+            texts = [text for text, _ in batch]
+
+            try:
+                verdicts = await loop.run_in_executor(None, guardrails.detect_pii_batch, texts)
+            except Exception as e:
+                logger.exception("Guardrail batch failed")
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            for (_, future), pii in zip(batch, verdicts):
+                if not future.done():
+                    future.set_result(pii)
+
+    async def serve(self):
+        from apps.newchat import guardrails
+
+        # Load the engine before accepting connections
+        guardrails.get_analyzer()
+
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+        self.queue = asyncio.Queue()
+        server = await asyncio.start_unix_server(self.handle, path=self.path)
+        batcher = asyncio.create_task(self.batcher())
+        logger.info("Guardrail sidecar listening on %s", self.path)
+
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher.cancel()
+            if os.path.exists(self.path):
+                os.unlink(self.path)
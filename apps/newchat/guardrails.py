@@ -1,6 +1,17 @@
-from presidio_analyzer import AnalyzerEngine
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+import asyncio
+import hashlib
+import logging
+import re
+import threading
+import time
 
-analyzer = AnalyzerEngine()
+from chatbox import metrics
+from . import guardrail_service, toxic
+
+logger = logging.getLogger(__name__)
 
 # Only detect serious personal info
 ALLOWED_ENTITIES = [
@@ -11,23 +22,207 @@ ALLOWED_ENTITIES = [
     "US_SSN"
 ]
 
+# Built-in fallback; the live lexicon is data/toxic_terms.txt (or
+# settings.GUARDRAIL_TOXIC_LEXICON), see toxic.py
 TOXIC_WORDS = [
     "kill", "bomb", "hack", "suicide", "murder",
     "kidnap", "rape", "terrorist"
 ]
 
-def check_guardrails(text):
-    if not text.strip():
+
+# =====================
+# LAZY NLP ENGINE
+# =====================
+# Presidio pulls in spaCy and its model; build it on first use (or from
+# warm_up() in server processes) so migrate/shell/tests never pay for it.
+_analyzer = None
+_analyzer_lock = threading.Lock()
+ENGINE_LOAD_SECONDS = None
+
+
+def get_analyzer():
+    global _analyzer, ENGINE_LOAD_SECONDS
+
+    if _analyzer is None:
+        with _analyzer_lock:
+            if _analyzer is None:
+                start = time.perf_counter()
+                from presidio_analyzer import AnalyzerEngine
+
+                _analyzer = AnalyzerEngine()
+                ENGINE_LOAD_SECONDS = time.perf_counter() - start
+                logger.info("Guardrail engine loaded in %.2fs", ENGINE_LOAD_SECONDS)
+    return _analyzer
+
+
+def engine_loaded():
+    return _analyzer is not None
+
+
+def warm_up():
+    """
+    Build the engine and lexicon ahead of the first request
+    """
+    toxic.get_matcher(TOXIC_WORDS)
+
+    # With a live sidecar this worker never needs its own engine
+    if guardrail_service.socket_path() and guardrail_service.sidecar_available():
+        return
+
+    get_analyzer()
+
+
+# =====================
+# FAST-PATH PREFILTER
+# =====================
+# Every entity in ALLOWED_ENTITIES needs either an "@" (email) or a run of
+# digits (phone, card, IBAN, SSN). Text with neither cannot match, so the
+# spaCy/Presidio pass is skipped for it.
+MIN_PII_DIGITS = 5
+
+_EMAIL_HINT = re.compile(r"@")
+_DIGIT = re.compile(r"\d")
+
+
+def _may_contain_pii(text):
+    if _EMAIL_HINT.search(text):
         return True
+    return len(_DIGIT.findall(text)) >= MIN_PII_DIGITS
+
 
-    # Only check selected PII types
-    results = analyzer.analyze(
+def _contains_toxic(text):
+    return toxic.get_matcher(TOXIC_WORDS).search(text) is not None
+
+
+def _contains_pii(text):
+    # Shared sidecar first (keeps spaCy out of this worker), then in-process
+    if guardrail_service.socket_path():
+        try:
+            return guardrail_service.remote_contains_pii(text)
+        except guardrail_service.SidecarUnavailable:
+            pass
+
+    results = get_analyzer().analyze(
         text=text,
         language="en",
         entities=ALLOWED_ENTITIES
     )
+    return len(results) > 0
+
+
+def detect_pii_batch(texts):
+    """
+    PII flags for many texts in one spaCy nlp.pipe pass (used by the sidecar)
+    """
+    from presidio_analyzer import BatchAnalyzerEngine
+
+    batch_engine = BatchAnalyzerEngine(analyzer_engine=get_analyzer())
+    results = batch_engine.analyze_iterator(
+        texts,
+        language="en",
+        entities=ALLOWED_ENTITIES,
+        batch_size=len(texts)
+    )
+    return [len(found) > 0 for found in results]
+
+
+def evaluate(text, prefilter=True):
+    """
+    Uncached verdict: True if the text is allowed
+    """
+    if not text.strip():
+        return True
+
+    if _contains_toxic(text):
+        return False
+
+    if prefilter and not _may_contain_pii(text):
+        return True
+
+    return not _contains_pii(text)
+
+
+# =====================
+# VERDICT CACHE (LRU)
+# =====================
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def _cache_key(text):
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+
+
+def clear_cache():
+    with _cache_lock:
+        _cache.clear()
+
+
+# Cached verdicts are stale once the lexicon changes
+toxic.on_reload(clear_cache)
+
+
+def check_guardrails(text):
+    if not text.strip():
+        return True
+
+    started = time.perf_counter()
+
+    # Picks up lexicon edits (and clears stale verdicts) before the lookup
+    toxic.get_matcher(TOXIC_WORDS)
+
+    key = _cache_key(text)
+
+    with _cache_lock:
+        allowed = _cache.get(key)
+        if allowed is not None:
+            _cache.move_to_end(key)
+
+    if allowed is not None:
+        metrics.GUARDRAIL_SECONDS.observe(time.perf_counter() - started, cached="true")
+        return allowed
+
+    allowed = evaluate(text)
+    metrics.GUARDRAIL_SECONDS.observe(time.perf_counter() - started, cached="false")
+
+    with _cache_lock:
+        _cache[key] = allowed
+        _cache.move_to_end(key)
+        while len(_cache) > getattr(settings, "GUARDRAIL_CACHE_SIZE", 4096):
+            _cache.popitem(last=False)
+
+    return allowed
+
+
+# =====================
+# WORKER POOL (SPECULATIVE MODE)
+# =====================
+# The views submit the check here. With GUARDRAIL_SPECULATIVE on they open
+# the upstream LLM request while it runs, so NER latency overlaps with
+# time-to-first-token, at the cost of sending the text before the verdict.
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _pool():
+    global _executor
+
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=getattr(settings, "GUARDRAIL_WORKERS", 4),
+                    thread_name_prefix="guardrails"
+                )
+    return _executor
+
+
+def submit_check(text):
+    """
+    Start check_guardrails in the worker pool; returns a Future
+    """
+    return _pool().submit(check_guardrails, text)
 
-    pii_found = len(results) > 0
-    toxic_found = any(word in text.lower() for word in TOXIC_WORDS)
 
-    return not (pii_found or toxic_found)
+async def acheck_guardrails(text):
+    return await asyncio.wrap_future(submit_check(text))
@@ -0,0 +1,262 @@
+"""
+Idempotency keys and in-flight coalescing for chat submissions
+
+The client sends an Idempotency-Key header with each message (reused on
+retries). The first request with a key claims it in the cache and generates
+the reply (the leader). A duplicate that arrives while the leader is still
+running is coalesced onto it (singleflight): in the same process it follows
+the leader's tokens live, elsewhere it waits for the stored result. A
+duplicate that arrives later, within IDEMPOTENCY_TTL, gets the stored reply
+replayed. Either way there is one upstream generation, one History row and
+one quota charge per key.
+
+Only a complete reply is stored; a leader that errors or loses its client
+frees the key so a retry generates again. The pending claim is refreshed as
+tokens arrive, so it outlives IDEMPOTENCY_PENDING_SECONDS on a long stream.
+A follower that cannot tail the leader live waits at most
+IDEMPOTENCY_WAIT_SECONDS and is then told to retry (409); one that tails it
+gives up after IDEMPOTENCY_WAIT_SECONDS without a new token (LeaderLost).
+"""
+
+from django.conf import settings
+from django.core.cache import cache
+import asyncio
+import hashlib
+import threading
+import time
+
+MAX_KEY_LENGTH = 128
+POLL_SECONDS = 0.1
+
+# Ticket roles
+NONE = "none"
+LEADER = "leader"
+FOLLOWER = "follower"
+REPLAY = "replay"
+CONFLICT = "conflict"
+INVALID = "invalid"
+
+
+class LeaderLost(Exception):
+    """
+    The leader being tailed failed or stopped sending tokens
+    """
+
+
+def fingerprint(*parts):
+    raw = "\x1f".join(str(part) for part in parts).encode("utf-8")
+    return hashlib.blake2b(raw, digest_size=16).hexdigest()
+
+
+# =====================
+# IN-PROCESS FLIGHTS
+# =====================
+class Flight:
+    """
+    A generation in progress in this process, for followers to tail
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.reply = None
+        self.failed = False
+        self.done = threading.Event()
+
+    def publish(self, token):
+        self.chunks.append(token)
+
+    def wait(self, timeout):
+        self.done.wait(timeout)
+        return self.reply if self.done.is_set() and not self.failed else None
+
+    async def follow(self, timeout=None):
+        """
+        Leader's tokens so far, then new ones as they arrive
+
+        Raises LeaderLost if the leader fails or sends nothing for timeout
+        seconds (IDEMPOTENCY_WAIT_SECONDS).
+        """
+        timeout = settings.IDEMPOTENCY_WAIT_SECONDS if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        sent = 0
+        while True:
+            finished = self.done.is_set()
+            if sent < len(self.chunks):
+                deadline = time.monotonic() + timeout
+            while sent < len(self.chunks):
+                yield self.chunks[sent]
+                sent += 1
+            if finished:
+                if self.failed:
+                    raise LeaderLost("The original request failed, please retry.")
+                return
+            if time.monotonic() >= deadline:
+                raise LeaderLost("The original request has not completed, please retry.")
+            await asyncio.sleep(0.02)
+
+
+_flights = {}
+_flights_lock = threading.Lock()
+
+
+# =====================
+# TICKET
+# =====================
+class Ticket:
+
+    def __init__(self, role, key=None, fp=None, reply=None, flight=None):
+        self.role = role
+        self.key = key
+        self.fp = fp
+        self.reply = reply
+        self.flight = flight
+        self._settled = False
+        self._handed_off = False
+        self._claimed_at = time.monotonic()
+
+    # ----- leader -----
+    def publish(self, token):
+        if self.flight is not None:
+            self.flight.publish(token)
+        if self.role == LEADER:
+            self._keep_claim()
+
+    def _keep_claim(self):
+        # Refresh the pending claim well before it expires mid-generation
+        pending = settings.IDEMPOTENCY_PENDING_SECONDS
+        if time.monotonic() - self._claimed_at < pending / 3:
+            return
+        self._claimed_at = time.monotonic()
+        cache.touch(self.key, pending)
+
+    def finish(self, reply):
+        """
+        Store a complete, successful reply for replays
+        """
+        if self.role != LEADER or self._settled:
+            return
+        self._settled = True
+
+        cache.set(self.key, {"state": "done", "fp": self.fp, "reply": reply}, settings.IDEMPOTENCY_TTL)
+        self._land(reply, failed=False)
+
+    def abort(self):
+        """
+        Leader did not produce a reply (blocked, quota, error): free the key
+
+        No-op once the ticket was handed off to a streaming generator.
+        """
+        if self._handed_off:
+            return
+        self.fail()
+
+    def fail(self):
+        """
+        Free the key: the reply is missing, partial or an error
+        """
+        if self.role != LEADER or self._settled:
+            return
+        self._settled = True
+
+        cache.delete(self.key)
+        self._land(None, failed=True)
+
+    def hand_off(self):
+        """
+        The streaming generator settles the ticket (finish / fail), not the view
+        """
+        self._handed_off = True
+
+    def _land(self, reply, failed):
+        flight = self.flight
+        flight.reply = reply
+        flight.failed = failed
+        if reply and not flight.chunks:
+            # Non-streaming leader: tailing followers get the whole reply at once
+            flight.publish(reply)
+        with _flights_lock:
+            if _flights.get(self.key) is flight:
+                del _flights[self.key]
+        flight.done.set()
+
+    # ----- follower -----
+    def wait(self, timeout=None):
+        """
+        Leader's reply, or None if it failed / did not finish in time
+        """
+        timeout = settings.IDEMPOTENCY_WAIT_SECONDS if timeout is None else timeout
+        if self.flight is not None:
+            return self.flight.wait(timeout)
+
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            result = _poll(self.key, self.fp)
+            if result is not _PENDING:
+                return result
+            time.sleep(POLL_SECONDS)
+        return None
+
+    async def await_reply(self, timeout=None):
+        timeout = settings.IDEMPOTENCY_WAIT_SECONDS if timeout is None else timeout
+        if self.flight is not None:
+            return await asyncio.to_thread(self.flight.wait, timeout)
+
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            record = await cache.aget(self.key)
+            result = _result(record, self.fp)
+            if result is not _PENDING:
+                return result
+            await asyncio.sleep(POLL_SECONDS)
+        return None
+
+
+_PENDING = object()
+
+
+def _result(record, fp):
+    if record is None or record.get("fp") != fp:
+        return None
+    if record["state"] == "done":
+        return record["reply"]
+    return _PENDING
+
+
+def _poll(key, fp):
+    return _result(cache.get(key), fp)
+
+
+def begin(user_id, raw_key, fp):
+    """
+    Claim or join the submission identified by (user, Idempotency-Key)
+    """
+    if not raw_key:
+        return Ticket(NONE)
+    if len(raw_key) > MAX_KEY_LENGTH:
+        return Ticket(INVALID)
+
+    key = f"idempotency:{user_id}:{raw_key}"
+
+    for _ in range(2):
+        if cache.add(key, {"state": "pending", "fp": fp}, settings.IDEMPOTENCY_PENDING_SECONDS):
+            flight = Flight()
+            with _flights_lock:
+                _flights[key] = flight
+            return Ticket(LEADER, key, fp, flight=flight)
+
+        record = cache.get(key)
+        if record is not None:
+            break
+        # Leader gave up between our add() and get(): try to claim it again
+    else:
+        return Ticket(CONFLICT)
+
+    with _flights_lock:
+        flight = _flights.get(key)
+
+    if record.get("fp") != fp:
+        # Same key, different request
+        return Ticket(CONFLICT)
+    if record["state"] == "done":
+        return Ticket(REPLAY, key, fp, reply=record["reply"])
+    return Ticket(FOLLOWER, key, fp, flight=flight)
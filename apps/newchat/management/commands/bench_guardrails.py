@@ -0,0 +1,64 @@
+from django.core.management.base import BaseCommand
+import random
+import time
+
+from apps.newchat import guardrails
+
+
+SAMPLE_MESSAGES = [
+    "hello, how do I reset my password",
+    "my laptop won't connect to the office wifi",
+    "can you explain what a django migration is?",
+    "the invoice page shows a blank screen after login",
+    "please describe this image",
+    "thanks, that fixed it!",
+    "call me on 9876543210 tomorrow",
+    "my email is someone@example.com",
+    "card 4111 1111 1111 1111 was declined",
+    "order #12 shipped on the 3rd",
+]
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+class Command(BaseCommand):
+    help = "Micro-benchmark check_guardrails: p50/p99 latency before and after the fast path"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--iterations", type=int, default=2000)
+        parser.add_argument("--seed", type=int, default=42)
+
+    def run(self, fn, messages):
+        timings = []
+        for text in messages:
+            start = time.perf_counter()
+            fn(text)
+            timings.append((time.perf_counter() - start) * 1000)
+        return timings
+
+    def report(self, label, timings):
+        self.stdout.write(
+            f"{label:<28} p50={percentile(timings, 50):8.3f} ms  "
+            f"p99={percentile(timings, 99):8.3f} ms  "
+            f"total={sum(timings):9.1f} ms"
+        )
+
+    def handle(self, *args, **options):
+        rng = random.Random(options["seed"])
+        messages = [rng.choice(SAMPLE_MESSAGES) for _ in range(options["iterations"])]
+
+        # Warm the NLP pipeline so the first call doesn't skew "before"
+        guardrails.evaluate(SAMPLE_MESSAGES[0], prefilter=False)
+
+        before = self.run(lambda text: guardrails.evaluate(text, prefilter=False), messages)
+
+        guardrails.clear_cache()
+        after = self.run(guardrails.check_guardrails, messages)
+
+        self.stdout.write(f"{len(messages)} messages, {len(SAMPLE_MESSAGES)} distinct")
+        self.report("before (full NLP pass)", before)
+        self.report("after (prefilter + cache)", after)
@@ -0,0 +1,58 @@
+from django.core.management.base import BaseCommand
+import random
+import string
+import time
+
+from apps.newchat.toxic import ToxicMatcher
+
+from .bench_guardrails import SAMPLE_MESSAGES, percentile
+
+
+def synthetic_lexicon(size, rng):
+    terms = []
+    for i in range(size):
+        word = "".join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(5, 10)))
+        # roughly one in five entries is a two-word phrase
+        if i % 5 == 0:
+            word += " " + "".join(rng.choice(string.ascii_lowercase) for _ in range(6))
+        terms.append(word)
+    return terms
+
+
+class Command(BaseCommand):
+    help = "Benchmark the toxic-term matcher against the old substring scan for growing lexicons"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sizes", default="10,100,1000,10000")
+        parser.add_argument("--iterations", type=int, default=2000)
+        parser.add_argument("--seed", type=int, default=42)
+
+    def time_calls(self, fn, messages):
+        timings = []
+        for text in messages:
+            start = time.perf_counter()
+            fn(text)
+            timings.append((time.perf_counter() - start) * 1_000_000)
+        return timings
+
+    def handle(self, *args, **options):
+        rng = random.Random(options["seed"])
+        messages = [rng.choice(SAMPLE_MESSAGES) for _ in range(options["iterations"])]
+
+        self.stdout.write(f"{'terms':>7}  {'scan p50':>10}  {'scan p99':>10}  {'match p50':>10}  {'match p99':>10}  (us)")
+
+        for size in [int(s) for s in options["sizes"].split(",")]:
+            terms = synthetic_lexicon(size, rng)
+            matcher = ToxicMatcher(terms)
+
+            def linear_scan(text):
+                lowered = text.lower()
+                return any(term in lowered for term in terms)
+
+            scan = self.time_calls(linear_scan, messages)
+            match = self.time_calls(matcher.search, messages)
+
+            self.stdout.write(
+                f"{size:>7}  {percentile(scan, 50):>10.2f}  {percentile(scan, 99):>10.2f}  "
+                f"{percentile(match, 50):>10.2f}  {percentile(match, 99):>10.2f}"
+            )
@@ -0,0 +1,69 @@
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand, CommandError
+import os
+
+from chatbox.storage import ContentAddressedStorage, path_digest
+
+MEDIA_DIRS = ("chat_uploads", "profile_images")
+
+
+class Command(BaseCommand):
+    help = "Link existing uploads to content-addressed blobs (one copy per unique file) and drop unreferenced blobs"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--dir", action="append", dest="dirs", help="Media subdirectory (repeatable)")
+        parser.add_argument("--dry-run", action="store_true")
+
+    def handle(self, *args, **options):
+        if not isinstance(default_storage, ContentAddressedStorage):
+            raise CommandError("STORAGES['default'] is not chatbox.storage.ContentAddressedStorage")
+
+        dry_run = options["dry_run"]
+        files = linked = reclaimed = 0
+        seen = set()
+
+        for directory in options["dirs"] or MEDIA_DIRS:
+            root = default_storage.path(directory)
+
+            for dirpath, _, filenames in os.walk(root):
+                for filename in filenames:
+                    path = os.path.join(dirpath, filename)
+                    if os.path.islink(path) or os.stat(path).st_nlink > 1:
+                        continue
+
+                    files += 1
+                    digest, size = path_digest(path)
+                    blob = default_storage.blob_path(digest)
+
+                    if digest not in seen and not os.path.exists(blob):
+                        # First copy becomes the blob (a link, no data written)
+                        seen.add(digest)
+                        if not dry_run:
+                            os.makedirs(os.path.dirname(blob), exist_ok=True)
+                            os.link(path, blob)
+                        continue
+
+                    # Duplicate: swap the file for a link to the blob
+                    linked += 1
+                    reclaimed += size
+                    if not dry_run:
+                        tmp_path = f"{path}.dedupe-tmp"
+                        os.link(blob, tmp_path)
+                        os.replace(tmp_path, path)
+
+        orphans = 0
+        for dirpath, _, filenames in os.walk(default_storage.blob_root):
+            for filename in filenames:
+                blob = os.path.join(dirpath, filename)
+                if os.stat(blob).st_nlink == 1:
+                    orphans += 1
+                    if not dry_run:
+                        os.remove(blob)
+
+        prefix = "[dry run] " if dry_run else ""
+        self.stdout.write(
+            f"{prefix}scanned {files} files under {settings.MEDIA_ROOT}: "
+            f"{linked} duplicates linked, {reclaimed / 1024:.1f} KiB reclaimed, "
+            f"{orphans} unreferenced blobs removed"
+        )
@@ -0,0 +1,215 @@
+from django.core.management.base import BaseCommand, CommandError
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import random
+import threading
+import time
+import uuid
+
+WORDS = (
+    "the request was processed and your account settings have been updated "
+    "please check the dashboard for details or contact support if needed"
+).split()
+
+
+class Stub:
+    """
+    Reply timing, error injection and counters shared by the handler threads
+    """
+
+    def __init__(self, options):
+        self.ttft = options["ttft_ms"] / 1000
+        self.jitter = options["jitter_ms"] / 1000
+        self.token_delay = 1 / options["tokens_per_second"]
+        self.reply_tokens = options["reply_tokens"]
+        self.error_rate = options["error_rate"]
+        self.midstream_error_rate = options["midstream_error_rate"]
+        self.model_ttft = {}
+        for spec in options["model_ttft"] or []:
+            model, _, ms = spec.rpartition("=")
+            if not model:
+                raise CommandError(f"--model-ttft expects MODEL=MS, got {spec!r}")
+            self.model_ttft[model] = int(ms) / 1000
+
+        self.lock = threading.Lock()
+        self.stats = {"requests": 0, "in_flight": 0, "peak_in_flight": 0, "errors": 0, "aborted": 0}
+
+    def first_token_delay(self, model):
+        base = self.model_ttft.get(model, self.ttft)
+        return max(0.0, base + random.uniform(-self.jitter, self.jitter))
+
+    def count(self, **values):
+        with self.lock:
+            for key, value in values.items():
+                self.stats[key] += value
+            self.stats["peak_in_flight"] = max(self.stats["peak_in_flight"], self.stats["in_flight"])
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.stats)
+
+
+def chunk(completion_id, model, content=None, finish_reason=None, usage=None):
+    delta = {"role": "assistant", "content": content} if content is not None else {}
+    body = {
+        "id": completion_id,
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    }
+    if usage is not None:
+        body["usage"] = usage
+    return body
+
+
+def make_handler(stub):
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def send_json(self, status, payload):
+            body = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def write_chunk(self, data):
+            self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+            self.wfile.flush()
+
+        def do_HEAD(self):
+            # prewarm() opens its connection with a HEAD
+            self.send_response(200)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def do_GET(self):
+            if self.path.rstrip("/").endswith("/stats"):
+                return self.send_json(200, stub.snapshot())
+            self.send_json(404, {"error": {"message": "Not found"}})
+
+        def do_POST(self):
+            if not self.path.rstrip("/").endswith("/chat/completions"):
+                return self.send_json(404, {"error": {"message": "Not found"}})
+
+            length = int(self.headers.get("Content-Length") or 0)
+            request = json.loads(self.rfile.read(length) or b"{}")
+            model = request.get("model", "stub")
+            max_tokens = min(request.get("max_tokens") or stub.reply_tokens, stub.reply_tokens)
+
+            stub.count(requests=1, in_flight=1)
+            try:
+                if random.random() < stub.error_rate:
+                    stub.count(errors=1)
+                    time.sleep(stub.first_token_delay(model) / 2)
+                    return self.send_json(502, {"error": {"message": "Injected upstream error", "code": 502}})
+
+                tokens = [random.choice(WORDS) + " " for _ in range(max_tokens)]
+                usage = {
+                    "prompt_tokens": sum(len(str(m.get("content", ""))) for m in request.get("messages", [])) // 4,
+                    "completion_tokens": len(tokens),
+                }
+                usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+
+                time.sleep(stub.first_token_delay(model))
+
+                if not request.get("stream"):
+                    return self.send_json(200, {
+                        "id": f"chatcmpl-{uuid.uuid4().hex}",
+                        "object": "chat.completion",
+                        "created": int(time.time()),
+                        "model": model,
+                        "choices": [{
+                            "index": 0,
+                            "message": {"role": "assistant", "content": "".join(tokens)},
+                            "finish_reason": "stop",
+                        }],
+                        "usage": usage,
+                    })
+
+                self.stream(request, model, tokens, usage)
+
+            except (BrokenPipeError, ConnectionResetError):
+                stub.count(aborted=1)
+            finally:
+                stub.count(in_flight=-1)
+
+        def stream(self, request, model, tokens, usage):
+            completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+            cut_at = len(tokens) // 2 if random.random() < stub.midstream_error_rate else None
+
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Cache-Control", "no-cache")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+
+            for n, token in enumerate(tokens):
+                if n == cut_at:
+                    # Drop the connection mid-reply
+                    stub.count(errors=1)
+                    self.close_connection = True
+                    return
+                if n:
+                    time.sleep(stub.token_delay)
+                self.write_chunk(f"data: {json.dumps(chunk(completion_id, model, token))}\n\n".encode())
+
+            include_usage = (request.get("stream_options") or {}).get("include_usage")
+            self.write_chunk(f"data: {json.dumps(chunk(completion_id, model, finish_reason='stop'))}\n\n".encode())
+            if include_usage:
+                final = chunk(completion_id, model, usage=usage)
+                final["choices"] = []
+                self.write_chunk(f"data: {json.dumps(final)}\n\n".encode())
+            self.write_chunk(b"data: [DONE]\n\n")
+            self.write_chunk(b"")
+
+    return Handler
+
+
+class Command(BaseCommand):
+    help = (
+        "Local stand-in for OpenRouter's OpenAI-compatible /chat/completions "
+        "(streaming and not) for load tests; run the app with "
+        "OPENROUTER_BASE_URL=http://HOST:PORT/v1"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--host", default="127.0.0.1")
+        parser.add_argument("--port", type=int, default=9100)
+        parser.add_argument("--ttft-ms", type=int, default=400, help="Delay before the first token")
+        parser.add_argument("--jitter-ms", type=int, default=100, help="+/- random spread on the first-token delay")
+        parser.add_argument("--tokens-per-second", type=float, default=50.0)
+        parser.add_argument("--reply-tokens", type=int, default=120, help="Upper bound on tokens per reply")
+        parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests answered with a 502")
+        parser.add_argument("--midstream-error-rate", type=float, default=0.0,
+                            help="Fraction of streams cut off halfway")
+        parser.add_argument("--model-ttft", action="append", metavar="MODEL=MS",
+                            help="Per-model first-token delay (repeatable), e.g. to exercise routing")
+
+    def handle(self, *args, **options):
+        if options["tokens_per_second"] <= 0:
+            raise CommandError("--tokens-per-second must be positive")
+
+        stub = Stub(options)
+        server = ThreadingHTTPServer((options["host"], options["port"]), make_handler(stub))
+        server.daemon_threads = True
+        server.request_queue_size = 1024
+
+        self.stdout.write(
+            f"Fake OpenRouter on http://{options['host']}:{options['port']}/v1 "
+            f"(ttft {options['ttft_ms']}ms, {options['tokens_per_second']:g} tok/s, "
+            f"errors {options['error_rate']:.0%}, mid-stream {options['midstream_error_rate']:.0%})"
+        )
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            self.stdout.write(json.dumps(stub.snapshot()))
@@ -0,0 +1,30 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+import asyncio
+
+from apps.newchat.guardrail_service import GuardrailServer
+
+
+class Command(BaseCommand):
+    help = "Run the shared guardrail sidecar on a Unix socket (one spaCy pipeline for all workers)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--socket", default=settings.GUARDRAIL_SOCKET)
+        parser.add_argument("--batch-size", type=int, default=settings.GUARDRAIL_BATCH_SIZE)
+        parser.add_argument("--batch-window-ms", type=int, default=settings.GUARDRAIL_BATCH_WINDOW_MS)
+
+    def handle(self, *args, **options):
+        if not options["socket"]:
+            raise CommandError("Set GUARDRAIL_SOCKET or pass --socket")
+
+        server = GuardrailServer(
+            options["socket"],
+            batch_size=options["batch_size"],
+            batch_window=options["batch_window_ms"] / 1000,
+        )
+
+        self.stdout.write(f"Guardrail sidecar on {options['socket']}")
+        try:
+            asyncio.run(server.serve())
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,304 @@
+"""
+Load test against a running server, e.g. to compare deployments per release:
+
+    manage.py fake_openrouter --ttft-ms 400 --tokens-per-second 50
+    OPENROUTER_BASE_URL=http://127.0.0.1:9100/v1 gunicorn chatbox.wsgi -w 4                        # WSGI sync
+    OPENROUTER_BASE_URL=http://127.0.0.1:9100/v1 gunicorn chatbox.wsgi -w 4 -k gthread --threads 8  # gthread
+    OPENROUTER_BASE_URL=http://127.0.0.1:9100/v1 gunicorn chatbox.asgi -w 4 -k uvicorn.workers.UvicornWorker  # ASGI
+    manage.py loadtest --users 50 --requests 10 --stub-url http://127.0.0.1:9100/v1
+
+Users, sessions and the CSRF cookie are created directly in the database the
+server uses, so the login flow is not part of the measurement.
+"""
+
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY, get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.crypto import get_random_string
+from importlib import import_module
+import asyncio
+import httpx
+import json
+import time
+import uuid
+
+from apps.profiles.models import Profile
+
+USER_PREFIX = "loadtest-"
+MESSAGES = (
+    "How do I reset my password?",
+    "My invoice shows the wrong amount, what should I do?",
+    "Can I change the email address on my account?",
+    "The dashboard is slow to load today",
+)
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, round(pct / 100 * len(ordered) + 0.5) - 1))
+    return ordered[rank]
+
+
+class Run:
+    """
+    Per-request samples and the live concurrency gauges
+    """
+
+    def __init__(self):
+        self.samples = []
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.streaming = 0
+        self.peak_streaming = 0
+
+    def started(self):
+        self.in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+
+    def first_byte(self):
+        self.streaming += 1
+        self.peak_streaming = max(self.peak_streaming, self.streaming)
+
+
+class Command(BaseCommand):
+    help = (
+        "Push N concurrent users through /chatbot/stream/ and /chatbot/ of a "
+        "running server and report throughput, TTFT percentiles and saturation. "
+        "Pair with `manage.py fake_openrouter` so no real completions are paid for."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--url", default="http://127.0.0.1:8000", help="Base URL of the server under test")
+        parser.add_argument("--users", type=int, default=20, help="Concurrent users")
+        parser.add_argument("--requests", type=int, default=10, help="Messages per user")
+        parser.add_argument("--endpoint", choices=("stream", "plain", "both"), default="both",
+                            help="both = alternate /chatbot/stream/ and /chatbot/ per message")
+        parser.add_argument("--sse", action="store_true", help="Ask /chatbot/stream/ for text/event-stream")
+        parser.add_argument("--model", default=None)
+        parser.add_argument("--think-ms", type=int, default=0, help="Pause between a user's messages")
+        parser.add_argument("--timeout", type=float, default=120.0)
+        parser.add_argument("--stub-url", default=None,
+                            help="fake_openrouter base URL (e.g. http://127.0.0.1:9100/v1) to report its peak load")
+        parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+
+    def handle(self, *args, **options):
+        if options["users"] < 1 or options["requests"] < 1:
+            raise CommandError("--users and --requests must be at least 1")
+
+        # Sessions are written here and read by the server: both need the same store
+        if "cache" in settings.SESSION_ENGINE and "cached_db" not in settings.SESSION_ENGINE:
+            raise CommandError("loadtest needs a database-backed SESSION_ENGINE shared with the server")
+
+        cookies = [self.login(n) for n in range(options["users"])]
+        report = asyncio.run(self.run(cookies, options))
+
+        if options["json"]:
+            self.stdout.write(json.dumps(report, indent=2))
+        else:
+            self.print_report(report, options)
+
+    # =====================
+    # SETUP
+    # =====================
+    def login(self, n):
+        """
+        Cookies for a ready-made session of loadtest user n (pro plan)
+        """
+        User = get_user_model()
+        username = f"{USER_PREFIX}{n}"
+        user, created = User.objects.get_or_create(username=username, defaults={"email": f"{username}@example.com"})
+        if created:
+            user.set_unusable_password()
+            user.save(update_fields=["password"])
+        Profile.objects.update_or_create(user=user, defaults={"plan": "pro"})
+
+        session = import_module(settings.SESSION_ENGINE).SessionStore()
+        session[SESSION_KEY] = str(user.pk)
+        session[BACKEND_SESSION_KEY] = settings.AUTHENTICATION_BACKENDS[0]
+        session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+        session.save()
+
+        csrf = get_random_string(32)
+        return {settings.SESSION_COOKIE_NAME: session.session_key, settings.CSRF_COOKIE_NAME: csrf}
+
+    # =====================
+    # DRIVER
+    # =====================
+    async def run(self, cookies, options):
+        stats = Run()
+        limits = httpx.Limits(max_connections=len(cookies) * 2, max_keepalive_connections=len(cookies))
+        timeout = httpx.Timeout(options["timeout"], connect=10.0)
+
+        async with httpx.AsyncClient(base_url=options["url"], limits=limits, timeout=timeout) as client:
+            stub_before = await self.stub_stats(client, options["stub_url"])
+
+            started = time.perf_counter()
+            await asyncio.gather(*[
+                self.user(client, stats, user_cookies, n, options)
+                for n, user_cookies in enumerate(cookies)
+            ])
+            wall = time.perf_counter() - started
+
+            stub_after = await self.stub_stats(client, options["stub_url"])
+
+        return self.summarize(stats, wall, len(cookies), stub_before, stub_after)
+
+    async def stub_stats(self, client, stub_url):
+        if not stub_url:
+            return None
+        try:
+            response = await client.get(f"{stub_url.rstrip('/')}/stats")
+            return response.json()
+        except httpx.HTTPError:
+            return None
+
+    async def user(self, client, stats, cookies, n, options):
+        chat_id = str(uuid.uuid4())
+
+        for i in range(options["requests"]):
+            if options["endpoint"] == "both":
+                endpoint = "stream" if (n + i) % 2 == 0 else "plain"
+            else:
+                endpoint = options["endpoint"]
+
+            data = {"message": f"{MESSAGES[(n + i) % len(MESSAGES)]} (#{i})", "chat_id": chat_id}
+            if options["model"]:
+                data["model"] = options["model"]
+
+            headers = {
+                "X-CSRFToken": cookies[settings.CSRF_COOKIE_NAME],
+                "X-Requested-With": "XMLHttpRequest",
+                "Idempotency-Key": str(uuid.uuid4()),
+                "Cookie": "; ".join(f"{name}={value}" for name, value in cookies.items()),
+            }
+            if endpoint == "stream" and options["sse"]:
+                headers["Accept"] = "text/event-stream"
+
+            path = "/chatbot/stream/" if endpoint == "stream" else "/chatbot/"
+            stats.samples.append(await self.send(client, stats, path, endpoint, data, headers))
+
+            if options["think_ms"]:
+                await asyncio.sleep(options["think_ms"] / 1000)
+
+    async def send(self, client, stats, path, endpoint, data, headers):
+        sample = {"endpoint": endpoint, "status": None, "error": None}
+        started = time.perf_counter()
+        stats.started()
+        streaming = False
+
+        try:
+            async with client.stream("POST", path, data=data, headers=headers) as response:
+                sample["status"] = response.status_code
+                sample["ttfb"] = time.perf_counter() - started
+
+                body = []
+                async for piece in response.aiter_text():
+                    if not piece:
+                        continue
+                    if not streaming:
+                        streaming = True
+                        stats.first_byte()
+                        sample["ttft"] = time.perf_counter() - started
+                    body.append(piece)
+
+            text = "".join(body)
+            sample["chars"] = len(text)
+            if response.status_code == 200 and "[Error" in text:
+                sample["error"] = "upstream"
+        except httpx.HTTPError as e:
+            sample["error"] = type(e).__name__
+        finally:
+            sample["total"] = time.perf_counter() - started
+            stats.in_flight -= 1
+            if streaming:
+                stats.streaming -= 1
+
+        return sample
+
+    # =====================
+    # REPORT
+    # =====================
+    def summarize(self, stats, wall, users, stub_before, stub_after):
+        samples = stats.samples
+        ok = [s for s in samples if s["status"] == 200 and not s["error"]]
+
+        def timings(key, endpoint):
+            values = [s[key] * 1000 for s in ok if s["endpoint"] == endpoint and key in s]
+            if not values:
+                return None
+            return {
+                "p50": round(percentile(values, 50), 1),
+                "p90": round(percentile(values, 90), 1),
+                "p99": round(percentile(values, 99), 1),
+                "max": round(max(values), 1),
+            }
+
+        statuses = {}
+        for sample in samples:
+            statuses[str(sample["status"])] = statuses.get(str(sample["status"]), 0) + 1
+
+        stream_seconds = sum(s["total"] - s["ttft"] for s in ok if s["endpoint"] == "stream" and "ttft" in s)
+        report = {
+            "users": users,
+            "requests": len(samples),
+            "ok": len(ok),
+            "statuses": statuses,
+            "errors": sum(1 for s in samples if s["error"]),
+            "wall_seconds": round(wall, 2),
+            "throughput_rps": round(len(ok) / wall, 2) if wall else 0.0,
+            "stream_chars_per_second": round(
+                sum(s["chars"] for s in ok if s["endpoint"] == "stream") / stream_seconds, 1
+            ) if stream_seconds else None,
+            "stream_ttft_ms": timings("ttft", "stream"),
+            "stream_ttfb_ms": timings("ttfb", "stream"),
+            "stream_total_ms": timings("total", "stream"),
+            "plain_latency_ms": timings("total", "plain"),
+            "saturation": {
+                "peak_in_flight": stats.peak_in_flight,
+                # Responses producing bytes at once: stuck at the worker count when saturated
+                "peak_streaming": stats.peak_streaming,
+                "ratio": round(stats.peak_streaming / users, 2),
+            },
+        }
+
+        if stub_after is not None:
+            report["upstream"] = {
+                "requests": stub_after["requests"] - (stub_before or {}).get("requests", 0),
+                "errors": stub_after["errors"] - (stub_before or {}).get("errors", 0),
+                "peak_in_flight": stub_after["peak_in_flight"],
+            }
+        return report
+
+    def print_report(self, report, options):
+        write = self.stdout.write
+
+        write(f"{report['users']} users x {options['requests']} messages -> {options['url']} ({options['endpoint']})")
+        write(f"  requests      {report['requests']} ({report['ok']} ok, {report['errors']} errors) statuses {report['statuses']}")
+        write(f"  wall          {report['wall_seconds']}s")
+        write(f"  throughput    {report['throughput_rps']} req/s")
+        if report["stream_chars_per_second"] is not None:
+            write(f"  stream rate   {report['stream_chars_per_second']} chars/s per stream")
+
+        for key, label in (
+            ("stream_ttft_ms", "stream TTFT"),
+            ("stream_ttfb_ms", "stream TTFB"),
+            ("stream_total_ms", "stream total"),
+            ("plain_latency_ms", "plain latency"),
+        ):
+            values = report[key]
+            if values:
+                write(f"  {label:<13} p50 {values['p50']}ms  p90 {values['p90']}ms  p99 {values['p99']}ms  max {values['max']}ms")
+
+        saturation = report["saturation"]
+        write(
+            f"  saturation    peak {saturation['peak_streaming']} streaming / {saturation['peak_in_flight']} in flight "
+            f"of {report['users']} users (ratio {saturation['ratio']})"
+        )
+        if "upstream" in report:
+            upstream = report["upstream"]
+            write(
+                f"  upstream      {upstream['requests']} requests, {upstream['errors']} injected errors, "
+                f"peak {upstream['peak_in_flight']} concurrent"
+            )
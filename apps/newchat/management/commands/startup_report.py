@@ -0,0 +1,37 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from importlib import import_module
+import sys
+import time
+
+from apps.newchat import guardrails
+
+HEAVY_MODULES = ("presidio_analyzer", "spacy", "openai", "httpx")
+
+
+class Command(BaseCommand):
+    help = "Report import cost of the URLconf and which heavy modules it pulls in"
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--warm",
+            action="store_true",
+            help="Also time guardrails.warm_up() (loads the Presidio/spaCy engine)",
+        )
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        import_module(settings.ROOT_URLCONF)
+        self.stdout.write(f"URLconf import: {(time.perf_counter() - start) * 1000:.1f} ms")
+
+        for name in HEAVY_MODULES:
+            state = "loaded" if name in sys.modules else "not loaded"
+            self.stdout.write(f"  {name:<18} {state}")
+
+        self.stdout.write(f"Guardrail engine: {'loaded' if guardrails.engine_loaded() else 'lazy (not loaded)'}")
+
+        if options["warm"]:
+            start = time.perf_counter()
+            guardrails.warm_up()
+            self.stdout.write(f"warm_up(): {(time.perf_counter() - start) * 1000:.1f} ms")
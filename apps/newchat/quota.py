@@ -0,0 +1,194 @@
+"""
+Per-user message quota (sliding window) kept in Django's cache
+
+The window (CHAT_QUOTA_PLANS[plan]["hours"]) is split into
+CHAT_QUOTA_BUCKETS fixed buckets. Each accepted message increments the
+current bucket with an atomic cache incr; usage is the sum of the buckets
+still inside the window, read with one get_many. A check costs a couple of
+cache round trips and no database queries. The limit is only per user with
+a cache shared by all workers (redis, memcached); with the default locmem
+cache each process counts separately (system check newchat.W001).
+
+Plans with "daily_tokens" also cap prompt + completion tokens per local
+day, read from the UsageDaily rollup (apps/history/usage.py, cached).
+"""
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+from datetime import timedelta
+import time
+
+DEFAULT_PLAN = "free"
+PLAN_CACHE_SECONDS = 300
+
+
+# =====================
+# PLAN LOOKUP
+# =====================
+def plan_cache_key(user_id):
+    return f"quota:plan:{user_id}"
+
+
+def plan_for(user):
+    """
+    User's plan name; cached so the steady state never touches the DB
+    """
+    key = plan_cache_key(user.pk)
+    plan = cache.get(key)
+
+    if plan is None:
+        from apps.profiles.models import Profile
+
+        plan = (
+            Profile.objects.filter(user=user).values_list("plan", flat=True).first()
+            or DEFAULT_PLAN
+        )
+        cache.set(key, plan, PLAN_CACHE_SECONDS)
+    return plan
+
+
+def forget_plan(user_id):
+    cache.delete(plan_cache_key(user_id))
+
+
+def plan_limits(plan):
+    plans = settings.CHAT_QUOTA_PLANS
+    limits = plans.get(plan) or plans[DEFAULT_PLAN]
+    return limits["messages"], int(limits["hours"] * 3600)
+
+
+def plan_token_limit(plan):
+    plans = settings.CHAT_QUOTA_PLANS
+    return (plans.get(plan) or plans[DEFAULT_PLAN]).get("daily_tokens")
+
+
+# =====================
+# DAILY TOKEN BUDGET
+# =====================
+def _seconds_to_midnight():
+    now = timezone.localtime()
+    midnight = (now + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+    return max(1, int((midnight - now).total_seconds()) + 1)
+
+
+def _with_tokens(state, user):
+    token_limit = plan_token_limit(plan_for(user))
+    state["token_limit"] = token_limit
+    state["tokens_used"] = 0
+
+    if token_limit:
+        from apps.history import usage
+
+        state["tokens_used"] = usage.tokens_used(user.pk)
+        if state["tokens_used"] >= token_limit:
+            state["allowed"] = False
+            state["remaining"] = 0
+            state["retry_after"] = max(state["retry_after"], _seconds_to_midnight())
+    return state
+
+
+# =====================
+# SLIDING WINDOW
+# =====================
+def _window(user, now):
+    limit, window = plan_limits(plan_for(user))
+    buckets = settings.CHAT_QUOTA_BUCKETS
+    width = window / buckets
+    current = int(now // width)
+
+    indexes = range(current - buckets + 1, current + 1)
+    keys = {index: f"quota:{user.pk}:{window}:{index}" for index in indexes}
+    return limit, window, width, buckets, keys
+
+
+def _state(limit, window, width, buckets, keys, counts, now):
+    used = sum(counts.get(key, 0) for key in keys.values())
+    retry_after = 0
+
+    if used >= limit:
+        # Drop the oldest buckets until usage falls under the limit;
+        # a bucket leaves the window (buckets * width) after it opens.
+        remaining_used = used
+        for index, key in keys.items():
+            remaining_used -= counts.get(key, 0)
+            if remaining_used < limit:
+                retry_after = max(1, int((index + buckets) * width - now) + 1)
+                break
+
+    return {
+        "allowed": used < limit,
+        "limit": limit,
+        "window": window,
+        "used": used,
+        "remaining": max(0, limit - used),
+        "retry_after": retry_after,
+    }
+
+
+def status(user, now=None):
+    """
+    Current usage without consuming a message
+    """
+    now = now or time.time()
+    limit, window, width, buckets, keys = _window(user, now)
+    counts = cache.get_many(list(keys.values()))
+    return _with_tokens(_state(limit, window, width, buckets, keys, counts, now), user)
+
+
+def reserve(user, now=None):
+    """
+    Atomically take one message from the quota
+
+    Returns the quota state; when "allowed" is False nothing was consumed.
+    """
+    now = now or time.time()
+
+    # Out of tokens for today: refuse before taking a message
+    tokens = _with_tokens({"allowed": True, "retry_after": 0}, user)
+    if not tokens["allowed"]:
+        state = status(user, now)
+        state["allowed"] = False
+        return state
+
+    limit, window, width, buckets, keys = _window(user, now)
+    current_key = keys[max(keys)]
+
+    cache.add(current_key, 0, timeout=window + int(width) + 60)
+    try:
+        cache.incr(current_key)
+    except ValueError:
+        # evicted between add and incr
+        cache.set(current_key, 1, timeout=window + int(width) + 60)
+
+    counts = cache.get_many(list(keys.values()))
+    state = _state(limit, window, width, buckets, keys, counts, now)
+
+    if state["used"] > limit:
+        # Over the limit: give the slot back
+        _give_back(current_key)
+        counts[current_key] = counts.get(current_key, 1) - 1
+        state = _state(limit, window, width, buckets, keys, counts, now)
+        state["allowed"] = False
+    else:
+        state["allowed"] = True
+        state["bucket"] = current_key
+
+    state["token_limit"] = tokens["token_limit"]
+    state["tokens_used"] = tokens["tokens_used"]
+    return state
+
+
+def _give_back(key):
+    try:
+        cache.decr(key)
+    except ValueError:
+        pass
+
+
+def release(state):
+    """
+    Return a message taken by reserve() (e.g. the request was blocked)
+    """
+    if state.get("bucket"):
+        _give_back(state["bucket"])
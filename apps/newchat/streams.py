@@ -0,0 +1,292 @@
+"""
+Resumable token streams (Server-Sent Events)
+
+When the client asks for text/event-stream, stream_chatbot runs the
+generation as a task of its own and the response only tails it, so a
+dropped connection no longer stops the model. Every token is an event with
+the id "<stream_id>:<seq>". Events are also kept in a bounded cache-backed
+ring buffer (the last STREAM_BUFFER_EVENTS, in blocks of BLOCK_EVENTS) for
+STREAM_BUFFER_TTL, and a reconnect to /chatbot/stream/resume/ with
+Last-Event-ID picks up after that event on any worker instead of
+re-generating.
+"""
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import StreamingHttpResponse
+import asyncio
+import contextvars
+import logging
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+BLOCK_EVENTS = 64
+POLL_SECONDS = 0.1
+
+# Event kinds; "token" is sent without an event: line
+TOKEN = "token"
+DONE = "done"
+ERROR = "error"
+
+
+class StreamGone(Exception):
+    """
+    Unknown, expired or foreign stream, or Last-Event-ID already evicted
+    """
+
+
+def wants_events(request):
+    return "text/event-stream" in request.headers.get("Accept", "")
+
+
+def format_event(data, event_id=None, event=None):
+    lines = []
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    if event:
+        lines.append(f"event: {event}")
+    # Multi-line data is one data: line per line; the client re-joins with \n
+    lines.extend(f"data: {line}" for line in data.split("\n"))
+    return "\n".join(lines) + "\n\n"
+
+
+def parse_event_id(value):
+    stream_id, _, seq = (value or "").partition(":")
+    try:
+        return str(uuid.UUID(stream_id)), int(seq)
+    except ValueError:
+        raise StreamGone("Malformed Last-Event-ID")
+
+
+def event_response(events, status=200):
+    response = StreamingHttpResponse(events, status=status, content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    # Tell nginx not to buffer the stream
+    response["X-Accel-Buffering"] = "no"
+    return response
+
+
+def _meta_key(stream_id):
+    return f"stream:{stream_id}"
+
+
+def _block_key(stream_id, block):
+    return f"stream:{stream_id}:{block}"
+
+
+def _block_of(seq):
+    return (seq - 1) // BLOCK_EVENTS
+
+
+def _ring_blocks():
+    return max(1, settings.STREAM_BUFFER_EVENTS // BLOCK_EVENTS)
+
+
+# =====================
+# PRODUCER SIDE
+# =====================
+class TokenStream:
+    """
+    One generation: events in memory for this process, flushed to the cache
+    """
+
+    def __init__(self, user_id):
+        self.id = str(uuid.uuid4())
+        self.user_id = user_id
+        self.events = []  # (kind, data); seq is index + 1
+        self.done = False
+        self._wake = None
+        self._flushed = 0
+        self._flushed_at = 0.0
+        self._first_block = 0
+
+    def _notify(self):
+        if self._wake is not None and not self._wake.done():
+            self._wake.set_result(None)
+        self._wake = None
+
+    def _waiter(self):
+        if self._wake is None:
+            self._wake = asyncio.get_running_loop().create_future()
+        return self._wake
+
+    async def append(self, data):
+        self.events.append((TOKEN, data))
+        self._notify()
+        if time.monotonic() - self._flushed_at >= settings.STREAM_FLUSH_MS / 1000:
+            await self.flush()
+
+    async def close(self, error=None):
+        self.events.append((ERROR, error) if error else (DONE, ""))
+        self.done = True
+        self._notify()
+        await self.flush()
+        _live.pop(self.id, None)
+
+    async def flush(self):
+        """
+        Rewrite the blocks touched since the last flush, evict past the ring
+        """
+        last = len(self.events)
+        if last == self._flushed:
+            return
+
+        last_block = _block_of(last)
+        values = {}
+        for block in range(_block_of(self._flushed + 1), last_block + 1):
+            start = block * BLOCK_EVENTS
+            values[_block_key(self.id, block)] = self.events[start:start + BLOCK_EVENTS]
+
+        first_block = max(self._first_block, last_block - _ring_blocks() + 1)
+        values[_meta_key(self.id)] = {
+            "user": self.user_id,
+            "first": first_block * BLOCK_EVENTS + 1,
+            "last": last,
+            "done": self.done,
+        }
+
+        try:
+            await cache.aset_many(values, settings.STREAM_BUFFER_TTL)
+            if first_block > self._first_block:
+                await cache.adelete_many([
+                    _block_key(self.id, block) for block in range(self._first_block, first_block)
+                ])
+        except Exception:
+            # The live response does not depend on the buffer
+            logger.exception("Could not buffer stream %s", self.id)
+            return
+
+        self._first_block = first_block
+        self._flushed = last
+        self._flushed_at = time.monotonic()
+
+    def render(self, seq):
+        kind, data = self.events[seq - 1]
+        return format_event(data, f"{self.id}:{seq}", None if kind == TOKEN else kind)
+
+    async def follow(self, after=0):
+        """
+        Events after seq `after`, waiting for new ones until the stream ends
+        """
+        sent = after
+        while True:
+            wake = self._waiter()
+            while sent < len(self.events):
+                sent += 1
+                yield self.render(sent)
+                if self.events[sent - 1][0] != TOKEN:
+                    return
+            await wake
+
+
+_live = {}
+_tasks = set()
+
+
+def run(stream, tokens):
+    """
+    Pump tokens into stream from a task that outlives the response
+
+    The task starts now, on the loop running the view, so the generation
+    (and the ticket / History it settles) happens even if the client goes
+    away before reading the first event. It runs in an empty context: the
+    view's context carries the request's thread-sensitive executor (under
+    WSGI, async_to_sync's), which is gone once the response is returned.
+    """
+
+    async def pump():
+        error = None
+        try:
+            async for token in tokens:
+                await stream.append(token)
+        except Exception as e:
+            logger.exception("Stream %s failed", stream.id)
+            error = str(e)
+        finally:
+            await stream.close(error)
+
+    _live[stream.id] = stream
+    task = contextvars.Context().run(asyncio.ensure_future, pump())
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+
+    return stream.follow()
+
+
+def untracked(tokens):
+    """
+    Events without ids, for replies that are not buffered (idempotent replays)
+    """
+
+    async def events():
+        try:
+            async for token in tokens:
+                yield format_event(token)
+        except Exception as e:
+            # e.g. the leader being tailed was lost (idempotency.LeaderLost)
+            yield format_event(str(e), event=ERROR)
+            return
+        yield format_event("", event=DONE)
+
+    return events()
+
+
+# =====================
+# RESUME
+# =====================
+async def resume(user_id, last_event_id):
+    """
+    Events after Last-Event-ID; raises StreamGone before anything is sent
+    """
+    stream_id, after = parse_event_id(last_event_id)
+
+    live = _live.get(stream_id)
+    if live is not None and live.user_id == user_id:
+        return live.follow(after)
+
+    meta = await _meta(stream_id, user_id, after)
+    return _replay(stream_id, user_id, after, meta)
+
+
+async def _meta(stream_id, user_id, after):
+    meta = await cache.aget(_meta_key(stream_id))
+    if meta is None or meta["user"] != user_id:
+        raise StreamGone("Unknown or expired stream")
+    if after + 1 < meta["first"]:
+        raise StreamGone("Events already evicted from the buffer")
+    return meta
+
+
+async def _replay(stream_id, user_id, after, meta):
+    sent = after
+    while True:
+        if meta["last"] > sent:
+            blocks = range(_block_of(sent + 1), _block_of(meta["last"]) + 1)
+            found = await cache.aget_many([_block_key(stream_id, block) for block in blocks])
+
+            for block in blocks:
+                events = found.get(_block_key(stream_id, block))
+                if events is None:
+                    # Evicted (or expired) under us
+                    yield format_event("Stream buffer expired", event=ERROR)
+                    return
+                for offset, (kind, data) in enumerate(events):
+                    seq = block * BLOCK_EVENTS + offset + 1
+                    if seq <= sent or seq > meta["last"]:
+                        continue
+                    sent = seq
+                    yield format_event(data, f"{stream_id}:{seq}", None if kind == TOKEN else kind)
+                    if kind != TOKEN:
+                        return
+
+        if meta["done"]:
+            return
+
+        await asyncio.sleep(POLL_SECONDS)
+        try:
+            meta = await _meta(stream_id, user_id, sent)
+        except StreamGone:
+            yield format_event("Stream buffer expired", event=ERROR)
+            return
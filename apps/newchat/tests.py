@@ -1,3 +1,722 @@
-from django.test import TestCase
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from unittest import mock
+import asyncio
+import base64
+import io
+import os
+import tempfile
+import uuid
+from types import SimpleNamespace
 
-# Create your tests here.
+from PIL import Image
+
+from apps.history.models import History
+from apps.newchat import guardrails, idempotency, quota, streams, toxic
+from chatbox import context, images, openrouter_api, response_cache, routing
+from chatbox.storage import ContentAddressedStorage
+
+
+class IdempotencyTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+
+    def begin(self, key="key-1", fp="fp-1"):
+        return idempotency.begin(1, key, fp)
+
+    def test_no_key(self):
+        self.assertEqual(self.begin(key="").role, idempotency.NONE)
+
+    def test_key_too_long(self):
+        key = "k" * (idempotency.MAX_KEY_LENGTH + 1)
+        self.assertEqual(self.begin(key=key).role, idempotency.INVALID)
+
+    def test_first_request_leads(self):
+        self.assertEqual(self.begin().role, idempotency.LEADER)
+
+    def test_duplicate_in_flight_follows_the_leader(self):
+        leader = self.begin()
+        follower = self.begin()
+
+        self.assertEqual(follower.role, idempotency.FOLLOWER)
+        self.assertIs(follower.flight, leader.flight)
+
+        leader.publish("Hel")
+        leader.publish("lo")
+        leader.finish("Hello")
+
+        self.assertEqual(follower.wait(timeout=1), "Hello")
+        self.assertEqual(leader.flight.chunks, ["Hel", "lo"])
+
+    def test_same_key_different_request_conflicts(self):
+        self.begin()
+        self.assertEqual(self.begin(fp="fp-2").role, idempotency.CONFLICT)
+
+    def test_finished_reply_is_replayed(self):
+        self.begin().finish("Hello")
+        replay = self.begin()
+
+        self.assertEqual(replay.role, idempotency.REPLAY)
+        self.assertEqual(replay.reply, "Hello")
+
+    def test_abort_frees_the_key(self):
+        leader = self.begin()
+        follower = self.begin()
+        leader.abort()
+
+        self.assertIsNone(follower.wait(timeout=1))
+        self.assertTrue(leader.flight.failed)
+        self.assertEqual(self.begin().role, idempotency.LEADER)
+
+    def test_abort_after_hand_off_leaves_the_ticket_to_the_generator(self):
+        leader = self.begin()
+        leader.hand_off()
+        leader.abort()
+
+        self.assertEqual(self.begin().role, idempotency.FOLLOWER)
+
+        leader.finish("Hello")
+        self.assertEqual(self.begin().role, idempotency.REPLAY)
+
+    def test_fail_after_finish_keeps_the_reply(self):
+        leader = self.begin()
+        leader.finish("Hello")
+        leader.fail()
+
+        self.assertEqual(self.begin().reply, "Hello")
+
+    def test_follower_in_another_process_polls_the_cache(self):
+        leader = self.begin()
+        follower = idempotency.Ticket(idempotency.FOLLOWER, leader.key, leader.fp)
+
+        self.assertIsNone(follower.wait(timeout=0.2))
+
+        leader.finish("Hello")
+        self.assertEqual(follower.wait(timeout=0.2), "Hello")
+
+    @override_settings(IDEMPOTENCY_WAIT_SECONDS=0.1)
+    def test_follower_wait_is_bounded(self):
+        self.begin()
+        self.assertIsNone(self.begin().wait())
+
+    async def test_follow_tails_the_leader(self):
+        leader = self.begin()
+        leader.publish("Hel")
+        follower = self.begin().flight.follow(timeout=1)
+
+        self.assertEqual(await anext(follower), "Hel")
+        leader.publish("lo")
+        leader.finish("Hello")
+        self.assertEqual(await _collect(follower), ["lo"])
+
+    async def test_follow_raises_when_the_leader_fails(self):
+        leader = self.begin()
+        follower = self.begin().flight.follow(timeout=1)
+        leader.fail()
+
+        with self.assertRaises(idempotency.LeaderLost):
+            await _collect(follower)
+
+    async def test_follow_gives_up_on_a_silent_leader(self):
+        self.begin()
+        follower = self.begin().flight.follow(timeout=0.1)
+
+        with self.assertRaises(idempotency.LeaderLost):
+            await _collect(follower)
+
+    @override_settings(IDEMPOTENCY_PENDING_SECONDS=3)
+    def test_publish_refreshes_the_pending_claim(self):
+        leader = self.begin()
+        with mock.patch.object(idempotency.cache, "touch") as touch:
+            leader.publish("early")
+            touch.assert_not_called()
+
+            leader._claimed_at -= 2
+            leader.publish("late")
+            touch.assert_called_once_with(leader.key, 3)
+
+
+@override_settings(
+    CHAT_QUOTA_PLANS={"free": {"messages": 2, "hours": 1}},
+    CHAT_QUOTA_BUCKETS=4,
+)
+class QuotaTests(TestCase):
+    NOW = 1_000_000_000.0
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user("quota", password="pw")
+
+    def test_reserve_takes_a_message(self):
+        state = quota.reserve(self.user, now=self.NOW)
+
+        self.assertTrue(state["allowed"])
+        self.assertEqual(state["used"], 1)
+        self.assertEqual(state["remaining"], 1)
+
+    def test_over_the_limit_is_denied_without_consuming(self):
+        quota.reserve(self.user, now=self.NOW)
+        quota.reserve(self.user, now=self.NOW)
+        state = quota.reserve(self.user, now=self.NOW)
+
+        self.assertFalse(state["allowed"])
+        self.assertGreater(state["retry_after"], 0)
+        self.assertEqual(quota.status(self.user, now=self.NOW)["used"], 2)
+
+    def test_release_gives_the_message_back(self):
+        state = quota.reserve(self.user, now=self.NOW)
+        quota.release(state)
+
+        self.assertEqual(quota.status(self.user, now=self.NOW)["used"], 0)
+
+    def test_release_of_a_denied_reservation_is_a_no_op(self):
+        quota.reserve(self.user, now=self.NOW)
+        quota.reserve(self.user, now=self.NOW)
+        quota.release(quota.reserve(self.user, now=self.NOW))
+
+        self.assertEqual(quota.status(self.user, now=self.NOW)["used"], 2)
+
+    def test_window_slides(self):
+        quota.reserve(self.user, now=self.NOW)
+        quota.reserve(self.user, now=self.NOW)
+
+        self.assertTrue(quota.reserve(self.user, now=self.NOW + 3600 + 900)["allowed"])
+
+
+async def _tokens(*tokens):
+    for token in tokens:
+        yield token
+
+
+async def _collect(events):
+    return [event async for event in events]
+
+
+@override_settings(STREAM_FLUSH_MS=0, STREAM_BUFFER_EVENTS=64)
+class StreamResumeTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+
+    async def generate(self, *tokens, user_id=1):
+        stream = streams.TokenStream(user_id)
+        events = await _collect(streams.run(stream, _tokens(*tokens)))
+        await self.settled(stream)
+        return stream, events
+
+    async def settled(self, stream):
+        # The pump task flushes and leaves _live after the last event is read
+        while stream.id in streams._live:
+            await asyncio.sleep(0.01)
+
+    async def test_events_carry_stream_ids(self):
+        stream, events = await self.generate("Hel", "lo")
+
+        self.assertEqual(events, [
+            f"id: {stream.id}:1\ndata: Hel\n\n",
+            f"id: {stream.id}:2\ndata: lo\n\n",
+            f"id: {stream.id}:3\nevent: done\ndata: \n\n",
+        ])
+
+    async def test_resume_replays_after_last_event_id_from_the_cache(self):
+        # Finished stream: only the cache buffer is left, as on another worker
+        stream, events = await self.generate("a", "b", "c")
+
+        replayed = await _collect(await streams.resume(1, f"{stream.id}:1"))
+
+        self.assertEqual(replayed, events[1:])
+
+    async def test_resume_follows_a_live_stream(self):
+        stream = streams.TokenStream(1)
+        source = asyncio.Queue()
+
+        async def tokens():
+            while (token := await source.get()) is not None:
+                yield token
+
+        first = streams.run(stream, tokens())
+        await source.put("a")
+        await anext(first)
+        await first.aclose()
+
+        resumed = await streams.resume(1, f"{stream.id}:1")
+        await source.put("b")
+        await source.put(None)
+
+        self.assertEqual(
+            [event.split("\n")[0] for event in await _collect(resumed)],
+            [f"id: {stream.id}:2", f"id: {stream.id}:3"],
+        )
+        await self.settled(stream)
+
+    async def test_unread_stream_still_generates(self):
+        stream = streams.TokenStream(1)
+        streams.run(stream, _tokens("a", "b"))
+        await self.settled(stream)
+
+        replayed = await _collect(await streams.resume(1, f"{stream.id}:0"))
+
+        self.assertEqual(len(replayed), 3)
+
+    async def test_foreign_or_malformed_ids_are_gone(self):
+        stream, _ = await self.generate("a")
+
+        with self.assertRaises(streams.StreamGone):
+            await streams.resume(2, f"{stream.id}:1")
+        with self.assertRaises(streams.StreamGone):
+            await streams.resume(1, "not-an-id")
+
+    async def test_evicted_events_are_gone(self):
+        # Two blocks of events (the last one is "done"); the ring keeps one
+        stream, events = await self.generate(*[str(i) for i in range(streams.BLOCK_EVENTS * 2 - 1)])
+
+        with self.assertRaises(streams.StreamGone):
+            await streams.resume(1, f"{stream.id}:1")
+
+        replayed = await _collect(await streams.resume(1, f"{stream.id}:{streams.BLOCK_EVENTS}"))
+        self.assertEqual(replayed, events[streams.BLOCK_EVENTS:])
+
+
+class FakeChatbot:
+    """
+    AsyncOpenRouterChatbot without the upstream
+    """
+
+    def __init__(self, model=None, context_key=None):
+        self.usage = {}
+        self.failed = False
+
+    async def stream_response(self, user_input, conversation_history=None, image_base64=None, model=None, stream=None):
+        for token in ("Hel", "lo"):
+            await asyncio.sleep(0)
+            yield token
+
+
+@override_settings(STREAM_FLUSH_MS=0, HISTORY_WRITER_ENABLED=False)
+@mock.patch("apps.newchat.views.AsyncOpenRouterChatbot", FakeChatbot)
+class StreamViewTests(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user("streamer", password="pw")
+        self.client.force_login(self.user)
+        self.chat = str(uuid.uuid4())
+
+    def post(self, key="stream-1"):
+        return self.client.post(
+            "/chatbot/stream/",
+            {"message": "hi", "chat_id": self.chat},
+            headers={"Accept": "text/event-stream", "Idempotency-Key": key},
+        )
+
+    def test_sse_under_wsgi_settles_everything(self):
+        response = self.post()
+        events = b"".join(response.streaming_content).decode().split("\n\n")
+
+        self.assertEqual(events[0].split("\n")[1], "data: Hel")
+        self.assertIn("event: done", events[2])
+        self.assertEqual(
+            list(History.objects.filter(chat_id=self.chat).values_list("ai_message", flat=True)),
+            ["Hello"],
+        )
+        self.assertEqual(cache.get(f"idempotency:{self.user.pk}:stream-1")["state"], "done")
+
+        # Buffered for Last-Event-ID resume
+        stream_id = events[0].split("\n")[0].removeprefix("id: ").split(":")[0]
+        resumed = self.client.get("/chatbot/stream/resume/", headers={"Last-Event-ID": f"{stream_id}:1"})
+        self.assertIn("data: lo", b"".join(resumed.streaming_content).decode())
+
+    def test_key_too_long_is_rejected(self):
+        response = self.post(key="k" * (idempotency.MAX_KEY_LENGTH + 1))
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {"error": "Idempotency-Key too long"})
+
+    @override_settings(IDEMPOTENCY_WAIT_SECONDS=0.1)
+    def test_follower_of_a_lost_leader_gets_an_error_event(self):
+        leader = idempotency.begin(self.user.pk, "stream-1", "unused")
+        with mock.patch.object(idempotency, "fingerprint", return_value=leader.fp):
+            events = b"".join(self.post().streaming_content).decode()
+
+        self.assertIn("event: error", events)
+        self.assertNotIn("event: done", events)
+
+    def test_retry_is_replayed(self):
+        b"".join(self.post().streaming_content)
+        replay = b"".join(self.post().streaming_content).decode()
+
+        self.assertIn("data: Hello", replay)
+        self.assertEqual(History.objects.filter(chat_id=self.chat).count(), 1)
+
+
+@override_settings(
+    MODEL_ROUTES={"a": ["b", "c"]},
+    ROUTING_EWMA_ALPHA=0.5,
+    ROUTING_ERROR_PENALTY=4.0,
+)
+class RoutingTests(SimpleTestCase):
+    def setUp(self):
+        routing._models.clear()
+        self.addCleanup(routing._models.clear)
+
+    def test_models_outside_a_group_are_not_routed(self):
+        self.assertEqual(routing.candidates("x"), ["x"])
+
+    def test_unmeasured_alternates_never_beat_the_requested_model(self):
+        self.assertEqual(routing.candidates("b"), ["b", "a", "c"])
+
+        routing.record_success("a", 500)
+        self.assertEqual(routing.candidates("b"), ["b", "a", "c"])
+
+    def test_faster_alternate_goes_first(self):
+        routing.record_success("a", 800)
+        routing.record_success("c", 200)
+
+        self.assertEqual(routing.candidates("a"), ["c", "a", "b"])
+
+    def test_ttft_is_an_ewma(self):
+        routing.record_success("a", 100)
+        routing.record_success("a", 300)
+
+        self.assertEqual(routing.stats()["a"]["ttft_ms"], 200)
+
+    def test_errors_push_a_model_down(self):
+        routing.record_success("a", 200)
+        routing.record_success("c", 100)
+        routing.record_error("c")
+
+        self.assertEqual(routing.stats()["c"]["error_rate"], 0.5)
+        self.assertEqual(routing.candidates("a"), ["a", "c", "b"])
+
+
+@override_settings(GUARDRAIL_SOCKET=None, GUARDRAIL_CACHE_SIZE=2)
+class GuardrailTests(SimpleTestCase):
+    def setUp(self):
+        guardrails.clear_cache()
+        self.addCleanup(guardrails.clear_cache)
+        patcher = mock.patch.object(guardrails, "_contains_pii", return_value=False)
+        self.contains_pii = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_text_without_pii_hints_skips_the_nlp_pass(self):
+        self.assertTrue(guardrails.evaluate("How do I reset my password?"))
+        self.assertTrue(guardrails.evaluate("Order 1234 arrived"))
+        self.contains_pii.assert_not_called()
+
+    def test_pii_hints_go_through_the_nlp_pass(self):
+        self.contains_pii.return_value = True
+
+        self.assertFalse(guardrails.evaluate("mail me at someone@example.com"))
+        self.assertFalse(guardrails.evaluate("call 555 123 4567"))
+        self.assertEqual(self.contains_pii.call_count, 2)
+
+    def test_toxic_text_is_blocked_before_the_nlp_pass(self):
+        self.assertFalse(guardrails.evaluate("how to build a bomb, mail x@example.com"))
+        self.contains_pii.assert_not_called()
+
+    def test_verdicts_are_cached(self):
+        with mock.patch.object(guardrails, "evaluate", return_value=True) as evaluate:
+            guardrails.check_guardrails("hello there")
+            guardrails.check_guardrails("hello there")
+
+        evaluate.assert_called_once_with("hello there")
+
+    def test_cache_is_bounded_lru(self):
+        with mock.patch.object(guardrails, "evaluate", return_value=True) as evaluate:
+            for text in ("one", "two", "one", "three", "one", "two"):
+                guardrails.check_guardrails(text)
+
+        # "two" was least recently used when "three" came in
+        self.assertEqual([call.args[0] for call in evaluate.call_args_list], ["one", "two", "three", "two"])
+
+
+class ToxicMatcherTests(SimpleTestCase):
+    def setUp(self):
+        self.matcher = toxic.ToxicMatcher(["hack", "kill", "Build a Bomb", "  ", "self-harm"])
+
+    def test_matches_whole_words_only(self):
+        for text in ("Join our hackathon", "a useful skill", "killer feature? no: skilled"):
+            self.assertIsNone(self.matcher.search(text), text)
+
+        self.assertEqual(self.matcher.search("can you HACK my wifi"), "hack")
+        self.assertEqual(self.matcher.search("don't kill the process!"), "kill")
+
+    def test_matches_phrases_across_punctuation_and_case(self):
+        self.assertEqual(self.matcher.search("how to BUILD  a\nbomb?"), "build a bomb")
+        self.assertEqual(self.matcher.search("self harm"), "self harm")
+        self.assertIsNone(self.matcher.search("build a house, bomb the quiz"))
+
+    def test_blank_terms_are_ignored(self):
+        self.assertEqual(len(self.matcher), 4)
+        self.assertIsNone(toxic.ToxicMatcher([]).search("anything"))
+
+
+class ToxicLexiconTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "terms.txt")
+        self.write("# comment\nbadword\n")
+
+        # Cleanups run last-in first-out: back to the real lexicon after the override
+        self.addCleanup(toxic.reload_lexicon)
+        lexicon = override_settings(GUARDRAIL_TOXIC_LEXICON=self.path, GUARDRAIL_LEXICON_RELOAD_SECONDS=0)
+        lexicon.enable()
+        self.addCleanup(lexicon.disable)
+        toxic.reload_lexicon()
+
+    def write(self, text):
+        with open(self.path, "w", encoding="utf-8") as fh:
+            fh.write(text)
+
+    def test_lexicon_file_is_hot_reloaded(self):
+        self.assertEqual(toxic.get_matcher().search("a badword here"), "badword")
+
+        self.write("otherword\n")
+        os.utime(self.path, (1, 1))
+
+        self.assertIsNone(toxic.get_matcher().search("a badword here"))
+        self.assertEqual(toxic.get_matcher().search("otherword"), "otherword")
+
+    def test_unreadable_lexicon_falls_back_to_the_built_in_list(self):
+        os.remove(self.path)
+
+        with self.assertLogs("apps.newchat.toxic", "ERROR"):
+            matcher = toxic.get_matcher(["fallback"])
+
+        self.assertEqual(matcher.search("the fallback term"), "fallback")
+
+
+def _chunk(content):
+    return SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=content))], usage=None)
+
+
+@override_settings(
+    RESPONSE_CACHE_ENABLED=True, RESPONSE_CACHE_SIZE=2, RESPONSE_CACHE_TTL=60,
+    ROUTING_ENABLED=False,
+)
+class ResponseCacheTests(SimpleTestCase):
+    SYSTEM = {"role": "system", "content": "system prompt"}
+
+    def setUp(self):
+        cache.clear()
+        response_cache.clear()
+        self.addCleanup(response_cache.clear)
+
+    def key(self, text, context=(), model="m"):
+        return response_cache.cache_key(model, [self.SYSTEM, *context, {"role": "user", "content": text}])
+
+    def test_key_ignores_case_spacing_and_trailing_punctuation(self):
+        self.assertEqual(self.key("How do I reset my password?"), self.key("  how do i reset   my PASSWORD"))
+
+    def test_key_depends_on_model_context_and_images(self):
+        image = [{"type": "text", "text": "what is this"}, {"type": "image_url", "image_url": {"url": "data:a"}}]
+        keys = {
+            self.key("what is this"),
+            self.key("what is this", model="other"),
+            self.key("what is this", context=[{"role": "user", "content": "earlier"}]),
+            self.key(image),
+        }
+        self.assertEqual(len(keys), 4)
+
+    def test_lru_with_ttl(self):
+        response_cache.put("a", "A")
+        response_cache.put("b", "B")
+        response_cache.get("a")
+        response_cache.put("c", "C")
+        response_cache.put("empty", "")
+
+        self.assertIsNone(response_cache.get("b"))
+        self.assertEqual(response_cache.get("a"), "A")
+
+        with mock.patch.object(response_cache.time, "monotonic", return_value=response_cache.time.monotonic() + 61):
+            self.assertIsNone(response_cache.get("c"))
+
+    def test_replay_keeps_the_text(self):
+        reply = "Hello  there,\nhow can I help?"
+        self.assertEqual("".join(response_cache.CachedStream(reply)), reply)
+
+    def test_repeated_question_skips_the_upstream(self):
+        create = mock.Mock(side_effect=lambda **kwargs: iter([_chunk("Try "), _chunk("again.")]))
+        client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+
+        with mock.patch.object(openrouter_api, "get_client", return_value=client):
+            first = openrouter_api.OpenRouterChatbot(model="m").get_response("Reset password?", [])
+            second = openrouter_api.OpenRouterChatbot(model="m").get_response("reset password", [])
+
+        self.assertEqual((first, second), ("Try again.", "Try again."))
+        create.assert_called_once()
+
+
+def _image_bytes(size, mode="RGB", format="JPEG", **save):
+    out = io.BytesIO()
+    Image.new(mode, size, "red" if mode == "RGB" else (255, 0, 0, 128)).save(out, format=format, **save)
+    return out.getvalue()
+
+
+def _decode(url):
+    header, _, payload = url.partition(",")
+    return header, Image.open(io.BytesIO(base64.b64decode(payload)))
+
+
+@override_settings(IMAGE_MAX_DIMENSION=64, IMAGE_JPEG_QUALITY=80)
+class ImageNormalizationTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_large_jpeg_is_downsized_and_stripped(self):
+        exif = Image.Exif()
+        exif[0x010F] = "Camera maker"
+        header, image = _decode(images.normalize(_image_bytes((400, 200), exif=exif.tobytes())))
+
+        self.assertEqual(header, "data:image/jpeg;base64")
+        self.assertEqual(image.size, (64, 32))
+        self.assertFalse(image.getexif())
+
+    def test_exif_rotation_is_applied(self):
+        exif = Image.Exif()
+        exif[0x0112] = 6  # rotate 90 degrees
+        _, image = _decode(images.normalize(_image_bytes((60, 30), exif=exif.tobytes())))
+
+        self.assertEqual(image.size, (30, 60))
+
+    def test_transparency_stays_png(self):
+        header, image = _decode(images.normalize(_image_bytes((32, 32), mode="RGBA", format="PNG")))
+
+        self.assertEqual(header, "data:image/png;base64")
+        self.assertEqual(image.mode, "RGBA")
+
+    def test_invalid_payloads_are_rejected(self):
+        with self.assertRaises(images.InvalidImage):
+            images.normalize(b"not an image")
+        with self.assertRaises(images.InvalidImage):
+            images.normalize_base64("data:image/png;base64,@@@")
+
+    def test_result_is_cached_by_content(self):
+        raw = _image_bytes((100, 100))
+        first = images.normalize_base64(base64.b64encode(raw).decode())
+
+        with mock.patch.object(images, "_encode") as encode:
+            self.assertEqual(images.normalize(raw), first)
+        encode.assert_not_called()
+
+
+class ContentAddressedStorageTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.storage = ContentAddressedStorage(location=directory.name)
+
+    def blobs(self):
+        return [
+            os.path.join(root, name)
+            for root, _, names in os.walk(self.storage.blob_root)
+            for name in names
+        ]
+
+    def test_same_bytes_are_stored_once(self):
+        first = self.storage.save("chat_uploads/a.jpg", ContentFile(b"same bytes"))
+        second = self.storage.save("chat_uploads/a.jpg", ContentFile(b"same bytes"))
+        other = self.storage.save("profile_images/b.jpg", ContentFile(b"other bytes"))
+
+        self.assertNotEqual(first, second)
+        self.assertEqual(len(self.blobs()), 2)
+        self.assertEqual(self.storage.references(first), 2)
+        self.assertEqual(self.storage.references(other), 1)
+        with self.storage.open(second) as fh:
+            self.assertEqual(fh.read(), b"same bytes")
+
+    def test_blob_goes_with_its_last_reference(self):
+        first = self.storage.save("chat_uploads/a.jpg", ContentFile(b"same bytes"))
+        second = self.storage.save("chat_uploads/b.jpg", ContentFile(b"same bytes"))
+
+        self.storage.delete(first)
+        self.assertEqual(len(self.blobs()), 1)
+        self.assertTrue(self.storage.exists(second))
+
+        self.storage.delete(second)
+        self.assertEqual(self.blobs(), [])
+
+    def test_saving_again_after_the_last_delete_restores_the_blob(self):
+        name = self.storage.save("chat_uploads/a.jpg", ContentFile(b"bytes"))
+        self.storage.delete(name)
+        name = self.storage.save("chat_uploads/a.jpg", ContentFile(b"bytes"))
+
+        self.assertEqual(self.storage.references(name), 1)
+        self.assertEqual(len(self.blobs()), 1)
+
+
+@override_settings(
+    CONTEXT_TOKEN_BUDGETS={"default": 40},
+    CONTEXT_REPLY_TOKENS=0,
+    CONTEXT_SUMMARY_TOKENS=0,
+    CONTEXT_HISTORY_ROWS=20,
+    CONTEXT_SUMMARY_BATCH=2,
+)
+class ContextBuilderTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        # One token per word, so every turn below costs 10 + 4 overhead
+        patcher = mock.patch.object(context, "count_tokens", lambda text: len(text.split()) if text else 0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def history(self, count):
+        return [
+            {"role": "user" if i % 2 == 0 else "assistant", "content": " ".join([f"t{i}"] * 10), "turn": i + 1}
+            for i in range(count)
+        ]
+
+    def test_keeps_the_newest_turns_that_fit(self):
+        history = self.history(6)
+
+        dropped, kept = context.ContextBuilder("any").fit(history, reserved_tokens=10)
+
+        # 40 - 10 reserved leaves room for two 14-token turns
+        self.assertEqual(kept, history[4:])
+        self.assertEqual(dropped, history[:4])
+
+    def test_window_leaves_the_oldest_batch_out(self):
+        history = self.history(6)
+
+        with override_settings(CONTEXT_TOKEN_BUDGETS={"default": 10_000}, CONTEXT_HISTORY_ROWS=3):
+            dropped, kept = context.ContextBuilder("any").fit(history, reserved_tokens=0)
+
+        self.assertEqual(kept, history[4:])
+        self.assertEqual(len(dropped), 4)
+
+    def test_model_budget_overrides_the_default(self):
+        history = self.history(6)
+
+        with override_settings(CONTEXT_TOKEN_BUDGETS={"default": 40, "big": 1000}):
+            _, kept = context.ContextBuilder("big").fit(history, reserved_tokens=0)
+
+        self.assertEqual(kept, history)
+
+    def test_images_count_against_the_budget(self):
+        message = {"role": "user", "content": [
+            {"type": "text", "text": "look at this"},
+            {"type": "image_url", "image_url": {"url": "data:image/jpeg;base64,"}},
+        ]}
+
+        self.assertEqual(
+            context.message_tokens(message),
+            3 + context.IMAGE_TOKENS + context.MESSAGE_OVERHEAD_TOKENS,
+        )
+
+    def test_build_adds_the_summary_and_queues_dropped_turns(self):
+        history = self.history(6)
+        cache.set(context._summary_key("1:chat"), {"text": "earlier", "turn": None})
+        system, user = {"role": "system", "content": "be brief"}, {"role": "user", "content": "next"}
+
+        with mock.patch.object(context, "_pool") as pool:
+            messages = context.ContextBuilder("any", context_key="1:chat").build(system, history, user)
+
+        self.assertEqual(messages[0], system)
+        self.assertEqual(messages[1]["content"], "Summary of the earlier conversation:\nearlier")
+        self.assertEqual(messages[-1], user)
+        # Only role/content reach the model, never the History id
+        self.assertTrue(all(set(m) == {"role", "content"} for m in messages[2:-1]))
+        pool.return_value.submit.assert_called_once_with(
+            context.refresh_summary, "1:chat", history[:len(history) - len(messages[2:-1])]
+        )
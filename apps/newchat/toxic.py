@@ -0,0 +1,138 @@
+from django.conf import settings
+from pathlib import Path
+import logging
+import re
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LEXICON = Path(__file__).resolve().parent / "data" / "toxic_terms.txt"
+
+_WORD = re.compile(r"\w+")
+
+
+def tokenize(text):
+    return _WORD.findall(text.casefold())
+
+
+class ToxicMatcher:
+    """
+    Whole-word matcher for a lexicon of terms and phrases
+
+    Each term is stored as a tuple of words in a hash set, so a lookup costs
+    one set probe per (position, phrase length) of the message, whatever the
+    lexicon size. Matching on word tokens means "hack" no longer fires on
+    "hackathon", nor "kill" on "skill".
+    """
+
+    def __init__(self, terms):
+        self.phrases = set()
+        for term in terms:
+            words = tuple(tokenize(term))
+            if words:
+                self.phrases.add(words)
+
+        self.lengths = sorted({len(words) for words in self.phrases})
+
+    def __len__(self):
+        return len(self.phrases)
+
+    def search(self, text):
+        """
+        Return the first lexicon phrase found in text, or None
+        """
+        if not self.phrases:
+            return None
+
+        words = tokenize(text)
+        for i in range(len(words)):
+            for length in self.lengths:
+                if i + length > len(words):
+                    break
+                candidate = tuple(words[i:i + length])
+                if candidate in self.phrases:
+                    return " ".join(candidate)
+        return None
+
+
+def read_lexicon(path):
+    """
+    One term or phrase per line; blank lines and # comments are ignored
+    """
+    terms = []
+    with open(path, encoding="utf-8") as fh:
+        for line in fh:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                terms.append(line)
+    return terms
+
+
+# =====================
+# HOT-RELOADABLE LEXICON
+# =====================
+_lock = threading.Lock()
+_matcher = None
+_mtime = None
+_checked_at = 0.0
+_listeners = []
+
+
+def lexicon_path():
+    return Path(getattr(settings, "GUARDRAIL_TOXIC_LEXICON", None) or DEFAULT_LEXICON)
+
+
+def on_reload(callback):
+    """
+    Register a callback run after the lexicon is (re)loaded
+    """
+    _listeners.append(callback)
+
+
+def reload_lexicon(fallback=()):
+    """
+    (Re)build the matcher from the lexicon file
+    """
+    global _matcher, _mtime, _checked_at
+
+    path = lexicon_path()
+    try:
+        mtime = path.stat().st_mtime
+        matcher = ToxicMatcher(read_lexicon(path))
+    except OSError:
+        logger.exception("Toxic lexicon %s unreadable, using built-in list", path)
+        mtime, matcher = None, ToxicMatcher(fallback)
+
+    with _lock:
+        _matcher, _mtime, _checked_at = matcher, mtime, time.monotonic()
+
+    logger.info("Toxic lexicon loaded: %d terms", len(matcher))
+    for callback in _listeners:
+        callback()
+    return matcher
+
+
+def get_matcher(fallback=()):
+    """
+    Current matcher; re-reads the file when its mtime changes (checked at
+    most every GUARDRAIL_LEXICON_RELOAD_SECONDS)
+    """
+    global _checked_at
+
+    if _matcher is None:
+        return reload_lexicon(fallback)
+
+    interval = getattr(settings, "GUARDRAIL_LEXICON_RELOAD_SECONDS", 30)
+    if time.monotonic() - _checked_at >= interval:
+        try:
+            changed = lexicon_path().stat().st_mtime != _mtime
+        except OSError:
+            changed = _mtime is not None
+
+        if changed:
+            return reload_lexicon(fallback)
+
+        _checked_at = time.monotonic()
+
+    return _matcher
@@ -7,6 +7,7 @@ from . import views
 urlpatterns = [
     path("", views.new_chatbot, name="chatbot"),
     path("stream/", views.stream_chatbot, name="stream_chatbot"),
+    path("stream/resume/", views.resume_stream, name="resume_stream"),
 ]
 
 if settings.DEBUG:
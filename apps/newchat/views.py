@@ -1,29 +1,26 @@
 
 from django.shortcuts import render
+from django.conf import settings
 from django.http import JsonResponse, StreamingHttpResponse
 from django.contrib.auth.decorators import login_required
-from django.utils import timezone
 from django.views.decorators.csrf import csrf_exempt
-from datetime import timedelta
-import uuid, base64, traceback
-from threading import Thread
+from asgiref.sync import sync_to_async
+import asyncio, logging, uuid, traceback, weakref
 
 from apps.newchat.forms import ChatbotMessageForm
 from apps.history.models import History
+from apps.history import recent, writer as history_writer
 from apps.profiles.models import Profile
-from chatbox.openrouter_api import OpenRouterChatbot
-from .guardrails import check_guardrails
+from chatbox import images, metrics, retrieval, worker_loop
+from chatbox.openrouter_api import OpenRouterChatbot, AsyncOpenRouterChatbot, DEFAULT_MODEL
+from .guardrails import submit_check, acheck_guardrails
+from . import idempotency, quota, streams
 
-
-
-# =====================
-# CHAT LIMIT CONFIG
-# =====================
-MAX_MESSAGES = 10
-CHAT_LIMIT_HOURS = 24
+logger = logging.getLogger(__name__)
 
 
 @login_required(login_url="login")
+@metrics.instrument("new_chatbot")
 def new_chatbot(request):
 
     # =====================
@@ -51,68 +48,42 @@ def new_chatbot(request):
     conversation = []
 
     if not is_new_chat:
-        db_history = History.objects.filter(
-            user=request.user,
-            chat_id=chat_id
-        ).only("user_message", "ai_message", "uploaded_file", "created_at") \
-        .order_by("-created_at")[:20]
+        # Cached recent turns; only a cold chat touches History
+        with metrics.HISTORY_LOAD_SECONDS.time(view="new_chatbot"):
+            turns = recent.get_recent(request.user.pk, chat_id)
 
-        db_history = reversed(db_history)
-
-        for item in db_history:
-            if item.user_message or item.uploaded_file:
+        for turn in turns:
+            if turn["user_message"] or turn["uploaded_file"]:
                 conversation.append({
                     "role": "user",
-                    "content": item.user_message,
-                    "image": item.uploaded_file.url if item.uploaded_file else None
+                    "content": turn["user_message"],
+                    "image": recent.file_url(turn["uploaded_file"]),
+                    "turn": turn["id"]
                 })
 
-            if item.ai_message:
+            if turn["ai_message"]:
                 conversation.append({
                     "role": "assistant",
-                    "content": item.ai_message
+                    "content": turn["ai_message"],
+                    "turn": turn["id"]
                 })
 
-    # =====================
-    # CHAT LIMIT
-    # =====================
-    now = timezone.now()
-    window_start = now - timedelta(hours=CHAT_LIMIT_HOURS)
-
-    recent_user_messages = History.objects.filter(
-        user=request.user,
-        chat_id=chat_id,
-        created_at__gte=window_start
-    ).exclude(user_message="").exclude(user_message__isnull=True)
-
-    user_message_count = recent_user_messages.count()
-    remaining_messages = max(0, MAX_MESSAGES - user_message_count)
-
-    limit_reached = user_message_count >= MAX_MESSAGES
-    remaining_seconds = 0
-
-    if limit_reached:
-        first_msg = recent_user_messages.first()
-        expiry_time = first_msg.created_at + timedelta(hours=CHAT_LIMIT_HOURS)
-        remaining_seconds = int((expiry_time - now).total_seconds())
-
     # =====================
     # AJAX MESSAGE SEND (NON-STREAM)
     # =====================
     if request.method == "POST" and request.headers.get("X-Requested-With"):
 
-        if limit_reached:
-            return JsonResponse({
-                "limit_reached": True,
-                "remaining_seconds": remaining_seconds
-            })
+        ticket = idempotency.Ticket(idempotency.NONE)
 
         try:
             # ✅ ALWAYS DEFINE FIRST
             message = request.POST.get("message", "").strip()
-            # 🚫 Guardrails check
-            if message and len(message) > 3 and not check_guardrails(message):
-                return JsonResponse({"blocked": True}, status=403)
+            # 🚫 Guardrails check (GUARDRAIL_SPECULATIVE: runs while upstream opens)
+            verdict = None
+            if message and len(message) > 3:
+                verdict = submit_check(message)
+                if not settings.GUARDRAIL_SPECULATIVE and not verdict.result():
+                    return _blocked_response()
 
 
             uploaded_file = request.FILES.get("file")
@@ -122,30 +93,59 @@ def new_chatbot(request):
             if uploaded_file and uploaded_file.size > MAX_IMAGE_SIZE:
                 return JsonResponse({"error": "Image too large"}, status=400)
 
-            image_base64 = request.POST.get("image_base64")
-
-            model = request.POST.get("model", "openai/gpt-4o-mini")
-            chatbot_engine = OpenRouterChatbot(model=model)
+            # =====================
+            # IDEMPOTENCY (retried / double-submitted sends)
+            # =====================
+            ticket = idempotency.begin(
+                request.user.pk,
+                request.headers.get("Idempotency-Key"),
+                _submission_fingerprint(request, chat_id, message, uploaded_file)
+            )
+            if ticket.role not in (idempotency.NONE, idempotency.LEADER):
+                return _duplicate_response(ticket)
+
+            # =====================
+            # CHAT LIMIT (cache-backed quota, per user)
+            # =====================
+            quota_state = quota.reserve(request.user)
+            if not quota_state["allowed"]:
+                return _limit_response(quota_state, "new_chatbot")
+
+            model = request.POST.get("model", DEFAULT_MODEL)
+            chatbot_engine = OpenRouterChatbot(
+                model=model,
+                context_key=f"{request.user.pk}:{chat_id}"
+            )
 
             ai_message = message or "Describe this image"
             file_for_db = None
 
-            if uploaded_file:
-                file_for_db = uploaded_file
+            image_base64 = request.POST.get("image_base64")
 
-                if uploaded_file.content_type.startswith("image"):
-                    image_base64 = base64.b64encode(
-                        uploaded_file.read()
-                    ).decode("utf-8")
-                    uploaded_file.seek(0)
+            try:
+                # 🖼️ Resized, metadata-free data URL for the model
+                if image_base64:
+                    image_base64 = images.normalize_base64(image_base64)
 
-                elif uploaded_file.content_type.startswith("text"):
-                    text = uploaded_file.read().decode(errors="ignore")[:1000]
-                    uploaded_file.seek(0)
-                    ai_message += f"\n\n[Text File]\n{text}"
+                if uploaded_file:
+                    file_for_db = uploaded_file
 
-                else:
-                    ai_message += f"\n\n[File]\n{uploaded_file.name}"
+                    if uploaded_file.content_type.startswith("image"):
+                        image_base64 = images.normalize_upload(uploaded_file)
+
+                    elif uploaded_file.content_type.startswith("text"):
+                        # Whole document indexed; later turns get its best chunks
+                        text = uploaded_file.read(settings.RETRIEVAL_MAX_DOCUMENT_BYTES).decode(errors="ignore")
+                        uploaded_file.seek(0)
+                        retrieval.add_document(f"{request.user.pk}:{chat_id}", uploaded_file.name, text)
+                        ai_message += f"\n\n[Text File]\n{text[:1000]}"
+
+                    else:
+                        ai_message += f"\n\n[File]\n{uploaded_file.name}"
+
+            except images.InvalidImage:
+                quota.release(quota_state)
+                return JsonResponse({"error": "Unsupported image"}, status=400)
 
             form = ChatbotMessageForm(
                 user=request.user,
@@ -155,13 +155,32 @@ def new_chatbot(request):
             )
 
             if not form.is_valid():
+                quota.release(quota_state)
                 return JsonResponse({"error": form.errors}, status=400)
 
+            # =====================
+            # SPECULATIVE UPSTREAM
+            # =====================
+            stream = None
+            if verdict is not None and not verdict.done():
+                stream = _open_speculative(chatbot_engine, form, image_base64)
+
+            if verdict is not None and not verdict.result():
+                if stream is not None:
+                    stream.close()
+                quota.release(quota_state)
+                return _blocked_response()
+
             reply = form.save(
                 bot_engine=chatbot_engine,
                 uploaded_file=uploaded_file,
-                image_base64=image_base64
+                image_base64=image_base64,
+                stream=stream,
+                on_token=ticket.publish
             )
+            # Errors are replied in-band: only a clean reply is kept for retries
+            if reply and not chatbot_engine.failed:
+                ticket.finish(reply)
 
             return JsonResponse({
                 "reply": reply or "",
@@ -175,45 +194,193 @@ def new_chatbot(request):
                 status=500
             )
 
+        finally:
+            # No complete reply: free the key so a retry can run
+            ticket.abort()
+
     # =====================
     # PAGE LOAD
     # =====================
+    quota_state = quota.status(request.user)
+
     return render(request, "root/chatbot.html", {
         "conversation": conversation,
         "profile": profile,
         "chat_id": chat_id,
-        "limit_reached": limit_reached,
-        "remaining_seconds": remaining_seconds,
-        "remaining_messages": remaining_messages,
+        "limit_reached": not quota_state["allowed"],
+        "remaining_seconds": quota_state["retry_after"],
+        "remaining_messages": quota_state["remaining"],
+        "quota_limit": quota_state["limit"],
+        "quota_hours": quota_state["window"] // 3600,
     })
 
 
 # =====================
-# STREAMING VIEW
+# SPECULATIVE HELPERS
+# =====================
+def _open_speculative(chatbot_engine, form, image_base64):
+    try:
+        return chatbot_engine.open_stream(
+            form.cleaned_data.get("message", ""),
+            form.conversation,
+            image_base64
+        )
+    except Exception:
+        # get_response re-opens and reports the error in-band
+        logger.exception("Speculative upstream open failed")
+        return None
+
+
+async def _cancel_upstream(upstream):
+    if upstream is None:
+        return
+
+    if not upstream.done():
+        upstream.cancel()
+        return
+
+    if not upstream.cancelled() and upstream.exception() is None:
+        await upstream.result().close()
+
+
+def _limit_response(quota_state, view):
+    metrics.QUOTA_REJECTIONS.inc(view=view)
+    return JsonResponse({
+        "limit_reached": True,
+        "remaining_seconds": quota_state["retry_after"]
+    }, status=429)
+
+
+# =====================
+# IDEMPOTENCY HELPERS
+# =====================
+def _submission_fingerprint(request, chat_id, message, uploaded_file):
+    return idempotency.fingerprint(
+        chat_id,
+        message,
+        request.POST.get("model", DEFAULT_MODEL),
+        uploaded_file.name if uploaded_file else "",
+        uploaded_file.size if uploaded_file else 0,
+        len(request.POST.get("image_base64", ""))
+    )
+
+
+def _key_error_response(ticket):
+    if ticket.role == idempotency.INVALID:
+        return JsonResponse({"error": "Idempotency-Key too long"}, status=400)
+    return JsonResponse({"error": "Idempotency-Key reused for a different request"}, status=409)
+
+
+def _duplicate_response(ticket):
+    if ticket.role in (idempotency.CONFLICT, idempotency.INVALID):
+        return _key_error_response(ticket)
+
+    # Bounded wait (IDEMPOTENCY_WAIT_SECONDS) so a duplicate does not hold a worker
+    reply = ticket.reply if ticket.role == idempotency.REPLAY else ticket.wait()
+    if reply is None:
+        return JsonResponse({"error": "Original request has not completed, please retry"}, status=409)
+
+    return JsonResponse({
+        "reply": reply,
+        "limit_reached": False,
+        "replayed": True
+    })
+
+
+async def _duplicate_stream(ticket, sse=False):
+    if ticket.role in (idempotency.CONFLICT, idempotency.INVALID):
+        return _key_error_response(ticket)
+
+    # Same process: tail the leader's tokens as they arrive (bounded, see Flight.follow)
+    if ticket.role == idempotency.FOLLOWER and ticket.flight is not None:
+        tokens = ticket.flight.follow()
+        if not sse:
+            tokens = _follow_text(tokens)
+    else:
+        reply = ticket.reply if ticket.role == idempotency.REPLAY else await ticket.await_reply()
+        if reply is None:
+            return StreamingHttpResponse("Original request has not completed, please retry", status=409)
+
+        async def replay():
+            yield reply
+
+        tokens = replay()
+
+    if sse:
+        return streams.event_response(streams.untracked(tokens))
+    return StreamingHttpResponse(tokens, content_type="text/plain")
+
+
+async def _follow_text(tokens):
+    # Plain text stream: the error goes in-band, like event_stream's
+    try:
+        async for token in tokens:
+            yield token
+    except idempotency.LeaderLost as e:
+        yield f"\n[Error]: {e}"
+
+
+def _settle_unread(started, ticket, quota_state):
+    # A stream body that never ran: no reply, no History row, no charge
+    if started:
+        return
+    try:
+        ticket.fail()
+        quota.release(quota_state)
+    except Exception:
+        logger.exception("Could not settle an unread stream")
+
+
+def _blocked_response():
+    metrics.BLOCKED.inc(view="new_chatbot")
+    return JsonResponse({"blocked": True}, status=403)
+
+
+def _blocked_stream_response():
+    metrics.BLOCKED.inc(view="stream_chatbot")
+    return StreamingHttpResponse(
+        '{"blocked": true}',
+        status=403,
+        content_type="application/json"
+    )
+
+
+# =====================
+# STREAMING VIEW (ASYNC)
 # =====================
 @csrf_exempt
 @login_required(login_url="login")
-def stream_chatbot(request):
+@worker_loop.serve
+@metrics.instrument("stream_chatbot")
+async def stream_chatbot(request):
     
     """
     Streaming chatbot response (Server-Sent like plain text stream)
+
+    Async so that under ASGI (chatbox.asgi) an open LLM stream only holds
+    an event-loop task instead of a whole worker. Under WSGI it runs on the
+    process's worker loop and still streams token by token
+    (see chatbox/worker_loop.py).
     """
 
     if request.method != "POST":
         return StreamingHttpResponse("Invalid request", status=405)
 
+    ticket = idempotency.Ticket(idempotency.NONE)
+
     try:
+        user = await request.auser()
+
         # =====================
         # SAFE INPUT HANDLING
         # =====================
         message = request.POST.get("message", "").strip()
-        # 🚫 Guardrails check
-        if message and len(message) > 3 and not check_guardrails(message):
-            return StreamingHttpResponse(
-                '{"blocked": true}',
-                status=403,
-                content_type="application/json"
-            )
+        # 🚫 Guardrails check (worker pool; GUARDRAIL_SPECULATIVE: overlaps upstream open)
+        verdict = None
+        if message and len(message) > 3:
+            verdict = asyncio.ensure_future(acheck_guardrails(message))
+            if not settings.GUARDRAIL_SPECULATIVE and not await verdict:
+                return _blocked_stream_response()
 
 
         chat_id = request.POST.get("chat_id")
@@ -221,77 +388,137 @@ def stream_chatbot(request):
         uploaded_file = request.FILES.get("file")
 
         # Model from frontend
-        model = request.POST.get("model", "openai/gpt-4o-mini")
+        model = request.POST.get("model", DEFAULT_MODEL)
 
         if not chat_id:
             return StreamingHttpResponse("Missing chat_id", status=400)
 
         # =====================
-        # LOAD CHAT HISTORY
+        # IDEMPOTENCY (retried / double-submitted sends)
         # =====================
-        db_history = History.objects.filter(
-            user=request.user,
-            chat_id=chat_id
-        ).only("user_message", "ai_message", "uploaded_file", "created_at") \
-        .order_by("-created_at")[:20]
-
-        db_history = reversed(db_history)
+        ticket = await sync_to_async(idempotency.begin)(
+            user.pk,
+            request.headers.get("Idempotency-Key"),
+            _submission_fingerprint(request, chat_id, message, uploaded_file)
+        )
+        if ticket.role not in (idempotency.NONE, idempotency.LEADER):
+            return await _duplicate_stream(ticket, sse=streams.wants_events(request))
 
+        # =====================
+        # CHAT LIMIT (same quota as new_chatbot)
+        # =====================
+        quota_state = await sync_to_async(quota.reserve)(user)
+        if not quota_state["allowed"]:
+            return _limit_response(quota_state, "stream_chatbot")
 
+        # =====================
+        # LOAD CHAT HISTORY (CACHED, ASYNC ORM ON A MISS)
+        # =====================
         conversation = []
-        for item in db_history:
-            if item.user_message:
+        with metrics.HISTORY_LOAD_SECONDS.time(view="stream_chatbot"):
+            turns = await recent.aget_recent(user.pk, chat_id)
+
+        for turn in turns:
+            if turn["user_message"]:
                 conversation.append({
                     "role": "user",
-                    "content": item.user_message
+                    "content": turn["user_message"],
+                    "turn": turn["id"]
                 })
-            if item.ai_message:
+            if turn["ai_message"]:
                 conversation.append({
                     "role": "assistant",
-                    "content": item.ai_message
+                    "content": turn["ai_message"],
+                    "turn": turn["id"]
                 })
 
         # =====================
         # FILE / IMAGE HANDLING
         # =====================
         final_prompt = message or "[Image]"
-        
-        if uploaded_file:
-            if uploaded_file.content_type.startswith("image"):
-                image_base64 = base64.b64encode(
-                    uploaded_file.read()
-                ).decode("utf-8")
-                uploaded_file.seek(0)
-
-            elif uploaded_file.content_type.startswith("text"):
-                text = uploaded_file.read().decode(errors="ignore")[:1000]
-                uploaded_file.seek(0)
-                final_prompt += f"\n\n[Text File]\n{text}"
-
-            else:
-                final_prompt += f"\n\n[File]\n{uploaded_file.name}"
+
+        try:
+            # 🖼️ Resized, metadata-free data URL (CPU work off the event loop)
+            if image_base64:
+                image_base64 = await sync_to_async(
+                    images.normalize_base64, thread_sensitive=False
+                )(image_base64)
+
+            if uploaded_file:
+                if uploaded_file.content_type.startswith("image"):
+                    image_base64 = await sync_to_async(
+                        images.normalize_upload, thread_sensitive=False
+                    )(uploaded_file)
+
+                elif uploaded_file.content_type.startswith("text"):
+                    text = uploaded_file.read(settings.RETRIEVAL_MAX_DOCUMENT_BYTES).decode(errors="ignore")
+                    uploaded_file.seek(0)
+                    await sync_to_async(retrieval.add_document, thread_sensitive=False)(
+                        f"{user.pk}:{chat_id}", uploaded_file.name, text
+                    )
+                    final_prompt += f"\n\n[Text File]\n{text[:1000]}"
+
+                else:
+                    final_prompt += f"\n\n[File]\n{uploaded_file.name}"
+
+        except images.InvalidImage:
+            await sync_to_async(quota.release)(quota_state)
+            return StreamingHttpResponse("Unsupported image", status=400)
 
         # =====================
         # INIT CHATBOT
         # =====================
-        chatbot_engine = OpenRouterChatbot(model=model)
+        chatbot_engine = AsyncOpenRouterChatbot(
+            model=model,
+            context_key=f"{user.pk}:{chat_id}"
+        )
+
+        # =====================
+        # SPECULATIVE UPSTREAM
+        # =====================
+        upstream = None
+        if verdict is not None and not verdict.done():
+            upstream = asyncio.ensure_future(chatbot_engine.open_stream(
+                final_prompt, conversation, image_base64, model
+            ))
+
+        if verdict is not None and not await verdict:
+            await _cancel_upstream(upstream)
+            await sync_to_async(quota.release)(quota_state)
+            return _blocked_stream_response()
+
+        stream = None
+        if upstream is not None:
+            try:
+                stream = await upstream
+            except Exception:
+                # stream_response re-opens and reports the error in-band
+                logger.exception("Speculative upstream open failed")
 
         # =====================
         # STREAM GENERATOR
         # =====================
-        def event_stream():
+        started = []
+
+        async def event_stream():
+            started.append(True)
             full_reply = ""
+            complete = False
 
             try:
-                for token in chatbot_engine.stream_response(
+                async for token in chatbot_engine.stream_response(
                     user_input=final_prompt,
                     conversation_history=conversation,
                     image_base64=image_base64,
-                    model=model
+                    model=model,
+                    stream=stream
                 ):
                     full_reply += token
+                    ticket.publish(token)
                     yield token
 
+                complete = bool(full_reply) and not chatbot_engine.failed
+
             except Exception as e:
                 yield f"\n\n[Error: {str(e)}]"
 
@@ -299,20 +526,36 @@ def stream_chatbot(request):
                 # =====================
                 # SAVE CHAT HISTORY
                 # =====================
-                def save_history():
-                    History.objects.create(
-                        user=request.user,
-                        chat_id=chat_id,
-                        user_message=message,
-                        ai_message=full_reply,
-                        uploaded_file=uploaded_file
-                    )
+                await sync_to_async(history_writer.submit)(History(
+                    user=user,
+                    chat_id=chat_id,
+                    user_message=message,
+                    ai_message=full_reply,
+                    uploaded_file=uploaded_file,
+                    **chatbot_engine.usage
+                ))
+                # Partial (client gone / cancelled) or failed: retries regenerate
+                if complete:
+                    await sync_to_async(ticket.finish)(full_reply)
+                else:
+                    await sync_to_async(ticket.fail)()
 
-                Thread(target=save_history).start()
 
+        # The generator settles the ticket from here on
+        ticket.hand_off()
+
+        # SSE: generation runs detached and is buffered for Last-Event-ID resume
+        if streams.wants_events(request):
+            return streams.event_response(
+                streams.run(streams.TokenStream(user.pk), event_stream())
+            )
+
+        body = event_stream()
+        # Client gone before the first byte: the body is dropped unread
+        weakref.finalize(body, _settle_unread, started, ticket, quota_state)
 
         return StreamingHttpResponse(
-            event_stream(),
+            body,
             content_type="text/plain"
         )
 
@@ -321,4 +564,31 @@ def stream_chatbot(request):
         return StreamingHttpResponse(
             f"Server error: {str(e)}",
             status=500
-        ) 
\ No newline at end of file
+        )
+
+    finally:
+        await sync_to_async(ticket.abort)()
+
+
+# =====================
+# RESUME A DROPPED STREAM (SSE)
+# =====================
+@login_required(login_url="login")
+@worker_loop.serve
+async def resume_stream(request):
+    """
+    Re-attach to an SSE stream after the event in Last-Event-ID
+    """
+
+    if request.method != "GET":
+        return StreamingHttpResponse("Invalid request", status=405)
+
+    user = await request.auser()
+    last_event_id = request.headers.get("Last-Event-ID") or request.GET.get("last_event_id")
+
+    try:
+        events = await streams.resume(user.pk, last_event_id)
+    except streams.StreamGone as e:
+        return JsonResponse({"error": str(e)}, status=410)
+
+    return streams.event_response(events)
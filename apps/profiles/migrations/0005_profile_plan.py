@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 19:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('profiles', '0004_alter_profile_gender'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='profile',
+            name='plan',
+            field=models.CharField(choices=[('free', 'Free'), ('pro', 'Pro')], default='free', max_length=20),
+        ),
+    ]
@@ -7,6 +7,12 @@ GENDER_CHOICES = (
     ('Other', 'Other'),
 )
 
+# Message quota plans (limits live in settings.CHAT_QUOTA_PLANS)
+PLAN_CHOICES = (
+    ('free', 'Free'),
+    ('pro', 'Pro'),
+)
+
 class Profile(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE)
     mobile = models.CharField(max_length=10, null=True, blank=True)
@@ -17,6 +23,7 @@ class Profile(models.Model):
         null=True,
         blank=True
     )
+    plan = models.CharField(max_length=20, choices=PLAN_CHOICES, default='free')
     
 
     def __str__(self):
@@ -2,6 +2,7 @@ from django.db.models.signals import post_save
 from django.dispatch import receiver
 from django.contrib.auth.models import User
 from apps.profiles.models import Profile
+from apps.newchat.quota import forget_plan
 
 @receiver(post_save, sender=User)
 def create_profile(sender, instance, created, **kwargs):
@@ -11,3 +12,8 @@ def create_profile(sender, instance, created, **kwargs):
 @receiver(post_save, sender=User)
 def save_profile(sender, instance, **kwargs):
     instance.profile.save()
+
+@receiver(post_save, sender=Profile)
+def refresh_quota_plan(sender, instance, **kwargs):
+    # Plan changes take effect on the next message, not after the cache TTL
+    forget_plan(instance.user_id)
@@ -1,8 +1,6 @@
 
 from django.shortcuts import render, redirect
 from django.contrib.auth.decorators import login_required
-from django.conf import settings
-import os
 
 from django.contrib.auth.models import User
 from apps.profiles.models import Profile
@@ -80,9 +78,8 @@ def delete_profile_image(request):
 
         if delete_flag == "1":
             if profile.profile_picture and profile.profile_picture.name != "default/user_img.png":
-                image_path = os.path.join(settings.MEDIA_ROOT, profile.profile_picture.name)
-                if os.path.exists(image_path):
-                    os.remove(image_path)
+                # Through the storage, so shared (deduplicated) bytes stay
+                profile.profile_picture.delete(save=False)
 
             profile.profile_picture = "default/user_img.png"
             profile.save()
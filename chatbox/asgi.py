@@ -3,6 +3,11 @@ ASGI config for Chatbox project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+Serve it with an ASGI server so the async streaming view (``/chatbot/stream/``)
+can hold many concurrent LLM streams per process, e.g.::
+
+    uvicorn chatbox.asgi:application --workers 2
+
 For more information on this file, see
 https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
 """
@@ -11,6 +16,6 @@ import os
 
 from django.core.asgi import get_asgi_application
 
-os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'Chatbox.settings')
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'chatbox.settings')
 
 application = get_asgi_application()
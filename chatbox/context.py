@@ -0,0 +1,255 @@
+"""
+Token-budgeted conversation context for OpenRouterChatbot
+
+Instead of sending the last N History rows verbatim, the builder keeps the
+newest turns that fit the model's token budget (CONTEXT_TOKEN_BUDGETS) and
+replaces everything older with a rolling summary kept in the cache. When
+turns fall out of the window they are folded into the summary by a
+background call, so the summary is extended incrementally rather than
+regenerated on every message.
+
+Messages carry the History id of their row ("turn"); the summary records
+the newest id it covers, and only turns after it are summarized. The window
+leaves the CONTEXT_SUMMARY_BATCH oldest fetched rows out, so turns are
+folded in batches (one LLM call per batch, not per message) before the
+history query stops returning them.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.core.cache import cache
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Per-message framing overhead in the chat format, and a flat estimate for
+# an attached image (low-detail vision input)
+MESSAGE_OVERHEAD_TOKENS = 4
+IMAGE_TOKENS = 850
+
+
+# =====================
+# LOCAL TOKEN COUNTING
+# =====================
+_encoding = None
+_encoding_loaded = False
+
+
+def _get_encoding():
+    global _encoding, _encoding_loaded
+
+    if not _encoding_loaded:
+        _encoding_loaded = True
+        try:
+            import tiktoken
+            _encoding = tiktoken.get_encoding("o200k_base")
+        except Exception:
+            # Not installed / no cached BPE file: fall back to an estimate
+            _encoding = None
+    return _encoding
+
+
+def count_tokens(text):
+    if not text:
+        return 0
+
+    encoding = _get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+
+    # ~4 characters per token for English text
+    return len(text) // 4 + 1
+
+
+def message_tokens(message):
+    content = message["content"]
+
+    if isinstance(content, list):
+        tokens = 0
+        for part in content:
+            if part.get("type") == "text":
+                tokens += count_tokens(part["text"])
+            else:
+                tokens += IMAGE_TOKENS
+    else:
+        tokens = count_tokens(content)
+
+    return tokens + MESSAGE_OVERHEAD_TOKENS
+
+
+def token_budget(model):
+    budgets = settings.CONTEXT_TOKEN_BUDGETS
+    return budgets.get(model, budgets["default"])
+
+
+# =====================
+# ROLLING SUMMARY
+# =====================
+def _summary_key(context_key):
+    return f"context:summary:{context_key}"
+
+
+def forget_summaries(user_id, chat_ids):
+    """
+    Drop the summaries of chats whose History rows were deleted
+    """
+    cache.delete_many([_summary_key(f"{user_id}:{chat_id}") for chat_id in chat_ids])
+
+
+def _uncovered(dropped, record):
+    """
+    Dropped turns newer than the last History row the summary covers
+    """
+    covered = record.get("turn") if record else None
+    if covered is None:
+        return list(dropped)
+
+    # A turn without an id is not written yet, so it is newer than any row
+    return [m for m in dropped if m.get("turn") is None or m["turn"] > covered]
+
+
+def _due(uncovered, history):
+    """
+    Enough new turns for a batch, or the oldest fetched row is among them
+    (the next history query may no longer return it)
+    """
+    if not uncovered:
+        return False
+    rows = {m.get("turn") for m in uncovered}
+    return len(rows) >= settings.CONTEXT_SUMMARY_BATCH or uncovered[0] is history[0]
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _pool():
+    global _executor
+
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="context-summary")
+    return _executor
+
+
+def refresh_summary(context_key, dropped):
+    """
+    Fold newly dropped turns into the cached summary (one LLM call)
+    """
+    key = _summary_key(context_key)
+    lock = f"{key}:lock"
+
+    # One refresh per chat at a time
+    if not cache.add(lock, 1, timeout=120):
+        return
+
+    try:
+        record = cache.get(key)
+        covered = record.get("turn") if record else None
+        new_turns = _uncovered(dropped, record)
+        if not new_turns:
+            return
+
+        transcript = "\n".join(f'{m["role"]}: {m["content"]}' for m in new_turns)
+        previous = record["text"] if record else "(none yet)"
+
+        from chatbox.openrouter_api import get_client
+
+        response = get_client().chat.completions.create(
+            model=settings.CONTEXT_SUMMARY_MODEL,
+            messages=[
+                {
+                    "role": "system",
+                    "content": (
+                        "You maintain a running summary of a helpdesk chat. "
+                        "Merge the new turns into the existing summary. Keep facts, "
+                        "user details, decisions and open questions. Be concise."
+                    )
+                },
+                {
+                    "role": "user",
+                    "content": f"Existing summary:\n{previous}\n\nNew turns:\n{transcript}"
+                },
+            ],
+            temperature=0,
+            max_tokens=settings.CONTEXT_SUMMARY_TOKENS,
+        )
+
+        text = (response.choices[0].message.content or "").strip()
+        ids = [m["turn"] for m in new_turns if m.get("turn") is not None]
+        if text:
+            cache.set(key, {
+                "text": text,
+                "turn": max(ids) if ids else covered,
+            }, timeout=settings.CONTEXT_SUMMARY_TTL)
+
+    except Exception:
+        logger.exception("Context summary refresh failed")
+    finally:
+        cache.delete(lock)
+
+
+# =====================
+# BUILDER
+# =====================
+class ContextBuilder:
+
+    def __init__(self, model, context_key=None):
+        self.model = model
+        self.context_key = context_key
+
+    def fit(self, conversation_history, reserved_tokens):
+        """
+        Split history into (dropped, kept): kept is the newest run of turns
+        that fits the budget left after reserved_tokens
+        """
+        history = list(conversation_history or [])
+        budget = token_budget(self.model) - reserved_tokens - settings.CONTEXT_SUMMARY_TOKENS
+
+        # Always leave the oldest CONTEXT_SUMMARY_BATCH fetched rows out of
+        # the window, so rows are summarized in batches before the history
+        # query stops returning them.
+        max_kept = max(0, 2 * (settings.CONTEXT_HISTORY_ROWS - settings.CONTEXT_SUMMARY_BATCH))
+
+        kept = []
+        used = 0
+        for message in reversed(history):
+            cost = message_tokens(message)
+            if used + cost > budget or len(kept) >= max_kept:
+                break
+            kept.append(message)
+            used += cost
+
+        kept.reverse()
+        return history[:len(history) - len(kept)], kept
+
+    def build(self, system_message, conversation_history, user_message):
+        reserved = (
+            message_tokens(system_message)
+            + message_tokens(user_message)
+            + settings.CONTEXT_REPLY_TOKENS
+        )
+        dropped, kept = self.fit(conversation_history, reserved)
+
+        messages = [system_message]
+
+        if self.context_key:
+            record = cache.get(_summary_key(self.context_key))
+            if record:
+                messages.append({
+                    "role": "system",
+                    "content": f"Summary of the earlier conversation:\n{record['text']}"
+                })
+
+            # Extend the summary off the request path
+            if dropped and _due(_uncovered(dropped, record), conversation_history):
+                _pool().submit(refresh_summary, self.context_key, dropped)
+
+        messages.extend(
+            {"role": message["role"], "content": message["content"]}
+            for message in kept
+        )
+        messages.append(user_message)
+        return messages
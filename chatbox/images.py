@@ -0,0 +1,182 @@
+"""
+Image normalization before an upload is sent to the model
+
+Uploads are sniffed for their real format (not the browser's content type),
+EXIF-rotated, downsized to IMAGE_MAX_DIMENSION, stripped of metadata and
+re-encoded (JPEG at IMAGE_JPEG_QUALITY, PNG when there is transparency).
+The resulting data URL is cached by content hash, so re-sending the same
+image costs one cache read.
+"""
+
+from django.conf import settings
+from django.core.cache import cache
+from io import BytesIO
+import base64
+import binascii
+import hashlib
+import logging
+import threading
+
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+logger = logging.getLogger(__name__)
+
+# Formats the vision endpoint accepts as-is, by Pillow format name
+MIME_TYPES = {
+    "JPEG": "image/jpeg",
+    "PNG": "image/png",
+    "WEBP": "image/webp",
+    "GIF": "image/gif",
+}
+
+# Magic numbers, for payloads that arrive already base64-encoded
+SIGNATURES = (
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+)
+
+
+class InvalidImage(ValueError):
+    pass
+
+
+def sniff_mime(head):
+    for signature, mime in SIGNATURES:
+        if head.startswith(signature):
+            return mime
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    return "image/png"
+
+
+def data_url(image):
+    """
+    data: URL for an image payload (normalized data URL or raw base64)
+    """
+    if image.startswith("data:"):
+        return image
+
+    try:
+        head = base64.b64decode(image[:24])
+    except (binascii.Error, ValueError):
+        head = b""
+    return f"data:{sniff_mime(head)};base64,{image}"
+
+
+# =====================
+# STATS
+# =====================
+_stats_lock = threading.Lock()
+_stats = {
+    "images": 0,
+    "cache_hits": 0,
+    "bytes_in": 0,
+    "bytes_out": 0,
+}
+
+
+def stats():
+    with _stats_lock:
+        return dict(_stats, bytes_saved=_stats["bytes_in"] - _stats["bytes_out"])
+
+
+def _record(bytes_in, bytes_out, hit):
+    with _stats_lock:
+        _stats["images"] += 1
+        _stats["cache_hits"] += int(hit)
+        _stats["bytes_in"] += bytes_in
+        _stats["bytes_out"] += bytes_out
+
+
+# =====================
+# PIPELINE
+# =====================
+def _cache_key(digest):
+    return f"image:normalized:{settings.IMAGE_MAX_DIMENSION}:{settings.IMAGE_JPEG_QUALITY}:{digest}"
+
+
+def _encode(raw):
+    """
+    (mime, bytes) of the normalized image
+    """
+    max_dimension = settings.IMAGE_MAX_DIMENSION
+
+    try:
+        image = Image.open(BytesIO(raw))
+        if image.format not in MIME_TYPES:
+            raise InvalidImage(f"Unsupported image format: {image.format}")
+
+        # JPEG can decode straight to a reduced scale (much cheaper than
+        # decoding full size and resampling)
+        image.draft("RGB", (max_dimension, max_dimension))
+        image = ImageOps.exif_transpose(image)
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError) as e:
+        raise InvalidImage(str(e)) from e
+
+    image.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+
+    has_alpha = image.mode in ("RGBA", "LA") or (
+        image.mode == "P" and "transparency" in image.info
+    )
+
+    # Pixels only: no EXIF/GPS, ICC profile or text chunks survive
+    out = BytesIO()
+    if has_alpha:
+        clean = image.convert("RGBA")
+        clean.info = {}
+        clean.save(out, format="PNG", optimize=True)
+        return "image/png", out.getvalue()
+
+    clean = image.convert("RGB")
+    clean.info = {}
+    clean.save(out, format="JPEG", quality=settings.IMAGE_JPEG_QUALITY, optimize=True)
+    return "image/jpeg", out.getvalue()
+
+
+def normalize(raw):
+    """
+    Normalized data URL for raw image bytes; raises InvalidImage
+    """
+    digest = hashlib.blake2b(raw, digest_size=20).hexdigest()
+    key = _cache_key(digest)
+
+    record = cache.get(key)
+    hit = record is not None
+
+    if not hit:
+        mime, encoded = _encode(raw)
+        record = {
+            "url": f"data:{mime};base64,{base64.b64encode(encoded).decode('ascii')}",
+            "size": len(encoded),
+        }
+        cache.set(key, record, settings.IMAGE_CACHE_TTL)
+
+    _record(len(raw), record["size"], hit)
+    logger.info(
+        "Image %s: %d -> %d bytes (saved %d)%s",
+        digest[:12], len(raw), record["size"], len(raw) - record["size"],
+        " [cached]" if hit else "",
+    )
+    return record["url"]
+
+
+def normalize_upload(uploaded_file):
+    raw = uploaded_file.read()
+    uploaded_file.seek(0)
+    return normalize(raw)
+
+
+def normalize_base64(image_base64):
+    """
+    Same as normalize() for a client-supplied base64 / data URL payload
+    """
+    if image_base64.startswith("data:"):
+        image_base64 = image_base64.partition(",")[2]
+
+    try:
+        raw = base64.b64decode(image_base64, validate=True)
+    except (binascii.Error, ValueError) as e:
+        raise InvalidImage("Invalid base64 image") from e
+    return normalize(raw)
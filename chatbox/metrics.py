@@ -0,0 +1,335 @@
+"""
+Prometheus metrics for the chat path (text exposition format)
+
+Counters and histograms are plain in-process structures (one lock each, a
+dict lookup and a bisect per observation), so instrumenting a request costs
+microseconds. /metrics renders them together with the stats() of the
+caches, the History writer, the OpenRouter pool and the model router.
+Values are per worker process: scrape each worker, not a load balancer.
+"""
+
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.http import Http404, HttpResponse
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+import asyncio
+import hmac
+import math
+import threading
+import time
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+DURATION_BUCKETS = (0.5, 1, 2.5, 5, 10, 20, 40, 80, 160)
+RATE_BUCKETS = (1, 5, 10, 20, 40, 80, 160, 320)
+
+# Label values come from requests (e.g. the posted model); past this many
+# series a metric folds new label sets into "other"
+MAX_SERIES = 200
+
+_registry = []
+
+
+# =====================
+# METRIC TYPES
+# =====================
+class _Metric:
+    type = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}
+        _registry.append(self)
+
+    def _key(self, labels):
+        key = tuple(str(labels.get(label, "")) for label in self.labels)
+        if key not in self._values and len(self._values) >= MAX_SERIES:
+            key = ("other",) * len(self.labels)
+        return key
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type}",
+        ]
+        with self._lock:
+            values = {key: _copy(value) for key, value in self._values.items()}
+        for key, value in sorted(values.items()):
+            lines.extend(self._samples(dict(zip(self.labels, key)), value))
+        return lines
+
+
+def _copy(value):
+    return [list(value[0]), value[1], value[2]] if isinstance(value, list) else value
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self, labels, value):
+        yield f"{self.name}{_labels(labels)} {_number(value)}"
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # per-bucket counts (not cumulative), sum, count
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            if index < len(self.buckets):
+                state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def _samples(self, labels, value):
+        counts, total, count = value
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets, counts):
+            cumulative += bucket_count
+            yield f"{self.name}_bucket{_labels(dict(labels, le=_number(bound)))} {cumulative}"
+        yield f"{self.name}_bucket{_labels(dict(labels, le='+Inf'))} {count}"
+        yield f"{self.name}_sum{_labels(labels)} {_number(total)}"
+        yield f"{self.name}_count{_labels(labels)} {count}"
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    pairs = ",".join(f'{name}="{_escape(value)}"' for name, value in labels.items())
+    return "{" + pairs + "}"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _number(value):
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    if isinstance(value, float) and math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+# =====================
+# CHAT METRICS
+# =====================
+REQUESTS = Counter("chatbox_requests_total", "Chat view requests", ["view"])
+VIEW_SECONDS = Histogram(
+    "chatbox_view_seconds", "Time in the view until the response (or stream) starts", ["view"]
+)
+DB_QUERIES = Counter("chatbox_db_queries_total", "Database queries run by a chat view", ["view"])
+HISTORY_LOAD_SECONDS = Histogram(
+    "chatbox_history_load_seconds", "Loading recent chat turns for the prompt", ["view"]
+)
+BLOCKED = Counter("chatbox_blocked_messages_total", "Messages rejected by guardrails", ["view"])
+QUOTA_REJECTIONS = Counter(
+    "chatbox_quota_rejections_total", "Messages refused by the per-user quota", ["view"]
+)
+
+GUARDRAIL_SECONDS = Histogram(
+    "chatbox_guardrail_seconds", "check_guardrails() time", ["cached"]
+)
+
+TIME_TO_FIRST_TOKEN = Histogram(
+    "chatbox_time_to_first_token_seconds", "Upstream request opened -> first content token", ["model"]
+)
+TOKENS_PER_SECOND = Histogram(
+    "chatbox_tokens_per_second", "Streamed chunks (about one token each) per second after the first",
+    ["model"], buckets=RATE_BUCKETS
+)
+STREAM_SECONDS = Histogram(
+    "chatbox_stream_duration_seconds", "Upstream request opened -> last token", ["model"],
+    buckets=DURATION_BUCKETS
+)
+UPSTREAM_ERRORS = Counter("chatbox_upstream_errors_total", "Failed upstream LLM streams", ["model"])
+
+
+class StreamTimer:
+    """
+    TTFT, throughput and duration of one upstream stream
+    """
+
+    def __init__(self, model, opened_at):
+        self.model = model
+        self.opened_at = opened_at or time.perf_counter()
+        self.first_at = None
+        self.tokens = 0
+        self.ttft_ms = None
+        self.duration_ms = None
+
+    def token(self):
+        if self.first_at is None:
+            self.first_at = time.perf_counter()
+            self.ttft_ms = round((self.first_at - self.opened_at) * 1000)
+            TIME_TO_FIRST_TOKEN.observe(self.first_at - self.opened_at, model=self.model)
+        self.tokens += 1
+
+    def finish(self):
+        if self.first_at is None:
+            return
+        now = time.perf_counter()
+        self.duration_ms = round((now - self.opened_at) * 1000)
+        STREAM_SECONDS.observe(now - self.opened_at, model=self.model)
+        if self.tokens > 1 and now > self.first_at:
+            TOKENS_PER_SECOND.observe((self.tokens - 1) / (now - self.first_at), model=self.model)
+
+
+# =====================
+# PER-VIEW DB QUERIES
+# =====================
+# A wrapper on every connection bumps the counter of the view that is
+# running (a ContextVar, so it follows the request into sync_to_async threads)
+_query_count = ContextVar("chatbox_query_count", default=None)
+
+
+def _count_query(execute, sql, params, many, context):
+    counter = _query_count.get()
+    if counter is not None:
+        counter[0] += 1
+    return execute(sql, params, many, context)
+
+
+def _wrap_connection(connection):
+    if _count_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_count_query)
+
+
+def _on_connection_created(sender, connection, **kwargs):
+    _wrap_connection(connection)
+
+
+def install():
+    connection_created.connect(_on_connection_created, dispatch_uid="chatbox.metrics")
+    for connection in connections.all(initialized_only=True):
+        _wrap_connection(connection)
+
+
+def instrument(view):
+    """
+    View decorator: request count, time to response and DB queries
+    """
+
+    def decorator(func):
+        def begin():
+            return _query_count.set([0]), time.perf_counter()
+
+        def end(state):
+            token, started = state
+            queries = _query_count.get()[0]
+            _query_count.reset(token)
+            REQUESTS.inc(view=view)
+            VIEW_SECONDS.observe(time.perf_counter() - started, view=view)
+            if queries:
+                DB_QUERIES.inc(queries, view=view)
+
+        if asyncio.iscoroutinefunction(func):
+            @wraps(func)
+            async def wrapper(request, *args, **kwargs):
+                state = begin()
+                try:
+                    return await func(request, *args, **kwargs)
+                finally:
+                    end(state)
+        else:
+            @wraps(func)
+            def wrapper(request, *args, **kwargs):
+                state = begin()
+                try:
+                    return func(request, *args, **kwargs)
+                finally:
+                    end(state)
+
+        return wrapper
+
+    return decorator
+
+
+# =====================
+# COMPONENT STATS (GAUGES)
+# =====================
+def _component_stats():
+    from apps.history import writer
+    from chatbox import images, openrouter_api, response_cache, routing, storage
+
+    yield "response_cache", {}, response_cache.stats()
+    yield "images", {}, images.stats()
+    yield "storage", {}, storage.stats()
+    yield "history_writer", {}, writer.stats()
+    yield "openrouter_pool", {}, openrouter_api.pool_stats()
+    for model, values in routing.stats().items():
+        yield "routing", {"model": model}, values
+
+
+def _render_components():
+    series = {}
+    for component, labels, values in _component_stats():
+        for key, value in values.items():
+            if value is None or not isinstance(value, (int, float)):
+                continue
+            series.setdefault(f"chatbox_{component}_{key}", []).append((labels, value))
+
+    lines = []
+    for name, samples in series.items():
+        lines.append(f"# TYPE {name} gauge")
+        lines.extend(f"{name}{_labels(labels)} {_number(value)}" for labels, value in samples)
+    return lines
+
+
+def render():
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    lines.extend(_render_components())
+    return "\n".join(lines) + "\n"
+
+
+# =====================
+# ENDPOINT
+# =====================
+def metrics_view(request):
+    """
+    GET /metrics (Authorization: Bearer METRICS_TOKEN)
+
+    Not served at all without a METRICS_TOKEN, except with DEBUG on.
+    """
+    token = settings.METRICS_TOKEN
+    if not token:
+        if not settings.DEBUG:
+            raise Http404()
+    else:
+        supplied = request.headers.get("Authorization", "").removeprefix("Bearer ").strip()
+        if not hmac.compare_digest(supplied.encode(), token.encode()):
+            return HttpResponse("Forbidden", status=403, content_type="text/plain")
+
+    return HttpResponse(render(), content_type=CONTENT_TYPE)
@@ -1,13 +1,264 @@
 from django.conf import settings
-from openai import OpenAI
+from asgiref.sync import sync_to_async
+from openai import OpenAI, AsyncOpenAI
+import asyncio
+import httpx
 import logging
+import os
+import threading
+import time
+import weakref
+from types import SimpleNamespace
+
+from chatbox.context import ContextBuilder
+from chatbox import images, metrics, response_cache, retrieval, routing, worker_loop
+
+try:
+    import h2  # noqa: F401  (enables HTTP/2 in httpx)
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
 
 logger = logging.getLogger(__name__)
 
+# Overridable so load tests can point at `manage.py fake_openrouter`
+OPENROUTER_BASE_URL = getattr(settings, "OPENROUTER_BASE_URL", "https://openrouter.ai/api/v1")
+DEFAULT_MODEL = "openai/gpt-4o-mini"
+
+
+# =====================
+# SHARED CLIENT REGISTRY
+# =====================
+# One pooled client per process (and one async client per event loop), so
+# keep-alive connections to openrouter.ai are reused across messages and the
+# TLS handshake drops out of time-to-first-token.
+
+_registry_lock = threading.Lock()
+_sync_client = None
+_sync_http_client = None
+_async_clients = weakref.WeakKeyDictionary()
+_async_http_clients = weakref.WeakKeyDictionary()
+
+_pool_stats_lock = threading.Lock()
+_pool_stats = {
+    "requests": 0,
+    "connections_opened": 0,
+}
+
+
+def _count(key):
+    with _pool_stats_lock:
+        _pool_stats[key] += 1
+
+
+def _trace(event_name, info):
+    if event_name == "connection.connect_tcp.complete":
+        _count("connections_opened")
+
+
+async def _atrace(event_name, info):
+    _trace(event_name, info)
+
+
+def _on_request(request):
+    _count("requests")
+    request.extensions["trace"] = _trace
+
+
+async def _aon_request(request):
+    _count("requests")
+    request.extensions["trace"] = _atrace
+
+
+def pool_stats():
+    """
+    Connection-reuse counters for the shared OpenRouter pool
+    """
+    with _pool_stats_lock:
+        stats = dict(_pool_stats)
+
+    stats["connections_reused"] = max(0, stats["requests"] - stats["connections_opened"])
+    stats["http2"] = _use_http2()
+    return stats
+
+
+def _use_http2():
+    return HTTP2_AVAILABLE and getattr(settings, "OPENROUTER_HTTP2", True)
+
+
+def _pool_options():
+    return {
+        "http2": _use_http2(),
+        "limits": httpx.Limits(
+            max_connections=getattr(settings, "OPENROUTER_POOL_MAX_CONNECTIONS", 100),
+            max_keepalive_connections=getattr(settings, "OPENROUTER_POOL_MAX_KEEPALIVE", 20),
+            keepalive_expiry=getattr(settings, "OPENROUTER_KEEPALIVE_EXPIRY", 30.0),
+        ),
+        "timeout": httpx.Timeout(
+            getattr(settings, "OPENROUTER_READ_TIMEOUT", 60.0),
+            connect=getattr(settings, "OPENROUTER_CONNECT_TIMEOUT", 5.0),
+        ),
+    }
+
+
+def get_client():
+    """
+    Process-wide pooled OpenAI client pointed at OpenRouter
+    """
+    global _sync_client, _sync_http_client
+
+    if _sync_client is None:
+        with _registry_lock:
+            if _sync_client is None:
+                _sync_http_client = httpx.Client(
+                    event_hooks={"request": [_on_request]},
+                    **_pool_options()
+                )
+                _sync_client = OpenAI(
+                    api_key=settings.OPENROUTER_API_KEY,
+                    base_url=OPENROUTER_BASE_URL,
+                    http_client=_sync_http_client,
+                )
+    return _sync_client
+
+
+def get_async_client():
+    """
+    Pooled AsyncOpenAI client for the running event loop
+
+    httpx async connections are bound to the loop that opened them, so the
+    pool is kept per loop: the server loop under ASGI, the worker loop
+    (chatbox/worker_loop.py) under WSGI.
+    """
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+
+    if client is None:
+        http_client = httpx.AsyncClient(
+            event_hooks={"request": [_aon_request]},
+            **_pool_options()
+        )
+        client = AsyncOpenAI(
+            api_key=settings.OPENROUTER_API_KEY,
+            base_url=OPENROUTER_BASE_URL,
+            http_client=http_client,
+        )
+        _async_clients[loop] = client
+        _async_http_clients[loop] = http_client
+    return client
+
+
+def _reset_registry():
+    # A forked worker must not share its parent's sockets
+    global _sync_client, _sync_http_client
+    _sync_client = None
+    _sync_http_client = None
+    _async_clients.clear()
+    _async_http_clients.clear()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_registry)
+
+
+def prewarm():
+    """
+    Open keep-alive connections to OpenRouter at worker start
+
+    Warms the sync pool and the async pool of the worker loop, which serves
+    the streaming views under WSGI. Under ASGI the streams use the server
+    loop's pool, which does not exist yet here; it opens on the first stream.
+    """
+    try:
+        get_client()
+        _sync_http_client.head(OPENROUTER_BASE_URL)
+        worker_loop.submit(aprewarm()).result()
+        logger.info("OpenRouter connection pools warmed")
+    except Exception:
+        logger.warning("OpenRouter pre-warm failed", exc_info=True)
+
+
+async def aprewarm():
+    """
+    Open a keep-alive connection in the running loop's async pool
+    """
+    get_async_client()
+    await _async_http_clients[asyncio.get_running_loop()].head(OPENROUTER_BASE_URL)
+
+SYSTEM_PROMPT = (
+    "You are ElixirTechne HelpDesk chatbot. "
+    "Analyze images if provided and reply clearly."
+)
+
+
+def build_messages(user_input, conversation_history, image_base64=None, model=None, context_key=None):
+    """
+    Build the OpenAI-style message list (system + history + user turn)
+
+    History is trimmed to the model's token budget; older turns are
+    replaced by the chat's rolling summary (see chatbox/context.py).
+    Uploaded documents contribute only their best-matching chunks
+    (see chatbox/retrieval.py).
+    """
+    system_message = {
+        "role": "system",
+        "content": SYSTEM_PROMPT
+    }
+
+    # ✅ Relevant chunks of documents uploaded to this chat (top-k only)
+    excerpts = retrieval.retrieve(context_key, user_input)
+    if excerpts:
+        system_message["content"] += (
+            "\n\nExcerpts from documents the user uploaded to this chat:\n\n"
+            + retrieval.format_excerpts(excerpts)
+        )
+
+    # ✅ User message
+    if image_base64:
+        user_message = {
+            "role": "user",
+            "content": [
+                {"type": "text", "text": user_input or "Describe this image"},
+                {
+                    "type": "image_url",
+                    "image_url": {
+                        "url": images.data_url(image_base64)
+                    }
+                }
+            ]
+        }
+    else:
+        user_message = {
+            "role": "user",
+            "content": user_input
+        }
+
+    # ✅ Previous messages (within budget)
+    builder = ContextBuilder(model or DEFAULT_MODEL, context_key=context_key)
+    return builder.build(system_message, conversation_history, user_message)
+
+
+# Cached replies cost no tokens
+NO_TOKENS = SimpleNamespace(prompt_tokens=0, completion_tokens=0)
+
+
+def reply_usage(model, upstream_usage, timer):
+    """
+    History usage fields for one reply (see apps/history/usage.py)
+    """
+    return {
+        "model": model or "",
+        "prompt_tokens": getattr(upstream_usage, "prompt_tokens", None),
+        "completion_tokens": getattr(upstream_usage, "completion_tokens", None),
+        "ttft_ms": timer.ttft_ms if timer else None,
+        "duration_ms": timer.duration_ms if timer else None,
+    }
+
+
 class OpenRouterChatbot:
     
     # TURN OFF STREAMING DATA FUNCTION 
-    def get_response(self, user_input, conversation_history=None, image_base64=None):
+    def get_response(self, user_input, conversation_history=None, image_base64=None, stream=None, on_token=None):
         """
         NON-STREAM RESPONSE (used when streaming OFF)
         """
@@ -18,91 +269,245 @@ class OpenRouterChatbot:
             user_input=user_input,
             conversation_history=conversation_history,
             image_base64=image_base64,
-            model=self.model
+            model=self.model,
+            stream=stream
         ):
             full_reply += token
+            if on_token is not None:
+                on_token(token)
 
         return full_reply
     
     
-    def __init__(self, model=None):
+    def __init__(self, model=None, context_key=None):
         self.api_key = settings.OPENROUTER_API_KEY
 
         # ✅ Default model fallback
-        self.model = model or "openai/gpt-4o-mini"
+        self.model = model or DEFAULT_MODEL
+
+        # ✅ Rolling-summary key for this chat (e.g. "<user_id>:<chat_id>")
+        self.context_key = context_key
+
+        # ✅ Reply-cache key of the last opened request (None = not cacheable)
+        self.cache_key = None
+
+        # ✅ Model that actually served the last request (see chatbox/routing.py)
+        self.served_model = None
+        self.opened_at = None
 
-        self.client = OpenAI(
-            api_key=self.api_key,
-            base_url="https://openrouter.ai/api/v1"
+        # ✅ Tokens / timings of the last reply, as History fields
+        self.usage = {}
+
+        # ✅ Last reply ended in an upstream error (reported in-band)
+        self.failed = False
+
+        # ✅ Shared pooled client (no new TLS handshake per message)
+        self.client = get_client()
+
+    def open_stream(self, user_input, conversation_history, image_base64=None, model=None):
+        """
+        Send the upstream request and return the open stream (tokens unread)
+        """
+        self.opened_at = time.perf_counter()
+        model = model or self.model
+        messages = build_messages(
+            user_input, conversation_history, image_base64,
+            model=model, context_key=self.context_key
         )
 
+        # ✅ Known question in the same context: replay, skip OpenRouter
+        self.cache_key = None
+        self.served_model = model
+        if response_cache.enabled():
+            self.cache_key = response_cache.cache_key(model, messages)
+            reply = response_cache.get(self.cache_key)
+            if reply is not None:
+                return response_cache.CachedStream(reply)
+
+        def create(routed_model):
+            return self.client.chat.completions.create(
+                model=routed_model,
+                messages=messages,
+                temperature=0.2,
+                max_tokens=settings.CONTEXT_REPLY_TOKENS,
+                stream=True,
+                # Final chunk carries token counts (stored per History row)
+                stream_options={"include_usage": True}
+            )
+
+        if not routing.enabled():
+            return create(model)
+
+        # ✅ Fastest healthy equivalent model, hedged / with fallbacks
+        stream = routing.open_routed(create, routing.candidates(model))
+        self.served_model = stream.model
+        return stream
+
     def stream_response(
     self,
     user_input,
     conversation_history,
     image_base64=None,
-    model=None
+    model=None,
+    stream=None
     ):
 
+        timer = None
+        upstream_usage = None
+        self.failed = False
+
         try:
-            messages = [
-                {
-                    "role": "system",
-                    "content": (
-                        "You are ElixirTechne HelpDesk chatbot. "
-                        "Analyze images if provided and reply clearly."
-                    )
-                }
-            ]
+            # ✅ Reuse a stream opened speculatively by the view
+            if stream is None:
+                stream = self.open_stream(user_input, conversation_history, image_base64, model)
+
+            if isinstance(stream, response_cache.CachedStream):
+                upstream_usage = NO_TOKENS
+                yield from stream
+                return
+
+            timer = metrics.StreamTimer(self.served_model, self.opened_at)
+            reply = []
+            for chunk in stream:
+                if getattr(chunk, "usage", None):
+                    upstream_usage = chunk.usage
+                if not chunk.choices:
+                    continue
+
+                delta = chunk.choices[0].delta
+                if delta and delta.content:
+                    timer.token()
+                    reply.append(delta.content)
+                    yield delta.content
+
+            timer.finish()
+            if self.cache_key:
+                response_cache.put(self.cache_key, "".join(reply))
+
+        except Exception as e:
+            logger.exception("Streaming AI error")
+            self.failed = True
+            metrics.UPSTREAM_ERRORS.inc(model=self.served_model or model or self.model)
+            yield f"\n[Error]: {str(e)}"
 
-            # ✅ Previous messages
-            for msg in conversation_history:
-                messages.append({
-                    "role": msg["role"],
-                    "content": msg["content"]
-                })
-
-            # ✅ User message
-            if image_base64:
-                messages.append({
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": user_input or "Describe this image"},
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/png;base64,{image_base64}"
-                            }
-                        }
-                    ]
-                })
-            else:
-                messages.append({
-                    "role": "user",
-                    "content": user_input
-                })
-
-            model = model or self.model
-
-            stream = self.client.chat.completions.create(
-                model=model,
+        finally:
+            self.usage = reply_usage(self.served_model or model or self.model, upstream_usage, timer)
+
+
+class AsyncOpenRouterChatbot:
+    """
+    ASYNC CLIENT (used by the ASGI streaming view)
+
+    Same contract as OpenRouterChatbot, but built on AsyncOpenAI so an
+    open stream only holds an event-loop task, not a worker thread.
+    """
+
+    def __init__(self, model=None, context_key=None):
+        self.api_key = settings.OPENROUTER_API_KEY
+        self.model = model or DEFAULT_MODEL
+        self.context_key = context_key
+        self.cache_key = None
+        self.served_model = None
+        self.opened_at = None
+        self.usage = {}
+        self.failed = False
+        self.client = get_async_client()
+
+    async def get_response(self, user_input, conversation_history=None, image_base64=None, stream=None):
+        full_reply = ""
+
+        async for token in self.stream_response(
+            user_input=user_input,
+            conversation_history=conversation_history,
+            image_base64=image_base64,
+            model=self.model,
+            stream=stream
+        ):
+            full_reply += token
+
+        return full_reply
+
+    async def open_stream(self, user_input, conversation_history, image_base64=None, model=None):
+        self.opened_at = time.perf_counter()
+        model = model or self.model
+        # Cache reads, index loads and tokenizing: keep them off the event loop
+        messages = await sync_to_async(build_messages, thread_sensitive=False)(
+            user_input, conversation_history, image_base64,
+            model=model, context_key=self.context_key
+        )
+
+        self.cache_key = None
+        self.served_model = model
+        if response_cache.enabled():
+            self.cache_key = response_cache.cache_key(model, messages)
+            reply = response_cache.get(self.cache_key)
+            if reply is not None:
+                return response_cache.AsyncCachedStream(reply)
+
+        async def create(routed_model):
+            return await self.client.chat.completions.create(
+                model=routed_model,
                 messages=messages,
                 temperature=0.2,
-                max_tokens=600,
-                stream=True
+                max_tokens=settings.CONTEXT_REPLY_TOKENS,
+                stream=True,
+                # Final chunk carries token counts (stored per History row)
+                stream_options={"include_usage": True}
             )
 
+        if not routing.enabled():
+            return await create(model)
 
-            for chunk in stream:
+        stream = await routing.aopen_routed(create, routing.candidates(model))
+        self.served_model = stream.model
+        return stream
+
+    async def stream_response(
+        self,
+        user_input,
+        conversation_history,
+        image_base64=None,
+        model=None,
+        stream=None
+    ):
+
+        timer = None
+        upstream_usage = None
+        self.failed = False
+
+        try:
+            if stream is None:
+                stream = await self.open_stream(user_input, conversation_history, image_base64, model)
+
+            if isinstance(stream, response_cache.AsyncCachedStream):
+                upstream_usage = NO_TOKENS
+                async for piece in stream:
+                    yield piece
+                return
+
+            timer = metrics.StreamTimer(self.served_model, self.opened_at)
+            reply = []
+            async for chunk in stream:
+                if getattr(chunk, "usage", None):
+                    upstream_usage = chunk.usage
                 if not chunk.choices:
                     continue
 
                 delta = chunk.choices[0].delta
                 if delta and delta.content:
+                    timer.token()
+                    reply.append(delta.content)
                     yield delta.content
 
+            timer.finish()
+            if self.cache_key:
+                response_cache.put(self.cache_key, "".join(reply))
+
         except Exception as e:
-            logger.exception("Streaming AI error")
+            logger.exception("Async streaming AI error")
+            self.failed = True
+            metrics.UPSTREAM_ERRORS.inc(model=self.served_model or model or self.model)
             yield f"\n[Error]: {str(e)}"
 
-
+        finally:
+            self.usage = reply_usage(self.served_model or model or self.model, upstream_usage, timer)
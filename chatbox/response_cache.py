@@ -0,0 +1,160 @@
+"""
+Exact-match reply cache for OpenRouterChatbot (opt-in: RESPONSE_CACHE_ENABLED)
+
+Keyed by model, system prompt, the normalized user message and a hash of the
+context sent with it (kept history, rolling summary, attached image), so a
+cached reply is only reused for the same question asked in the same
+situation - in practice the common first questions of a fresh chat. Entries
+live in a per-process LRU with a TTL; a hit is replayed as a stream of
+word-sized chunks so the views handle it exactly like an upstream stream.
+"""
+
+from collections import OrderedDict
+from django.conf import settings
+import asyncio
+import hashlib
+import json
+import re
+import threading
+import time
+
+_WHITESPACE = re.compile(r"\s+")
+# Roughly the size of the deltas OpenRouter sends (a word plus its spacing)
+_CHUNK = re.compile(r"\s*\S+\s*|\s+")
+
+
+def enabled():
+    return getattr(settings, "RESPONSE_CACHE_ENABLED", False)
+
+
+# =====================
+# KEY
+# =====================
+def normalize(text):
+    text = _WHITESPACE.sub(" ", (text or "").strip().lower())
+    return text.rstrip(" ?!.")
+
+
+def _digest(value):
+    return hashlib.blake2b(value.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def cache_key(model, messages):
+    """
+    Key for an OpenAI-style message list (system prompt first, user turn last)
+    """
+    system, context, user = messages[0], messages[1:-1], messages[-1]
+
+    content = user["content"]
+    if isinstance(content, list):
+        text = " ".join(part["text"] for part in content if part.get("type") == "text")
+        images = [part["image_url"]["url"] for part in content if part.get("type") == "image_url"]
+    else:
+        text, images = content, []
+
+    context_hash = _digest(json.dumps(
+        {
+            "context": [[m["role"], m["content"]] for m in context],
+            "images": [_digest(url) for url in images],
+        },
+        sort_keys=True,
+    ))
+
+    return _digest("\x1f".join([model, system["content"], normalize(text), context_hash]))
+
+
+# =====================
+# STORE (PER-PROCESS LRU + TTL)
+# =====================
+_entries = OrderedDict()
+_lock = threading.Lock()
+_stats = {
+    "hits": 0,
+    "misses": 0,
+    "stores": 0,
+    "evictions": 0,
+}
+
+
+def get(key):
+    now = time.monotonic()
+
+    with _lock:
+        entry = _entries.get(key)
+        if entry is not None and entry[0] > now:
+            _entries.move_to_end(key)
+            _stats["hits"] += 1
+            return entry[1]
+
+        if entry is not None:
+            del _entries[key]
+            _stats["evictions"] += 1
+        _stats["misses"] += 1
+        return None
+
+
+def put(key, reply):
+    if not reply:
+        return
+
+    expires = time.monotonic() + settings.RESPONSE_CACHE_TTL
+
+    with _lock:
+        _entries[key] = (expires, reply)
+        _entries.move_to_end(key)
+        _stats["stores"] += 1
+
+        while len(_entries) > settings.RESPONSE_CACHE_SIZE:
+            _entries.popitem(last=False)
+            _stats["evictions"] += 1
+
+
+def clear():
+    with _lock:
+        _entries.clear()
+
+
+def stats():
+    with _lock:
+        lookups = _stats["hits"] + _stats["misses"]
+        return dict(
+            _stats,
+            entries=len(_entries),
+            hit_ratio=round(_stats["hits"] / lookups, 3) if lookups else 0.0,
+        )
+
+
+# =====================
+# REPLAY
+# =====================
+def chunks(reply):
+    return _CHUNK.findall(reply)
+
+
+class CachedStream:
+    """
+    Stands in for an open upstream stream when the reply is cached
+    """
+
+    def __init__(self, reply):
+        self.reply = reply
+
+    def __iter__(self):
+        return iter(chunks(self.reply))
+
+    def close(self):
+        pass
+
+
+class AsyncCachedStream(CachedStream):
+
+    async def __aiter__(self):
+        delay = settings.RESPONSE_CACHE_CHUNK_DELAY_MS / 1000
+
+        for piece in chunks(self.reply):
+            yield piece
+            if delay:
+                await asyncio.sleep(delay)
+
+    async def close(self):
+        pass
@@ -0,0 +1,270 @@
+"""
+Local retrieval over text documents uploaded to a chat
+
+Uploaded text is split into overlapping chunks and embedded with hashed
+TF-IDF (hashing trick, no vocabulary, CPU/NumPy only). Each chat keeps one
+index file holding the chunk vectors in CSR form (indptr / indices / values)
+plus the chunk texts. On every turn the user message is scored against the
+index and only the top RETRIEVAL_TOP_K chunks go into the prompt, so prompt
+size stays flat however large the documents are.
+
+Indexes are keyed by the chatbot's context_key ("<user_id>:<chat_id>").
+"""
+
+from collections import OrderedDict
+from django.conf import settings
+import hashlib
+import logging
+import os
+import re
+import tempfile
+import threading
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+_TOKEN = re.compile(r"[a-z0-9]+")
+_BREAK = re.compile(r"\n\s*\n|(?<=[.!?])\s+|\n")
+
+
+# =====================
+# CHUNKING / EMBEDDING
+# =====================
+def chunk_text(text, size=None, overlap=None):
+    """
+    ~size character chunks, cut at paragraph/sentence/line breaks
+    """
+    size = size or settings.RETRIEVAL_CHUNK_CHARS
+    overlap = settings.RETRIEVAL_CHUNK_OVERLAP if overlap is None else overlap
+    text = text.strip()
+
+    chunks = []
+    start = 0
+    while start < len(text):
+        end = min(len(text), start + size)
+
+        if end < len(text):
+            # Last break in the second half of the window
+            breaks = [m.end() for m in _BREAK.finditer(text, start + size // 2, end)]
+            if breaks:
+                end = breaks[-1]
+
+        chunk = text[start:end].strip()
+        if chunk:
+            chunks.append(chunk)
+        if end >= len(text):
+            break
+        start = max(end - overlap, start + 1)
+
+    return chunks
+
+
+def _hash(token, dimensions):
+    digest = hashlib.blake2b(token.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "little") % dimensions
+
+
+def term_frequencies(text, dimensions):
+    """
+    (indices, values): sublinear TF of the hashed unigrams and bigrams
+    """
+    tokens = _TOKEN.findall(text.lower())
+    terms = tokens + [f"{a} {b}" for a, b in zip(tokens, tokens[1:])]
+    if not terms:
+        return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.float32)
+
+    hashed = np.fromiter((_hash(term, dimensions) for term in terms), dtype=np.int32, count=len(terms))
+    indices, counts = np.unique(hashed, return_counts=True)
+    return indices.astype(np.int32), (1.0 + np.log(counts)).astype(np.float32)
+
+
+# =====================
+# INDEX
+# =====================
+class ChunkIndex:
+
+    def __init__(self, dimensions, indptr=None, indices=None, values=None, texts=None, sources=None):
+        self.dimensions = dimensions
+        self.indptr = indptr if indptr is not None else np.zeros(1, dtype=np.int64)
+        self.indices = indices if indices is not None else np.empty(0, dtype=np.int32)
+        self.values = values if values is not None else np.empty(0, dtype=np.float32)
+        self.texts = texts or []
+        self.sources = sources or []
+
+    def __len__(self):
+        return len(self.texts)
+
+    def add(self, source, text):
+        chunks = chunk_text(text)
+        rows = [term_frequencies(chunk, self.dimensions) for chunk in chunks]
+        if not rows:
+            return 0
+
+        lengths = np.array([len(indices) for indices, _ in rows], dtype=np.int64)
+        self.indptr = np.concatenate([self.indptr, self.indptr[-1] + np.cumsum(lengths)])
+        self.indices = np.concatenate([self.indices] + [indices for indices, _ in rows])
+        self.values = np.concatenate([self.values] + [values for _, values in rows])
+        self.texts.extend(chunks)
+        self.sources.extend([source] * len(chunks))
+        return len(chunks)
+
+    def search(self, query, k):
+        """
+        [(score, source, text)] of the k best chunks with a positive score
+        """
+        if not self.texts:
+            return []
+
+        q_indices, q_values = term_frequencies(query, self.dimensions)
+        if not len(q_indices):
+            return []
+
+        # Smoothed IDF over this chat's chunks
+        n = len(self.texts)
+        df = np.bincount(self.indices, minlength=self.dimensions)
+        idf = (np.log((1 + n) / (1 + df)) + 1).astype(np.float32)
+
+        query_vector = np.zeros(self.dimensions, dtype=np.float32)
+        query_vector[q_indices] = q_values * idf[q_indices]
+        query_vector /= np.linalg.norm(query_vector) or 1.0
+
+        weighted = self.values * idf[self.indices]
+        row = np.repeat(np.arange(n), np.diff(self.indptr))
+        dots = np.bincount(row, weights=weighted * query_vector[self.indices], minlength=n)
+        norms = np.sqrt(np.bincount(row, weights=weighted * weighted, minlength=n))
+        scores = dots / np.where(norms > 0, norms, 1.0)
+
+        k = min(k, n)
+        best = np.argpartition(-scores, k - 1)[:k]
+        best = best[np.argsort(-scores[best])]
+        return [
+            (float(scores[i]), self.sources[i], self.texts[i])
+            for i in best if scores[i] > 0
+        ]
+
+    # =====================
+    # PERSISTENCE (.npz, no pickle)
+    # =====================
+    def save(self, path):
+        encoded = [text.encode("utf-8") for text in self.texts]
+        offsets = np.cumsum([0] + [len(b) for b in encoded]).astype(np.int64)
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".npz")
+        with os.fdopen(fd, "wb") as f:
+            np.savez_compressed(
+                f,
+                dimensions=np.array([self.dimensions]),
+                indptr=self.indptr,
+                indices=self.indices,
+                values=self.values.astype(np.float16),
+                text_data=np.frombuffer(b"".join(encoded), dtype=np.uint8),
+                text_offsets=offsets,
+                sources=np.array(self.sources, dtype=np.str_),
+            )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as data:
+            raw = data["text_data"].tobytes()
+            offsets = data["text_offsets"]
+            texts = [
+                raw[offsets[i]:offsets[i + 1]].decode("utf-8")
+                for i in range(len(offsets) - 1)
+            ]
+            return cls(
+                int(data["dimensions"][0]),
+                indptr=data["indptr"],
+                indices=data["indices"],
+                values=data["values"].astype(np.float32),
+                texts=texts,
+                sources=[str(source) for source in data["sources"]],
+            )
+
+
+# =====================
+# PER-CHAT INDEXES
+# =====================
+_loaded = OrderedDict()
+_lock = threading.Lock()
+_write_lock = threading.Lock()
+LOADED_INDEXES = 64
+
+
+def index_path(key):
+    safe = re.sub(r"[^A-Za-z0-9_-]", "_", str(key))
+    return os.path.join(settings.RETRIEVAL_INDEX_DIR, f"{safe}.npz")
+
+
+def _get(key):
+    path = index_path(key)
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+    with _lock:
+        cached = _loaded.get(path)
+        if cached and cached[0] == mtime:
+            _loaded.move_to_end(path)
+            return cached[1]
+
+    index = ChunkIndex.load(path)
+    with _lock:
+        _loaded[path] = (mtime, index)
+        _loaded.move_to_end(path)
+        while len(_loaded) > LOADED_INDEXES:
+            _loaded.popitem(last=False)
+    return index
+
+
+def add_document(key, name, text):
+    """
+    Chunk, embed and append a document to the chat's index; returns chunks added
+    """
+    path = index_path(key)
+
+    with _write_lock:
+        # Fresh copy: the loaded one may be in use by a search
+        index = ChunkIndex.load(path) if os.path.exists(path) else ChunkIndex(settings.RETRIEVAL_DIMENSIONS)
+        added = index.add(name, text)
+        if added:
+            index.save(path)
+    logger.info("Indexed %s for %s: %d chunks (%d total)", name, key, added, len(index))
+    return added
+
+
+def retrieve(key, query, k=None):
+    if not key:
+        return []
+
+    try:
+        index = _get(key)
+    except Exception:
+        logger.exception("Could not load retrieval index for %s", key)
+        return []
+
+    if index is None:
+        return []
+    return index.search(query or "", k or settings.RETRIEVAL_TOP_K)
+
+
+def drop(user_id, chat_ids):
+    """
+    Remove the indexes of deleted chats
+    """
+    for chat_id in chat_ids:
+        key = f"{user_id}:{chat_id}"
+        path = index_path(key)
+        with _lock:
+            _loaded.pop(path, None)
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def format_excerpts(results):
+    return "\n\n".join(f"[{source}]\n{text}" for _, source, text in results)
@@ -0,0 +1,370 @@
+"""
+Latency-aware model routing (used by chatbox/openrouter_api.py)
+
+Off by default (ROUTING_ENABLED, MODEL_ROUTES). A requested model that
+belongs to a MODEL_ROUTES group is served by the group member with the best
+time-to-first-token, weighted by its recent error rate (both EWMAs, per
+process); alternates without samples never win over the requested model. If the first token is late
+(ROUTING_HEDGE_MS) a hedged request goes to the next member and whichever
+starts streaming first wins; the loser is closed. A model that errors or
+sends nothing within ROUTING_FIRST_TOKEN_TIMEOUT falls through to the next
+member of the chain.
+
+Routing only ever sees the upstream stream up to its first content chunk;
+after that the caller reads it as usual.
+"""
+
+from django.conf import settings
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import asyncio
+import logging
+import math
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def enabled():
+    return settings.ROUTING_ENABLED
+
+
+# =====================
+# PER-MODEL HEALTH (EWMA)
+# =====================
+_lock = threading.Lock()
+_models = {}
+
+
+def _entry(model):
+    entry = _models.get(model)
+    if entry is None:
+        entry = _models[model] = {
+            "ttft_ms": None,
+            "error_rate": 0.0,
+            "requests": 0,
+            "errors": 0,
+            "hedges": 0,
+            "hedge_wins": 0,
+        }
+    return entry
+
+
+def record_success(model, ttft_ms, hedged=False):
+    alpha = settings.ROUTING_EWMA_ALPHA
+    with _lock:
+        entry = _entry(model)
+        entry["requests"] += 1
+        entry["hedge_wins"] += int(hedged)
+        entry["error_rate"] += alpha * (0.0 - entry["error_rate"])
+        if entry["ttft_ms"] is None:
+            entry["ttft_ms"] = ttft_ms
+        else:
+            entry["ttft_ms"] += alpha * (ttft_ms - entry["ttft_ms"])
+
+
+def record_error(model):
+    alpha = settings.ROUTING_EWMA_ALPHA
+    with _lock:
+        entry = _entry(model)
+        entry["requests"] += 1
+        entry["errors"] += 1
+        entry["error_rate"] += alpha * (1.0 - entry["error_rate"])
+
+
+def _record_hedge(model):
+    with _lock:
+        _entry(model)["hedges"] += 1
+
+
+def _score(model, requested):
+    entry = _models.get(model)
+    if entry is None or entry["ttft_ms"] is None:
+        # Unmeasured: the requested model goes first, an alternate only after
+        # the measured ones (it gets samples as a hedge or fallback)
+        return 0.0 if model == requested else math.inf
+    return entry["ttft_ms"] * (1 + settings.ROUTING_ERROR_PENALTY * entry["error_rate"])
+
+
+def candidates(model):
+    """
+    Models to try for a request for `model`, best first
+    """
+    group = None
+    for name, members in settings.MODEL_ROUTES.items():
+        if model == name or model in members:
+            group = [name] + [member for member in members if member != name]
+            break
+
+    if not group:
+        return [model]
+
+    # Requested model first so it wins ties
+    ordered = [model] + [member for member in group if member != model]
+    with _lock:
+        return sorted(ordered, key=lambda member: _score(member, model))
+
+
+def stats():
+    with _lock:
+        return {model: dict(entry) for model, entry in _models.items()}
+
+
+# =====================
+# PRIMED STREAMS
+# =====================
+def _is_content(chunk):
+    return bool(chunk.choices) and bool(chunk.choices[0].delta and chunk.choices[0].delta.content)
+
+
+class PrimedStream:
+    """
+    An upstream stream whose first chunks were already read by the router
+    """
+
+    def __init__(self, model, head, stream, chunks):
+        self.model = model
+        self.head = head
+        self.stream = stream
+        self.chunks = chunks
+
+    def __iter__(self):
+        yield from self.head
+        try:
+            yield from self.chunks
+        except Exception:
+            record_error(self.model)
+            raise
+
+    def close(self):
+        self.stream.close()
+
+
+class AsyncPrimedStream:
+
+    def __init__(self, model, head, stream, chunks):
+        self.model = model
+        self.head = head
+        self.stream = stream
+        self.chunks = chunks
+
+    async def __aiter__(self):
+        for chunk in self.head:
+            yield chunk
+        try:
+            async for chunk in self.chunks:
+                yield chunk
+        except Exception:
+            record_error(self.model)
+            raise
+
+    async def close(self):
+        await self.stream.close()
+
+
+def _prime(create, model):
+    started = time.monotonic()
+    stream = create(model)
+    # One iterator, so the caller carries on where we stopped
+    chunks = iter(stream)
+    head = []
+    try:
+        for chunk in chunks:
+            head.append(chunk)
+            if _is_content(chunk):
+                break
+    except BaseException:
+        stream.close()
+        raise
+    return PrimedStream(model, head, stream, chunks), (time.monotonic() - started) * 1000
+
+
+async def _aprime(create, model):
+    started = time.monotonic()
+    stream = await create(model)
+    chunks = aiter(stream)
+    head = []
+    try:
+        async for chunk in chunks:
+            head.append(chunk)
+            if _is_content(chunk):
+                break
+    except BaseException:
+        await stream.close()
+        raise
+    return AsyncPrimedStream(model, head, stream, chunks), (time.monotonic() - started) * 1000
+
+
+class NoModelAvailable(Exception):
+    pass
+
+
+# =====================
+# SYNC ROUTER
+# =====================
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _pool():
+    global _executor
+
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=settings.ROUTING_WORKERS,
+                    thread_name_prefix="model-router"
+                )
+    return _executor
+
+
+def _reset_pool():
+    global _executor
+    _executor = None
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_pool)
+
+
+def _discard(future):
+    # Loser / abandoned attempt: close its stream whenever it shows up
+    def close(done):
+        if not done.cancelled() and done.exception() is None:
+            done.result()[0].close()
+    future.add_done_callback(close)
+
+
+def open_routed(create, models):
+    """
+    create(model) opens an upstream stream; returns a PrimedStream
+    """
+    hedge_after = settings.ROUTING_HEDGE_MS / 1000
+    first_token_timeout = settings.ROUTING_FIRST_TOKEN_TIMEOUT
+
+    pending = list(models)
+    running = {}
+    last_error = None
+
+    def launch(hedged=False):
+        model = pending.pop(0)
+        if hedged:
+            _record_hedge(model)
+        running[_pool().submit(_prime, create, model)] = (model, time.monotonic(), hedged)
+
+    launch()
+    while running:
+        oldest = min(started for _, started, _ in running.values())
+        deadline = oldest + first_token_timeout
+        hedge_at = oldest + hedge_after if hedge_after and pending and len(running) == 1 else None
+        timeout = max(0, min(filter(None, [deadline, hedge_at])) - time.monotonic())
+
+        done, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+
+        for future in done:
+            model, _, hedged = running.pop(future)
+            try:
+                stream, ttft_ms = future.result()
+            except Exception as e:
+                logger.warning("Model %s failed before its first token: %s", model, e)
+                record_error(model)
+                last_error = e
+                continue
+
+            record_success(model, ttft_ms, hedged)
+            for loser in running:
+                _discard(loser)
+            return stream
+
+        now = time.monotonic()
+        if not done and now >= deadline:
+            # Nothing within the first-token timeout: give up on them all
+            for future, (model, _, _) in list(running.items()):
+                logger.warning("Model %s sent no token in %ss", model, first_token_timeout)
+                record_error(model)
+                _discard(future)
+            running.clear()
+            last_error = TimeoutError("No first token in time")
+        elif not done and hedge_at is not None and now >= hedge_at:
+            launch(hedged=True)
+
+        if not running and pending:
+            launch()
+
+    raise NoModelAvailable(f"All models failed: {', '.join(models)}") from last_error
+
+
+# =====================
+# ASYNC ROUTER
+# =====================
+async def _adiscard(task):
+    task.cancel()
+    try:
+        stream, _ = await task
+    except BaseException:
+        return
+    await stream.close()
+
+
+async def aopen_routed(create, models):
+    """
+    Async open_routed; the loser of a hedge is cancelled, not just closed
+    """
+    hedge_after = settings.ROUTING_HEDGE_MS / 1000
+    first_token_timeout = settings.ROUTING_FIRST_TOKEN_TIMEOUT
+    loop = asyncio.get_running_loop()
+
+    pending = list(models)
+    running = {}
+    last_error = None
+
+    def launch(hedged=False):
+        model = pending.pop(0)
+        if hedged:
+            _record_hedge(model)
+        running[asyncio.ensure_future(_aprime(create, model))] = (model, loop.time(), hedged)
+
+    launch()
+    try:
+        while running:
+            oldest = min(started for _, started, _ in running.values())
+            deadline = oldest + first_token_timeout
+            hedge_at = oldest + hedge_after if hedge_after and pending and len(running) == 1 else None
+            timeout = max(0, min(filter(None, [deadline, hedge_at])) - loop.time())
+
+            done, _ = await asyncio.wait(running, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+
+            for task in done:
+                model, _, hedged = running.pop(task)
+                try:
+                    stream, ttft_ms = task.result()
+                except Exception as e:
+                    logger.warning("Model %s failed before its first token: %s", model, e)
+                    record_error(model)
+                    last_error = e
+                    continue
+
+                record_success(model, ttft_ms, hedged)
+                return stream
+
+            now = loop.time()
+            if not done and now >= deadline:
+                for task, (model, _, _) in list(running.items()):
+                    logger.warning("Model %s sent no token in %ss", model, first_token_timeout)
+                    record_error(model)
+                    await _adiscard(task)
+                running.clear()
+                last_error = TimeoutError("No first token in time")
+            elif not done and hedge_at is not None and now >= hedge_at:
+                launch(hedged=True)
+
+            if not running and pending:
+                launch()
+    finally:
+        # Hedge losers, or everything if we were cancelled ourselves
+        for task in running:
+            await _adiscard(task)
+
+    raise NoModelAvailable(f"All models failed: {', '.join(models)}") from last_error
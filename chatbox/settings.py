@@ -30,6 +30,118 @@ DEBUG = env.bool("DEBUG")
 
 OPENROUTER_API_KEY = env("OPENROUTER_API_KEY")
 OPENROUTER_MODEL = env("OPENROUTER_MODEL", default="oopenai/gpt-4.1-mini")
+# Point at a local `manage.py fake_openrouter` for load tests
+OPENROUTER_BASE_URL = env("OPENROUTER_BASE_URL", default="https://openrouter.ai/api/v1")
+
+# OpenRouter connection pool (shared per worker process)
+OPENROUTER_HTTP2 = env.bool("OPENROUTER_HTTP2", default=True)
+OPENROUTER_POOL_MAX_CONNECTIONS = env.int("OPENROUTER_POOL_MAX_CONNECTIONS", default=100)
+OPENROUTER_POOL_MAX_KEEPALIVE = env.int("OPENROUTER_POOL_MAX_KEEPALIVE", default=20)
+OPENROUTER_KEEPALIVE_EXPIRY = env.float("OPENROUTER_KEEPALIVE_EXPIRY", default=30.0)
+OPENROUTER_CONNECT_TIMEOUT = env.float("OPENROUTER_CONNECT_TIMEOUT", default=5.0)
+OPENROUTER_READ_TIMEOUT = env.float("OPENROUTER_READ_TIMEOUT", default=60.0)
+OPENROUTER_PREWARM = env.bool("OPENROUTER_PREWARM", default=True)
+
+# Model routing (see chatbox/routing.py): a request for a group's model is
+# served by the fastest healthy member, falling through the rest on failure.
+# Opt-in: it may answer with a model other than the one the user picked, e.g.
+# MODEL_ROUTES='{"openai/gpt-4o-mini": ["google/gemini-2.0-flash-001"]}'
+ROUTING_ENABLED = env.bool("ROUTING_ENABLED", default=False)
+MODEL_ROUTES = env.json("MODEL_ROUTES", default={})
+# Hedge to the next model when the first token is this late (0 = never)
+ROUTING_HEDGE_MS = env.int("ROUTING_HEDGE_MS", default=0)
+ROUTING_FIRST_TOKEN_TIMEOUT = env.float("ROUTING_FIRST_TOKEN_TIMEOUT", default=20.0)
+ROUTING_EWMA_ALPHA = env.float("ROUTING_EWMA_ALPHA", default=0.2)
+# Score = ttft_ms * (1 + penalty * error_rate)
+ROUTING_ERROR_PENALTY = env.float("ROUTING_ERROR_PENALTY", default=4.0)
+ROUTING_WORKERS = env.int("ROUTING_WORKERS", default=16)
+
+# Prometheus scrape endpoint /metrics (see chatbox/metrics.py); scrapers
+# send "Authorization: Bearer <METRICS_TOKEN>". Unset = 404 (unless DEBUG)
+METRICS_TOKEN = env("METRICS_TOKEN", default="")
+
+# Conversation context sent to the model (see chatbox/context.py)
+CONTEXT_HISTORY_ROWS = env.int("CONTEXT_HISTORY_ROWS", default=20)
+CONTEXT_TOKEN_BUDGETS = {
+    "default": 4000,
+    "openai/gpt-4o-mini": 8000,
+}
+CONTEXT_REPLY_TOKENS = 600
+CONTEXT_SUMMARY_MODEL = env("CONTEXT_SUMMARY_MODEL", default="openai/gpt-4o-mini")
+CONTEXT_SUMMARY_TOKENS = 300
+# History rows folded into the summary per background call
+CONTEXT_SUMMARY_BATCH = env.int("CONTEXT_SUMMARY_BATCH", default=4)
+CONTEXT_SUMMARY_TTL = 7 * 24 * 3600
+
+# Exact-match reply cache (see chatbox/response_cache.py); off unless enabled
+RESPONSE_CACHE_ENABLED = env.bool("RESPONSE_CACHE_ENABLED", default=False)
+RESPONSE_CACHE_TTL = env.int("RESPONSE_CACHE_TTL", default=6 * 3600)
+RESPONSE_CACHE_SIZE = env.int("RESPONSE_CACHE_SIZE", default=2048)
+# Pause between replayed chunks so a cached reply still streams like a live one
+RESPONSE_CACHE_CHUNK_DELAY_MS = env.int("RESPONSE_CACHE_CHUNK_DELAY_MS", default=15)
+
+# Images sent to the model (see chatbox/images.py)
+IMAGE_MAX_DIMENSION = env.int("IMAGE_MAX_DIMENSION", default=1536)
+IMAGE_JPEG_QUALITY = env.int("IMAGE_JPEG_QUALITY", default=85)
+IMAGE_CACHE_TTL = env.int("IMAGE_CACHE_TTL", default=3600)
+
+# Retrieval over uploaded text documents (see chatbox/retrieval.py)
+RETRIEVAL_INDEX_DIR = env("RETRIEVAL_INDEX_DIR", default=str(BASE_DIR / "var" / "retrieval"))
+RETRIEVAL_DIMENSIONS = env.int("RETRIEVAL_DIMENSIONS", default=2 ** 18)
+RETRIEVAL_CHUNK_CHARS = env.int("RETRIEVAL_CHUNK_CHARS", default=800)
+RETRIEVAL_CHUNK_OVERLAP = env.int("RETRIEVAL_CHUNK_OVERLAP", default=100)
+RETRIEVAL_TOP_K = env.int("RETRIEVAL_TOP_K", default=4)
+RETRIEVAL_MAX_DOCUMENT_BYTES = env.int("RETRIEVAL_MAX_DOCUMENT_BYTES", default=5 * 1024 * 1024)
+
+# Background History writer (see apps/history/writer.py); off = insert inline
+HISTORY_WRITER_ENABLED = env.bool("HISTORY_WRITER_ENABLED", default=True)
+HISTORY_WRITER_WORKERS = env.int("HISTORY_WRITER_WORKERS", default=1)
+HISTORY_WRITER_QUEUE_SIZE = env.int("HISTORY_WRITER_QUEUE_SIZE", default=2000)
+HISTORY_WRITER_BATCH_SIZE = env.int("HISTORY_WRITER_BATCH_SIZE", default=100)
+HISTORY_WRITER_FLUSH_MS = env.int("HISTORY_WRITER_FLUSH_MS", default=50)
+HISTORY_WRITER_DRAIN_SECONDS = env.float("HISTORY_WRITER_DRAIN_SECONDS", default=10.0)
+
+# Idempotency-Key handling (see apps/newchat/idempotency.py): finished replies
+# are replayed for IDEMPOTENCY_TTL; an unfinished claim expires after PENDING
+# without a new token; a duplicate waits at most WAIT for the result (or, when
+# tailing the leader live, for its next token), then gets a 409 / error event
+IDEMPOTENCY_TTL = env.int("IDEMPOTENCY_TTL", default=24 * 3600)
+IDEMPOTENCY_PENDING_SECONDS = env.int("IDEMPOTENCY_PENDING_SECONDS", default=120)
+IDEMPOTENCY_WAIT_SECONDS = env.float("IDEMPOTENCY_WAIT_SECONDS", default=5.0)
+
+# SSE stream replay buffer (see apps/newchat/streams.py): last N events per
+# stream, written to the cache at most every STREAM_FLUSH_MS
+STREAM_BUFFER_EVENTS = env.int("STREAM_BUFFER_EVENTS", default=4096)
+STREAM_BUFFER_TTL = env.int("STREAM_BUFFER_TTL", default=600)
+STREAM_FLUSH_MS = env.int("STREAM_FLUSH_MS", default=100)
+
+# Message quota: sliding window per user, counted in the cache (no DB queries)
+# "daily_tokens": prompt + completion tokens per local day (None = no cap)
+CHAT_QUOTA_PLANS = {
+    "free": {"messages": 10, "hours": 24, "daily_tokens": 100_000},
+    "pro": {"messages": 200, "hours": 24, "daily_tokens": 2_000_000},
+}
+# Window resolution: a 24h window is tracked as 24 hourly buckets
+CHAT_QUOTA_BUCKETS = env.int("CHAT_QUOTA_BUCKETS", default=24)
+
+# Guardrails
+GUARDRAIL_CACHE_SIZE = env.int("GUARDRAIL_CACHE_SIZE", default=4096)
+# Load the NLP engine at server start (it is otherwise built on first use)
+GUARDRAIL_WARMUP = env.bool("GUARDRAIL_WARMUP", default=True)
+GUARDRAIL_WORKERS = env.int("GUARDRAIL_WORKERS", default=4)
+# Open the upstream LLM request while the guardrail check runs. Off by
+# default: when on, the message (PII, toxic text) is sent to OpenRouter
+# before the verdict is known, and a blocked message has already left.
+GUARDRAIL_SPECULATIVE = env.bool("GUARDRAIL_SPECULATIVE", default=False)
+# Toxic terms/phrases file (defaults to apps/newchat/data/toxic_terms.txt)
+GUARDRAIL_TOXIC_LEXICON = env("GUARDRAIL_TOXIC_LEXICON", default=None)
+GUARDRAIL_LEXICON_RELOAD_SECONDS = env.int("GUARDRAIL_LEXICON_RELOAD_SECONDS", default=30)
+# Shared guardrail sidecar (manage.py guardrail_server); unset = in-process only
+GUARDRAIL_SOCKET = env("GUARDRAIL_SOCKET", default=None)
+GUARDRAIL_SOCKET_TIMEOUT = env.float("GUARDRAIL_SOCKET_TIMEOUT", default=2.0)
+GUARDRAIL_SIDECAR_RETRY_SECONDS = env.int("GUARDRAIL_SIDECAR_RETRY_SECONDS", default=10)
+GUARDRAIL_BATCH_SIZE = env.int("GUARDRAIL_BATCH_SIZE", default=32)
+GUARDRAIL_BATCH_WINDOW_MS = env.int("GUARDRAIL_BATCH_WINDOW_MS", default=5)
 
 ALLOWED_HOSTS = []
 
@@ -77,6 +189,7 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = 'chatbox.wsgi.application'
+ASGI_APPLICATION = 'chatbox.asgi.application'
 
 
 # Database
@@ -94,6 +207,16 @@ DATABASES = {
 }
 
 
+# Cache (quota counters, guardrail verdicts, ...). Use a shared backend such
+# as redis:// or pymemcache:// in production so all workers see one count:
+# with locmem each worker process keeps its own quota (check newchat.W001).
+# https://docs.djangoproject.com/en/5.2/topics/cache/
+
+CACHES = {
+    'default': env.cache("CACHE_URL", default="locmemcache://"),
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
 
@@ -148,3 +271,10 @@ ADMIN_ALLOW_ONLY = True
 
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
+
+# Uploads are stored once per unique content (see chatbox/storage.py)
+STORAGES = {
+    "default": {"BACKEND": "chatbox.storage.ContentAddressedStorage"},
+    "staticfiles": {"BACKEND": "django.contrib.staticfiles.storage.StaticFilesStorage"},
+}
+CAS_BLOB_DIR = ".blobs"
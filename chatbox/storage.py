@@ -0,0 +1,183 @@
+"""
+Content-addressed media storage (STORAGES["default"])
+
+Every saved file is hashed in streamed chunks and its bytes are kept once,
+under MEDIA_ROOT/<CAS_BLOB_DIR>/<h[:2]>/<h>. The name a FileField stores
+(e.g. "chat_uploads/photo_ab12Cd3.jpg") is a hard link to that blob, so
+URLs, names and templates are unchanged while a repeated upload costs a
+hash pass and a link instead of a second copy on disk.
+
+The blob's link count is its reference count: deleting a name drops one
+reference, and the blob goes when the last name pointing at it is deleted.
+"""
+
+from django.conf import settings
+from django.core.files.storage import FileSystemStorage
+from django.core.files.move import file_move_safe
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+
+logger = logging.getLogger(__name__)
+
+HASH_CHUNK_SIZE = 64 * 1024
+
+_stats_lock = threading.Lock()
+_stats = {
+    "saves": 0,
+    "deduplicated": 0,
+    "bytes_written": 0,
+    "bytes_deduplicated": 0,
+}
+
+
+def stats():
+    with _stats_lock:
+        return dict(_stats)
+
+
+def _count(**values):
+    with _stats_lock:
+        for key, value in values.items():
+            _stats[key] += value
+
+
+def file_digest(chunks):
+    digest = hashlib.sha256()
+    size = 0
+    for chunk in chunks:
+        digest.update(chunk)
+        size += len(chunk)
+    return digest.hexdigest(), size
+
+
+def path_digest(path):
+    with open(path, "rb") as f:
+        return file_digest(iter(lambda: f.read(HASH_CHUNK_SIZE), b""))
+
+
+class ContentAddressedStorage(FileSystemStorage):
+
+    @property
+    def blob_root(self):
+        return os.path.join(self.location, settings.CAS_BLOB_DIR)
+
+    def blob_path(self, digest):
+        return os.path.join(self.blob_root, digest[:2], digest)
+
+    def references(self, name):
+        """
+        How many stored names share this file's bytes
+        """
+        return os.stat(self.path(name)).st_nlink - 1
+
+    # =====================
+    # SAVE
+    # =====================
+    def _save(self, name, content):
+        if hasattr(content, "temporary_file_path"):
+            digest, size = path_digest(content.temporary_file_path())
+        else:
+            content.seek(0)
+            digest, size = file_digest(content.chunks(HASH_CHUNK_SIZE))
+            content.seek(0)
+
+        blob = self.blob_path(digest)
+        try:
+            created = self._ensure_blob(blob, content)
+        except OSError:
+            # No hard links on this filesystem: plain copy
+            logger.warning("Content-addressed save failed, storing a plain copy", exc_info=True)
+            content.seek(0)
+            return super()._save(name, content)
+
+        full_path = self.path(name)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+
+        while True:
+            try:
+                os.link(blob, full_path)
+                break
+            except FileExistsError:
+                # A file with this name appeared since get_available_name()
+                name = self.get_available_name(name)
+                full_path = self.path(name)
+            except FileNotFoundError:
+                # Last reference deleted the blob meanwhile; put it back
+                created = self._ensure_blob(blob, content)
+
+        if self.file_permissions_mode is not None:
+            os.chmod(full_path, self.file_permissions_mode)
+
+        _count(
+            saves=1,
+            deduplicated=int(not created),
+            bytes_written=size if created else 0,
+            bytes_deduplicated=0 if created else size,
+        )
+        return str(name).replace("\\", "/")
+
+    def _ensure_blob(self, blob, content):
+        """
+        Write the blob unless it is already stored; True if written
+        """
+        if os.path.exists(blob):
+            return False
+
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(blob), prefix=".tmp-")
+
+        try:
+            if hasattr(content, "temporary_file_path"):
+                os.close(fd)
+                fd = None
+                file_move_safe(content.temporary_file_path(), tmp_path, allow_overwrite=True)
+            else:
+                with os.fdopen(fd, "wb") as f:
+                    fd = None
+                    for chunk in content.chunks(HASH_CHUNK_SIZE):
+                        f.write(chunk)
+
+            try:
+                os.link(tmp_path, blob)
+                return True
+            except FileExistsError:
+                # Same bytes stored concurrently
+                return False
+        finally:
+            if fd is not None:
+                os.close(fd)
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    # =====================
+    # DELETE
+    # =====================
+    def delete(self, name):
+        if not name:
+            raise ValueError("The name must be given to delete().")
+
+        path = self.path(name)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return
+
+        if stat.st_nlink <= 1:
+            # Not linked to a blob (stored before this backend)
+            return super().delete(name)
+
+        digest, _ = path_digest(path)
+        super().delete(name)
+        self._release_blob(self.blob_path(digest))
+
+    def _release_blob(self, blob):
+        try:
+            if os.stat(blob).st_nlink == 1:
+                os.remove(blob)
+        except FileNotFoundError:
+            pass
+        except OSError:
+            logger.warning("Could not release blob %s", blob, exc_info=True)
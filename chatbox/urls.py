@@ -2,10 +2,12 @@ from django.contrib import admin
 from django.urls import path, include
 from django.conf import settings
 from django.conf.urls.static import static  
+from chatbox.metrics import metrics_view
 
 urlpatterns = [
     
     path("chatbot/", include("apps.newchat.urls")),
+    path("metrics", metrics_view, name="metrics"),
     path("",include("apps.author.urls")),
     path("",include("apps.history.urls")),
     path("", include("apps.profiles.urls")),
@@ -0,0 +1,99 @@
+"""
+One long-lived event loop per process for the async chat views under WSGI
+
+Under WSGI Django runs an async view on a throwaway event loop and reads an
+async streaming response to the end before sending any of it. Views wrapped
+in serve() run on this loop instead, so the AsyncOpenAI pool, detached SSE
+generations and live streams outlive the request, and their response body
+is handed to the WSGI server as a plain iterator that steps the async one a
+chunk at a time. Under ASGI serve() calls the view directly.
+"""
+
+from asgiref.sync import ThreadSensitiveContext
+from django.core.handlers.asgi import ASGIRequest
+from functools import wraps
+import asyncio
+import os
+import threading
+
+_loop = None
+_lock = threading.Lock()
+_END = object()
+
+
+def get_loop():
+    global _loop
+
+    if _loop is None:
+        with _lock:
+            if _loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name="worker-loop", daemon=True).start()
+                _loop = loop
+    return _loop
+
+
+def _reset_loop():
+    # The loop's thread does not survive a fork
+    global _loop
+    _loop = None
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_loop)
+
+
+def submit(coro):
+    """
+    Run coro on the worker loop; returns a concurrent.futures.Future
+    """
+    return asyncio.run_coroutine_threadsafe(coro, get_loop())
+
+
+def iterate(iterator):
+    """
+    Blocking iterator over an async iterator that lives on the worker loop
+    """
+
+    async def step():
+        try:
+            return await anext(iterator)
+        except StopAsyncIteration:
+            return _END
+
+    try:
+        while True:
+            item = submit(step()).result()
+            if item is _END:
+                return
+            yield item
+    finally:
+        # Client gone (or body done): let the async generator clean up
+        aclose = getattr(iterator, "aclose", None)
+        if aclose is not None:
+            submit(aclose()).result()
+
+
+def serve(view):
+    """
+    Async view decorator: run on the worker loop when not under ASGI
+    """
+
+    @wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        if isinstance(request, ASGIRequest):
+            return await view(request, *args, **kwargs)
+
+        async def run():
+            # Own thread for this request's thread-sensitive ORM calls
+            async with ThreadSensitiveContext():
+                return await view(request, *args, **kwargs)
+
+        response = await asyncio.wrap_future(submit(run()))
+        if getattr(response, "is_async", False):
+            # The view's own iterator (not the streaming_content wrapper), so
+            # closing the response closes the view's generator right away
+            response.streaming_content = iterate(response._iterator)
+        return response
+
+    return wrapper
@@ -3,6 +3,9 @@ WSGI config for Chatbox project.
 
 It exposes the WSGI callable as a module-level variable named ``application``.
 
+The async streaming views run on a per-process worker loop here (see
+chatbox/worker_loop.py), so their responses still stream chunk by chunk.
+
 For more information on this file, see
 https://docs.djangoproject.com/en/5.2/howto/deployment/wsgi/
 """
@@ -11,6 +14,6 @@ import os
 
 from django.core.wsgi import get_wsgi_application
 
-os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'Chatbox.settings')
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'chatbox.settings')
 
 application = get_wsgi_application()
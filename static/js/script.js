@@ -44,38 +44,43 @@ document.addEventListener("click", function (e) {
 
 });
 
-// Toggle individual menu
-document.querySelectorAll(".menu-btn").forEach(btn => {
-    btn.addEventListener("click", function (e) {
-        e.stopPropagation();
+// Toggle individual menu (root = document, or rows appended by infinite scroll)
+function bindRowMenus(root = document) {
 
-        const menu = this.nextElementSibling;
+    root.querySelectorAll(".menu-btn").forEach(btn => {
+        btn.addEventListener("click", function (e) {
+            e.stopPropagation();
 
-        // Close other open menus first
-        document.querySelectorAll(".menu-dropdown").forEach(m => {
-            if (m !== menu) m.style.display = "none";
-        });
+            const menu = this.nextElementSibling;
+
+            // Close other open menus first
+            document.querySelectorAll(".menu-dropdown").forEach(m => {
+                if (m !== menu) m.style.display = "none";
+            });
 
-        // Toggle current menu
-        menu.style.display =
-            menu.style.display === "block" ? "none" : "block";
+            // Toggle current menu
+            menu.style.display =
+                menu.style.display === "block" ? "none" : "block";
+        });
     });
-});
 
-document.querySelectorAll(".menu-item").forEach(item => {
+    root.querySelectorAll(".menu-item").forEach(item => {
 
-    item.addEventListener("click", function () {
+        item.addEventListener("click", function () {
 
-        // find this menu
-        const menu = this.closest(".menu-dropdown");
+            // find this menu
+            const menu = this.closest(".menu-dropdown");
 
-        if(menu){
-            menu.style.display = "none";
-        }
+            if(menu){
+                menu.style.display = "none";
+            }
+
+        });
 
     });
+}
 
-});
+bindRowMenus();
 
 
 // ======================
@@ -140,7 +145,7 @@ function forceLimitReached(seconds = 0) {
         msg.id = "limitMessage";
         msg.className = "message system-message";
         msg.innerHTML = `
-            ⚠ Chat limit reached (10 messages / 24 hours)
+            ⚠ Chat limit reached (${window.QUOTA_LIMIT || 10} messages / ${window.QUOTA_HOURS || 24} hours)
             <div id="timeLeft"></div>
         `;
         chatBody.appendChild(msg);
@@ -329,10 +334,10 @@ const closeShare = document.getElementById("closeShare");
 const copyBtn = document.getElementById("copyShare");
 const shareInput = document.getElementById("shareLink");
 
-// STOP if modal doesn't exist on this page
-if (modal && closeShare && copyBtn && shareInput) {
+function bindShareButtons(root = document) {
+  if (!modal || !shareInput) return;
 
-  document.querySelectorAll(".share-btn, .history-share").forEach(btn => {
+  root.querySelectorAll(".share-btn, .history-share").forEach(btn => {
     btn.addEventListener("click", function (e) {
       e.stopPropagation();
 
@@ -343,6 +348,12 @@ if (modal && closeShare && copyBtn && shareInput) {
       modal.style.display = "block";
     });
   });
+}
+
+// STOP if modal doesn't exist on this page
+if (modal && closeShare && copyBtn && shareInput) {
+
+  bindShareButtons();
 
   closeShare.onclick = () => modal.style.display = "none";
 
@@ -400,17 +411,31 @@ async function sendMessage(e) {
 
     if (selectedFile) formData.append("file", selectedFile);
 
+    // 🔁 One key per message: a retry of this send is answered, not re-generated
+    const idempotencyKey = crypto.randomUUID();
+
+    const post = () => fetch(isStreaming ? "/chatbot/stream/" : "/chatbot/", {
+        method: "POST",
+        headers: {
+            "X-CSRFToken": getCookie("csrftoken"),
+            "X-Requested-With": "XMLHttpRequest",
+            "Idempotency-Key": idempotencyKey,
+            // SSE: numbered events we can resume from if the connection drops
+            "Accept": isStreaming ? "text/event-stream" : "application/json"
+        },
+        body: formData
+    });
+
     try {
 
         // ✅ 1. SEND REQUEST FIRST (check legal)
-        const res = await fetch(isStreaming ? "/chatbot/stream/" : "/chatbot/", {
-            method: "POST",
-            headers: {
-                "X-CSRFToken": getCookie("csrftoken"),
-                "X-Requested-With": "XMLHttpRequest"
-            },
-            body: formData
-        });
+        let res;
+        try {
+            res = await post();
+        } catch (networkError) {
+            // Dropped connection: retry once with the same key
+            res = await post();
+        }
 
         // 🚫 2. ILLEGAL → popup only
         if (res.status === 403) {
@@ -427,6 +452,15 @@ async function sendMessage(e) {
         }
 
 
+        // ⏳ QUOTA → lock input + countdown
+        if (res.status === 429) {
+            const data = await res.json().catch(() => ({}));
+            window.REMAINING_MESSAGES = 0;
+            forceLimitReached(data.remaining_seconds || 0);
+            isProcessing = false;
+            return;
+        }
+
         if (!res.ok) {
             const err = await res.text();
             console.error("Server error:", err);
@@ -512,8 +546,8 @@ async function sendMessage(e) {
         // STREAM
         // ======================
         if (isStreaming) {
-            const reader = res.body.getReader();
-            const decoder = new TextDecoder();
+            let reader = res.body.getReader();
+            let decoder = new TextDecoder();
 
             const botWrapper = document.createElement("div");
             botWrapper.className = "chat-message bot-message";
@@ -525,7 +559,6 @@ async function sendMessage(e) {
             botContent.className = "message-content markdown-content message-text";
 
             botMsg.appendChild(botContent);
-
             // ✅ ADD COPY BUTTON
             const actions = document.createElement("div");
             actions.className = "message-actions";
@@ -537,22 +570,18 @@ async function sendMessage(e) {
 
             let fullMarkdown = "";
             let renderTimer="";
+            let pending = "";
+            let lastEventId = null;
+            let resumes = 0;
+            let finished = false;
 
-            while (true) {
-                const { value, done } = await reader.read();
-                if (done) break;
-
-                const chunk = decoder.decode(value, { stream: true });
-
-                if (!streamStarted && chunk.trim()) {
+            function showToken(text) {
+                if (!streamStarted && text.trim()) {
                     streamStarted = true;
                     if (typing) typing.style.display = "none";
                 }
 
-                fullMarkdown += chunk;
-                function renderMarkdown() {
-                    botContent.innerHTML = DOMPurify.sanitize(marked.parse(fullMarkdown));
-                }
+                fullMarkdown += text;
 
                 clearTimeout(renderTimer);
                 renderTimer = setTimeout(() => {
@@ -560,6 +589,48 @@ async function sendMessage(e) {
                 }, 80);
                 autoScroll();
             }
+
+            while (!finished) {
+                let value, done;
+                try {
+                    ({ value, done } = await reader.read());
+                } catch (dropped) {
+                    // 🔌 Connection lost mid-reply: pick up after the last event
+                    if (!lastEventId || resumes >= MAX_STREAM_RESUMES) throw dropped;
+                    resumes++;
+                    await new Promise(r => setTimeout(r, 1000 * resumes));
+
+                    const resumed = await fetch("/chatbot/stream/resume/", {
+                        headers: { "Last-Event-ID": lastEventId }
+                    }).catch(() => null);
+                    if (!resumed || !resumed.ok) throw dropped;
+
+                    reader = resumed.body.getReader();
+                    decoder = new TextDecoder();
+                    pending = "";
+                    continue;
+                }
+                if (done) break;
+
+                pending += decoder.decode(value, { stream: true });
+
+                let boundary;
+                while (!finished && (boundary = pending.indexOf("\n\n")) !== -1) {
+                    const event = parseSseEvent(pending.slice(0, boundary));
+                    pending = pending.slice(boundary + 2);
+
+                    if (event.id) lastEventId = event.id;
+
+                    if (event.type === "done") {
+                        finished = true;
+                    } else if (event.type === "error") {
+                        showToken(`\n\n[Error: ${event.data}]`);
+                        finished = true;
+                    } else {
+                        showToken(event.data);
+                    }
+                }
+            }
         }
 
         window.REMAINING_MESSAGES--;
@@ -578,6 +649,29 @@ async function sendMessage(e) {
     document.getElementById("fileInput").value = "";
 }
 
+// ======================
+// SSE PARSING
+// ======================
+const MAX_STREAM_RESUMES = 3;
+
+function parseSseEvent(frame) {
+    const event = { id: null, type: "message", data: [] };
+
+    frame.split("\n").forEach(line => {
+        const colon = line.indexOf(":");
+        const field = colon === -1 ? line : line.slice(0, colon);
+        let value = colon === -1 ? "" : line.slice(colon + 1);
+        if (value.startsWith(" ")) value = value.slice(1);
+
+        if (field === "id") event.id = value;
+        else if (field === "event") event.type = value;
+        else if (field === "data") event.data.push(value);
+    });
+
+    event.data = event.data.join("\n");
+    return event;
+}
+
 // ======================
 // FILE UPLOAD
 // ======================
@@ -749,6 +843,72 @@ function searchHistory() {
     });
 }
 
+// ======================
+// INFINITE SCROLL (keyset pages from /history/page/)
+// ======================
+document.addEventListener("DOMContentLoaded", () => {
+    const body = document.querySelector(".history-body[data-page-url]");
+    if (!body) return;
+
+    let loading = false;
+
+    function appendRows(html) {
+        const tpl = document.createElement("template");
+        tpl.innerHTML = html;
+
+        tpl.content.querySelectorAll(".history-group").forEach(group => {
+            const groups = body.querySelectorAll(".history-group");
+            const last = groups[groups.length - 1];
+
+            // Same day as the last rendered group -> continue that group
+            if (last && last.dataset.date === group.dataset.date) {
+                group.querySelectorAll(".history-row").forEach(row => {
+                    last.appendChild(row);
+                    bindRowMenus(row);
+                    bindShareButtons(row);
+                });
+            } else {
+                body.appendChild(group);
+                bindRowMenus(group);
+                bindShareButtons(group);
+            }
+        });
+    }
+
+    async function loadNextPage() {
+        const cursor = body.dataset.nextCursor;
+        if (loading || !cursor) return;
+
+        loading = true;
+        try {
+            const params = new URLSearchParams({
+                archived: body.dataset.archived,
+                sort: body.dataset.sort,
+                cursor: cursor
+            });
+            const res = await fetch(`${body.dataset.pageUrl}?${params}`);
+            if (!res.ok) return;
+
+            const data = await res.json();
+            appendRows(data.html);
+            body.dataset.nextCursor = data.next_cursor || "";
+        } finally {
+            loading = false;
+        }
+
+        // Short pages may not fill the viewport yet
+        if (body.scrollHeight <= body.clientHeight) loadNextPage();
+    }
+
+    body.addEventListener("scroll", () => {
+        if (body.scrollTop + body.clientHeight >= body.scrollHeight - 200) {
+            loadNextPage();
+        }
+    });
+
+    if (body.scrollHeight <= body.clientHeight) loadNextPage();
+});
+
 // -------------------------
 // 🌟 SORT HISTORY
 // -------------------------